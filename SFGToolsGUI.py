@@ -4,6 +4,7 @@ import sys
 import sfgtools as SFGTools
 from pathlib import PurePath
 import numpy as np
+import matplotlib.pyplot as plt
 import itertools as itertools
 
 class ItemDelegate(QtWidgets.QStyledItemDelegate):
@@ -70,6 +71,32 @@ class TableModel(QtCore.QAbstractTableModel):
         print('ended insert rows')
 
 
+class ProcessWorker(QtCore.QObject):
+    """Runs pull_trigger() of an SFGProcessTools object on a QThread, so the window doesn't freeze.
+
+    Each processed file is sent back to the GUI thread with the progress signal, which is where it is plotted,
+    as matplotlib figures can only be made on the GUI thread.
+    """
+    progress = QtCore.pyqtSignal(int, int, object)
+    failed = QtCore.pyqtSignal(object)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    @QtCore.pyqtSlot()
+    def run(self):
+        self.model.progress_callback = self.progress.emit
+        try:
+            self.model.pull_trigger(plot=False)
+        except Exception as error:
+            self.failed.emit(error)
+        finally:
+            self.model.progress_callback = None
+            self.finished.emit()
+
+
 class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
 
     def __init__(self):
@@ -94,6 +121,13 @@ class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
         self.model.close_plots_check = self.close_plots_checkbox.isChecked()
         self.model.stack_plots_check = self.stack_plots_checkbox.isChecked()
         self.model.auto_sort_check = self.auto_sort_checkbox.isChecked()
+        # JDP the performance options are off unless they were ticked last time, see the Performance tab
+        self.metadata_index_checkbox.setChecked(self.initsettings.value("last_metadata_index", False, type=bool))
+        self.incremental_checkbox.setChecked(self.initsettings.value("last_incremental", False, type=bool))
+        self.fast_plot_checkbox.setChecked(self.initsettings.value("last_fast_plot", False, type=bool))
+        self.model.metadata_index_check = self.metadata_index_checkbox.isChecked()
+        self.model.incremental_check = self.incremental_checkbox.isChecked()
+        self.model.fast_plot_check = self.fast_plot_checkbox.isChecked()
 
         # JDP getting last run values for boxes and things from the Qsettings
         if self.initsettings.value("last_dir"):
@@ -116,9 +150,11 @@ class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
             self.cosmic_width_box.setText(self.initsettings.value("last_cosmicwidth"))
             self.model.cosmic_max_width = self.initsettings.value("last_cosmicwidth")
 
-        if self.initsettings.value("last_cosmicthreshold"):
-            self.cosmic_threshold_box.setText(self.initsettings.value("last_cosmicthreshold"))
-            self.model.cosmic_threshold = self.initsettings.value("last_cosmicthreshold")
+        # JDP the threshold used to be absolute, now it is in multiples of the noise, so drop the old setting
+        self.initsettings.remove("last_cosmicthreshold")
+        if self.initsettings.value("last_cosmicthreshold_sigma"):
+            self.cosmic_threshold_box.setText(self.initsettings.value("last_cosmicthreshold_sigma"))
+            self.model.cosmic_threshold = self.initsettings.value("last_cosmicthreshold_sigma")
 
         if self.initsettings.value("last_upconverter"):
             self.upconversion_line_dropdown.setCurrentText(self.initsettings.value("last_upconverter"))
@@ -155,10 +191,98 @@ class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
         self.delegate = ItemDelegate(mainWindow)
         self.dataTable.setItemDelegate(self.delegate)
         self.referenceTable.setItemDelegate(self.delegate)
+        # JDP progress bar and cancel button for processing, only shown while it is running
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setVisible(False)
+        self.cancel_button = QtWidgets.QPushButton('Cancel')
+        self.cancel_button.setVisible(False)
+        self.cancel_button.clicked.connect(self.cancelSlot)
+        self.statusbar.addPermanentWidget(self.progress_bar)
+        self.statusbar.addPermanentWidget(self.cancel_button)
+        self.process_thread = None
+        self.process_worker = None
 
     @QtCore.pyqtSlot()
     def detonateSlot(self):
-        self.model.pull_trigger()
+        # JDP process on a worker thread so the window stays responsive, the settings are locked while it runs
+        if self.process_thread is not None:
+            return
+        self.centralwidget.setEnabled(False)
+        self.progress_bar.setRange(0, max(len(self.model.signal_names), 1))
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.cancel_button.setEnabled(True)
+        self.cancel_button.setVisible(True)
+        self.statusbar.showMessage('Processing...')
+
+        # JDP clear any earlier cancel here rather than on the worker thread, so an early cancel isn't wiped
+        self.model.cancel_event.clear()
+        self.process_thread = QtCore.QThread()
+        self.process_worker = ProcessWorker(self.model)
+        self.process_worker.moveToThread(self.process_thread)
+        self.process_thread.started.connect(self.process_worker.run)
+        self.process_worker.progress.connect(self.process_progressSlot)
+        self.process_worker.failed.connect(self.process_failedSlot)
+        self.process_worker.finished.connect(self.process_finishedSlot)
+        self.process_thread.start()
+
+    @QtCore.pyqtSlot(int, int, object)
+    def process_progressSlot(self, index, num_files, datastore):
+        self.progress_bar.setMaximum(num_files)
+        self.progress_bar.setValue(index + 1)
+        self.statusbar.showMessage('Processed ' + str(index + 1) + '/' + str(num_files) + ': ' +
+                                   PurePath(datastore.filename_sig).name)
+        if self.model.plot_data_check:
+            self.model.current_figure = self.model.plot_data(datastore, index, num_files,
+                                                             self.model.current_figure)
+
+    @QtCore.pyqtSlot(object)
+    def process_failedSlot(self, error):
+        print('Processing failed:', repr(error))
+        self.statusbar.showMessage('Processing failed: ' + str(error))
+        err = QtWidgets.QMessageBox(self)
+        err.setText('Processing failed: ' + str(error))
+        err.setIcon(QtWidgets.QMessageBox.Warning)
+        err.setStandardButtons(QtWidgets.QMessageBox.Ok)
+        err.setDefaultButton(QtWidgets.QMessageBox.Ok)
+        err.open()
+
+    @QtCore.pyqtSlot()
+    def process_finishedSlot(self):
+        self.process_thread.quit()
+        self.process_thread.wait()
+        self.process_worker.deleteLater()
+        self.process_thread.deleteLater()
+        self.process_thread = None
+        self.process_worker = None
+
+        if self.model.cancel_event.is_set():
+            self.statusbar.showMessage('Processing cancelled.')
+            # JDP plots are only shown after the last file, so show what was plotted before cancelling
+            if self.model.plot_data_check:
+                plt.show()
+        elif not self.statusbar.currentMessage().startswith('Processing failed'):
+            self.statusbar.showMessage('Processing finished.')
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+        self.centralwidget.setEnabled(True)
+
+    @QtCore.pyqtSlot()
+    def cancelSlot(self):
+        self.model.cancel_event.set()
+        self.cancel_button.setEnabled(False)
+        self.statusbar.showMessage('Cancelling after the current file...')
+
+    def stop_processing(self):
+        # JDP cancel and wait for the worker thread, so it isn't destroyed while it is still running
+        if self.process_thread is not None:
+            self.model.cancel_event.set()
+            self.process_thread.quit()
+            self.process_thread.wait()
+
+    def closeEvent(self, event):
+        self.stop_processing()
+        super().closeEvent(event)
 
     @QtCore.pyqtSlot()
     def data_directorySlot(self):
@@ -346,7 +470,7 @@ class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
     @QtCore.pyqtSlot()
     def cosmic_thresholdSlot(self):
         self.model.cosmic_threshold = float(self.cosmic_threshold_box.text())
-        self.initsettings.setValue("last_cosmicthreshold", self.model.cosmic_threshold)
+        self.initsettings.setValue("last_cosmicthreshold_sigma", self.model.cosmic_threshold)
 
     @QtCore.pyqtSlot()
     def cosmic_widthSlot(self):
@@ -385,7 +509,7 @@ class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
             self.model.cosmic_max_width = None
             self.cosmic_width_box.setText(self.model.cosmic_max_width)
 
-        if self.initsettings.value("last_cosmicthreshold"):
+        if self.initsettings.value("last_cosmicthreshold_sigma"):
             self.model.cosmic_threshold = None
             self.cosmic_threshold_box.setText(self.model.cosmic_threshold)
 
@@ -405,6 +529,10 @@ class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
             self.model.custom_region_end = None
             self.custom_region_end_textbox.setText(self.model.custom_region_end)
 
+        self.metadata_index_checkbox.setChecked(False)
+        self.incremental_checkbox.setChecked(False)
+        self.fast_plot_checkbox.setChecked(False)
+
         for i in self.initsettings.allKeys():
             self.initsettings.remove(i)
 
@@ -462,12 +590,28 @@ class MainWindowUIClass(QtWidgets.QMainWindow, Ui_MainWindow):
 
     @QtCore.pyqtSlot()
     def quit_Slot(self):
+        self.stop_processing()
         QtWidgets.QApplication.quit()
 
     @QtCore.pyqtSlot()
     def auto_sort_checkSlot(self):
         self.model.auto_sort_check = self.auto_sort_checkbox.isChecked()
 
+    @QtCore.pyqtSlot()
+    def metadata_index_checkboxSlot(self):
+        self.model.metadata_index_check = self.metadata_index_checkbox.isChecked()
+        self.initsettings.setValue("last_metadata_index", self.model.metadata_index_check)
+
+    @QtCore.pyqtSlot()
+    def incremental_checkboxSlot(self):
+        self.model.incremental_check = self.incremental_checkbox.isChecked()
+        self.initsettings.setValue("last_incremental", self.model.incremental_check)
+
+    @QtCore.pyqtSlot()
+    def fast_plot_checkboxSlot(self):
+        self.model.fast_plot_check = self.fast_plot_checkbox.isChecked()
+        self.initsettings.setValue("last_fast_plot", self.model.fast_plot_check)
+
 
     @QtCore.pyqtSlot()
     def calibration_sample_dropdownSlot(self):
@@ -510,4 +654,5 @@ def main():
     app.exec()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -219,6 +219,27 @@ class Ui_MainWindow(object):
         self.cosmic_width_box.setObjectName("cosmic_width_box")
         self.gridLayout_4.addWidget(self.cosmic_width_box, 6, 1, 1, 2)
         self.processing_tab.addTab(self.general_processing, "")
+        self.performance_processing = QtWidgets.QWidget()
+        self.performance_processing.setObjectName("performance_processing")
+        self.layoutWidget_performance = QtWidgets.QWidget(self.performance_processing)
+        self.layoutWidget_performance.setGeometry(QtCore.QRect(10, 10, 221, 91))
+        self.layoutWidget_performance.setObjectName("layoutWidget_performance")
+        self.gridLayout_performance = QtWidgets.QGridLayout(self.layoutWidget_performance)
+        self.gridLayout_performance.setContentsMargins(0, 0, 0, 0)
+        self.gridLayout_performance.setObjectName("gridLayout_performance")
+        self.metadata_index_checkbox = QtWidgets.QCheckBox(self.layoutWidget_performance)
+        self.metadata_index_checkbox.setChecked(False)
+        self.metadata_index_checkbox.setObjectName("metadata_index_checkbox")
+        self.gridLayout_performance.addWidget(self.metadata_index_checkbox, 0, 0, 1, 1)
+        self.incremental_checkbox = QtWidgets.QCheckBox(self.layoutWidget_performance)
+        self.incremental_checkbox.setChecked(False)
+        self.incremental_checkbox.setObjectName("incremental_checkbox")
+        self.gridLayout_performance.addWidget(self.incremental_checkbox, 1, 0, 1, 1)
+        self.fast_plot_checkbox = QtWidgets.QCheckBox(self.layoutWidget_performance)
+        self.fast_plot_checkbox.setChecked(False)
+        self.fast_plot_checkbox.setObjectName("fast_plot_checkbox")
+        self.gridLayout_performance.addWidget(self.fast_plot_checkbox, 2, 0, 1, 1)
+        self.processing_tab.addTab(self.performance_processing, "")
         self.output = QtWidgets.QGroupBox(self.centralwidget)
         self.output.setGeometry(QtCore.QRect(10, 370, 261, 221))
         font = QtGui.QFont()
@@ -518,6 +539,9 @@ class Ui_MainWindow(object):
         self.calibration_sample_dropdown.currentTextChanged['QString'].connect(MainWindow.calibration_sample_dropdownSlot)
         self.calibrate_checkbox.clicked['bool'].connect(self.calibration_degree_box.setEnabled)
         self.calibration_degree_box.editingFinished.connect(MainWindow.calibration_degree_boxSlot)
+        self.metadata_index_checkbox.stateChanged['int'].connect(MainWindow.metadata_index_checkboxSlot)
+        self.incremental_checkbox.stateChanged['int'].connect(MainWindow.incremental_checkboxSlot)
+        self.fast_plot_checkbox.stateChanged['int'].connect(MainWindow.fast_plot_checkboxSlot)
         QtCore.QMetaObject.connectSlotsByName(MainWindow)
 
     def retranslateUi(self, MainWindow):
@@ -610,10 +634,10 @@ class Ui_MainWindow(object):
         self.calibration_degree_box.setText(_translate("MainWindow", "1"))
         self.calibration_degree_box.setPlaceholderText(_translate("MainWindow", "Calibration Degree"))
         self.label_2.setText(_translate("MainWindow", "Degree"))
-        self.cosmic_threshold_box.setToolTip(_translate("MainWindow", "The height that a spectral feature needs to be above the baseline to be considered for cosmic ray removal."))
-        self.cosmic_threshold_box.setStatusTip(_translate("MainWindow", "The height that a spectral feature needs to be above the baseline to be considered for cosmic ray removal."))
-        self.cosmic_threshold_box.setWhatsThis(_translate("MainWindow", "The height that a spectral feature needs to be above the baseline to be considered for cosmic ray removal."))
-        self.cosmic_threshold_box.setPlaceholderText(_translate("MainWindow", "Default: 0.01"))
+        self.cosmic_threshold_box.setToolTip(_translate("MainWindow", "How far a spike needs to be above the running median baseline to be considered for cosmic ray removal, in multiples of the noise of the spectrum (1.4826 x median absolute deviation). Default 5."))
+        self.cosmic_threshold_box.setStatusTip(_translate("MainWindow", "How far a spike needs to be above the running median baseline to be considered for cosmic ray removal, in multiples of the noise of the spectrum (1.4826 x median absolute deviation). Default 5."))
+        self.cosmic_threshold_box.setWhatsThis(_translate("MainWindow", "How far a spike needs to be above the running median baseline to be considered for cosmic ray removal, in multiples of the noise of the spectrum (1.4826 x median absolute deviation). Default 5."))
+        self.cosmic_threshold_box.setPlaceholderText(_translate("MainWindow", "Default: 5"))
         self.calibration_sample_dropdown.setItemText(0, _translate("MainWindow", "Polystyrene"))
         self.calibration_sample_dropdown.setItemText(1, _translate("MainWindow", "Water"))
         self.calibration_sample_dropdown.setItemText(2, _translate("MainWindow", "CO2"))
@@ -622,6 +646,19 @@ class Ui_MainWindow(object):
         self.cosmic_width_box.setWhatsThis(_translate("MainWindow", "The maximum width (in pixels) for a spectral feature to be considered a cosmic ray - if it is wider than this it is presumed to be real."))
         self.cosmic_width_box.setPlaceholderText(_translate("MainWindow", "Default: 5"))
         self.processing_tab.setTabText(self.processing_tab.indexOf(self.general_processing), _translate("MainWindow", "General"))
+        self.metadata_index_checkbox.setToolTip(_translate("MainWindow", "Keep an index of the files in the data directory."))
+        self.metadata_index_checkbox.setStatusTip(_translate("MainWindow", "Keep an index of the files in the data directory."))
+        self.metadata_index_checkbox.setWhatsThis(_translate("MainWindow", "If checked, \"Get Data\" keeps an index of the .spe files in a .sfgtools_index.sqlite file in the data directory, so that only new or changed files are read on the next click."))
+        self.metadata_index_checkbox.setText(_translate("MainWindow", "Index Data Directory?"))
+        self.incremental_checkbox.setToolTip(_translate("MainWindow", "Only redo the processing that has changed since the last run."))
+        self.incremental_checkbox.setStatusTip(_translate("MainWindow", "Only redo the processing that has changed since the last run."))
+        self.incremental_checkbox.setWhatsThis(_translate("MainWindow", "If checked, the result of every processing step is kept in memory, and pressing process again only redoes the steps whose options have changed."))
+        self.incremental_checkbox.setText(_translate("MainWindow", "Only Redo Changed Steps?"))
+        self.fast_plot_checkbox.setToolTip(_translate("MainWindow", "Plot a decimated line for each file, and redraw once per batch."))
+        self.fast_plot_checkbox.setStatusTip(_translate("MainWindow", "Plot a decimated line for each file, and redraw once per batch."))
+        self.fast_plot_checkbox.setWhatsThis(_translate("MainWindow", "If checked, each spectrum is plotted as a decimated line and the figure is only redrawn at the end of the batch. Faster for many files, but not full resolution."))
+        self.fast_plot_checkbox.setText(_translate("MainWindow", "Fast Plots?"))
+        self.processing_tab.setTabText(self.processing_tab.indexOf(self.performance_processing), _translate("MainWindow", "Performance"))
         self.output.setTitle(_translate("MainWindow", "Output"))
         self.close_plots_checkbox.setToolTip(_translate("MainWindow", "Close currently open plots on next run."))
         self.close_plots_checkbox.setStatusTip(_translate("MainWindow", "Close currently open plots on next run."))
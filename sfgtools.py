@@ -2,20 +2,67 @@
 
 Classes:
     SFGProcess Tools
+
+matplotlib, lxml, and h5py are only imported the first time they are used (see LazyModule), so importing
+this module is quick. benchmark_import() times it.
 """
 
 import numpy as np
-from lxml import etree
-from PyQt5 import QtWidgets
-import matplotlib.pyplot as plt
+import importlib
+import importlib.util
 import pathlib
-import matplotlib.gridspec as gs
 import glob
+import os
+import sqlite3
 import inspect
+import collections
+import concurrent.futures
+import itertools
 import warnings
+import hashlib
+import argparse
+import threading
+import queue
+import json
+import sys
+import time
+import subprocess
 warnings.filterwarnings('ignore')
 
 
+class LazyModule:
+    """Stand-in for a module that is imported the first time one of its attributes is used.
+
+    Plotting, XML, and HDF5 support are slow to import and aren't needed by e.g. a worker process that only
+    reads SPE 2.x files and writes text files, so they are imported through this.
+
+    Parameters
+    -----------
+    name : str
+        Full name of the module, e.g. "matplotlib.pyplot".
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+etree = LazyModule('lxml.etree')
+matplotlib = LazyModule('matplotlib')
+plt = LazyModule('matplotlib.pyplot')
+gs = LazyModule('matplotlib.gridspec')
+mcollections = LazyModule('matplotlib.collections')
+mfigure = LazyModule('matplotlib.figure')
+backend_agg = LazyModule('matplotlib.backends.backend_agg')
+# JDP h5py is optional, it is None if it isn't installed
+h5py = LazyModule('h5py') if importlib.util.find_spec('h5py') is not None else None
+
+
 
 
 class SFGProcessTools:
@@ -32,6 +79,9 @@ class SFGProcessTools:
         If true tells program to print REALLY verbose output.
     sum_accumulations : bool
         If true tells program to sum multiple frames stored in the same .spe file
+    accumulation_mode : str
+        How frames are combined when sum_accumulations is set. "sum" adds them, "median", "sigmaclip" and
+        "min" reject cosmic rays across frames first. See combine_frames().
     series_accumulations : bool
         If true tells program to store multiple frames from the same .spe file as different arrays (series).
     downconvert_check : bool
@@ -56,6 +106,14 @@ class SFGProcessTools:
         If true then processed data is plotted using matplotlib.
     close_plots_check : bool
         If true then plots are closed between successive runs.
+    fast_plot_check : bool
+        If true then plot_data() draws every row of a file as one LineCollection, decimated to plot_max_points
+        with decimate_minmax(), and figures are only drawn once, after the last file of the batch.
+    stacked_check : bool
+        If true then pull_trigger() processes all files together as one SFGBatchStore.
+    metadata_index_check : bool
+        If true then the smart file getter lists files from the persistent metadata index rather than
+        globbing the data directory.
     data_directory : str
         Direcotry where all the files to processed are.
     write_directory : str
@@ -75,9 +133,57 @@ class SFGProcessTools:
     custom_region_end : float
         Defines rightmost edge of plotted data in wavenumbers.
     cosmic_threshold : float
-        Used by the cosmic_ray_killer method. See description for detail.
+        Height above the running median that a spike needs to be a cosmic ray, in multiples of the robust noise
+        of the spectrum (1.4826 times the median absolute deviation). Default 5. See cosmic_ray_killer().
     cosmic_max_width : float
         Used by the cosmic_ray_killer method. See description for detail.
+    accumulation_sigma : float
+        Frames further than this many standard deviations from the median are rejected when accumulation_mode
+        is "sigmaclip".
+    accumulation_chunk_size : int
+        Maximum number of pixel values held in memory at once when combining frames with accumulation_mode.
+    result_cache_check : bool
+        If true then processed results are saved to and loaded from an on-disk cache, see
+        process_files_cached().
+    incremental_check : bool
+        If true then pull_trigger() only redoes the processing stages that have changed since it was last
+        called, see incremental_process(). Ignored (with a message) if stacked_check, num_workers,
+        result_cache_check, or lean_memory are set, see pull_trigger() for the order of precedence.
+    lean_memory : bool
+        If true then each step of the processing chain overwrites the previous stage where it can, and only
+        the stages in keep_intermediates are kept (the others are written as NaN). See
+        SFGDataStore.lean_buffer().
+    async_write_check : bool
+        If true then files are written on a background thread while the next ones are processed, see
+        SFGFileWriter.
+    write_queue_size : int
+        Maximum number of processed files waiting to be written when async_write_check is set.
+    write_formats : list
+        Formats that write_data_to_file() writes. Possible values "txt", "npz", "hdf5", "png", a preview image
+        drawn without a display (see write_preview()), and "hdf5_batch", which adds every file of the batch to
+        one HDF5 file instead (see write_batch_to_hdf5()).
+    batch_filename : str
+        Name of the HDF5 file in write_directory that "hdf5_batch" output goes to.
+    keep_intermediates : list
+        Stages kept in lean_memory mode. Possible values "signal_raw", "signal_subtracted", "ref_raw".
+    result_cache_directory : str
+        Directory of the on-disk result cache. If None a per-user cache directory is used.
+    result_cache_max_size : int
+        Maximum size of the on-disk result cache in bytes, see prune_result_cache().
+    working_dtype : np.dtype
+        Floating point type that the spectra are stored and processed in, np.float32 (default) or np.float64.
+        Energy axes are always np.float64.
+    read_cache_size : int
+        Maximum number of files kept in read_cache. 0 disables the cache.
+    plot_max_points : int
+        Maximum number of points plotted per row of a spectrum when fast_plot_check is set.
+    preview_dpi : int
+        Resolution of the preview images from write_preview().
+    preview_size : tuple
+        Width and height in inches of the preview images from write_preview().
+    num_workers : int
+        Number of processes used to read, process, and write files in pull_trigger(). 1 processes
+        everything in the main process.
     spe_version_loc : int
         Location in bytes that the .spe file version is stored in the .spe file.
     footer_offset_loc_loc : int
@@ -95,6 +201,10 @@ class SFGProcessTools:
         Location in bytes of the pixel type stored in an SPE2.x file.
     acqtime_loc : int
         Location in bytes of the acquisition time in an SPE2.x file.
+    calib_polyorder_loc : int
+        Location in bytes of the order of the wavelength calibration polynomial in an SPE2.x file.
+    calib_polycoeffs_loc : int
+        Location in bytes of the six wavelength calibration polynomial coefficients in an SPE2.x file.
     signal_names : list
         Contains the filenames of the signal files to be processed.
     bg_names : list
@@ -113,6 +223,25 @@ class SFGProcessTools:
         Contains data to be down in the GUI reference data table.
     current_figure : pyplot figure
         Figure data is currently being plotted on.
+    preview_template : tuple
+        Figure, axes, and LineCollection reused by write_preview(), see get_preview_template().
+    metadata_index : np.ndarray
+        Metadata table of the data directory from the last call to update_metadata_index().
+    read_cache : OrderedDict
+        Least recently used cache of the data read from reference and background files. See
+        read_files_cached().
+    text_templates : dict
+        Format strings used by write_text_file(), by the shape of the data written.
+    text_columns : str
+        Last line of the header of the text files, describing the columns.
+    stage_cache : dict
+        Result of every processing stage of every file from the last call to incremental_process().
+    progress_callback : callable
+        If not None, called as progress_callback(index, num_files, datastore) each time pull_trigger() finishes
+        processing a file, see file_done().
+    cancel_event : threading.Event
+        Set it (from any thread) to stop pull_trigger() cleanly at the next file. It stays set until it is
+        cleared, so clear it before starting the next run (the GUI does so before starting its worker thread).
     """
     def __init__(self):
 
@@ -132,10 +261,22 @@ class SFGProcessTools:
         self.write_file_check = False
         self.plot_data_check = False
         self.close_plots_check = False
+        self.fast_plot_check = False
         self.auto_sort_check = False
+        self.metadata_index_check = False
+        self.stacked_check = False
+        self.lean_memory = False
+        self.incremental_check = False
+        self.result_cache_check = False
+        self.async_write_check = False
 
         # strings
+        self.accumulation_mode = 'sum'
         self.data_directory = None
+        self.result_cache_directory = None
+        self.batch_filename = 'sfgtools_batch.h5'
+        self.text_columns = "\n 0: Energy Axis, 1: Signal Normalised, 2: Reference, 3: Signal Pre-Normalise, " \
+                            "4: Signal Pre-Subtract, 5: Background, 6:Reference Pre-Subtract, 7: Energy Axis Raw"
         self.write_directory = None
         self.samplestring = None
         self.refstring = None
@@ -147,9 +288,22 @@ class SFGProcessTools:
         self.calibration_offset = None
         self.custom_region_start = None
         self.custom_region_end = None
-        self.cosmic_threshold = 0.001
+        self.cosmic_threshold = 5.0
         self.cosmic_max_width = 10
         self.calibration_degree = 1
+        self.accumulation_sigma = 3.0
+        self.accumulation_chunk_size = 2**22
+        self.working_dtype = np.float32
+        self.result_cache_max_size = 2**30
+        self.write_queue_size = 8
+        self.read_cache_size = 32
+        self.num_workers = 1
+        self.plot_max_points = 2000
+        self.preview_dpi = 100
+
+        # lists
+        self.keep_intermediates = []
+        self.write_formats = ['txt']
         
         #np arrays
         self.calibration_sample = None
@@ -163,6 +317,8 @@ class SFGProcessTools:
         self.numframes_loc = 1446
         self.pixeltype_loc = 108
         self.acqtime_loc = 10
+        self.calib_polyorder_loc = 3101
+        self.calib_polycoeffs_loc = 3263
 
         # lists
         self.signal_names = []
@@ -179,8 +335,16 @@ class SFGProcessTools:
                                   'Water' : np.array([1424.123, 1505.599, 1601.201, 1792.651]),
                                   'CO2': np.array([2330.55754, 2339.37269, 2351.44763, 2361.46638])
                                  }
+        self.read_cache = collections.OrderedDict()
+        self.stage_cache = {}
+        self.text_templates = {}
         # misc
         self.current_figure = None
+        self.preview_template = None
+        self.preview_size = (6.4, 4.8)
+        self.metadata_index = None
+        self.progress_callback = None
+        self.cancel_event = threading.Event()
         
 
 
@@ -213,7 +377,29 @@ class SFGProcessTools:
             If true then allow data to be (e.g.) downconverted more than once (default False).
         """
 
-        if cosmic_kill_check:
+        for stage in ['cosmic', 'downconvert', 'calibrate', 'exposure', 'subtract', 'normalise']:
+            self.process_stage(datastore, stage, downconvert_check, subtract_check, normalise_check,
+                               exposure_check, calibrate_check, cosmic_kill_check, force)
+
+        return
+
+    def process_stage(self, datastore, stage, downconvert_check, subtract_check, normalise_check,
+                      exposure_check, calibrate_check, cosmic_kill_check, force=False):
+        """Do one stage of the processing in process_data() on datastore.
+
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            Contains the data to be processed.
+        stage : str
+            The stage to do. Possible values "cosmic", "downconvert", "calibrate", "exposure", "subtract"
+            (which includes the reference background), "normalise".
+        downconvert_check, subtract_check, normalise_check, exposure_check, calibrate_check, cosmic_kill_check : bool
+            As for process_data().
+        force : bool, optional.
+            If true then allow data to be (e.g.) downconverted more than once (default False).
+        """
+        if stage == 'cosmic' and cosmic_kill_check:
             datastore.remove_cosmic_rays(self.cosmic_threshold, self.cosmic_max_width, 'sig')
             if subtract_check:
                 datastore.remove_cosmic_rays(self.cosmic_threshold, self.cosmic_max_width, 'bg')
@@ -222,28 +408,159 @@ class SFGProcessTools:
             if normalise_check and subtract_check:
                 datastore.remove_cosmic_rays(self.cosmic_threshold, self.cosmic_max_width, 'refbg')
 
-        if downconvert_check:
+        if stage == 'downconvert' and downconvert_check:
             upconverter = self.nm_to_cm(self.upconversion_line)
             datastore.downconvert_spectrum(upconverter, force)
 
-        if calibrate_check:
+        if stage == 'calibrate' and calibrate_check:
             datastore.calibrate_spectrum(np.float32(self.calibration_offset), force)
 
-        if exposure_check:
+        if stage == 'exposure' and exposure_check:
             datastore.divide_exposure(force)
 
-        if subtract_check:
+        if stage == 'subtract' and subtract_check:
             datastore.background_subtract(force)
 
-        if subtract_check and normalise_check:
+        if stage == 'subtract' and subtract_check and normalise_check:
             datastore.ref_background_subtract(force)
 
-        if normalise_check:
+        if stage == 'normalise' and normalise_check:
             datastore.normalise_data(force)
 
         return
 
-    def batch_process(self, datastores):
+    def stage_keys(self, directory, signal_name, bg_name, ref_name, ref_bg_name):
+        """Return a key for every stage of the processing of one signal file, used by incremental_process().
+
+        The processing forms two chains that both start from the files that are read: the intensities go
+        through "cosmic", "exposure", "subtract", and "normalise", and the energy axis goes through
+        "downconvert" and "calibrate". The key of each stage holds the options that stage uses and the key of
+        the stage before it, so a stage has to be redone exactly when its key changes.
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_name, bg_name, ref_name, ref_bg_name : str
+            Filenames of the signal file and its background, reference, and reference background. The ones
+            that aren't used with the current flags can be None.
+
+        Returns
+        ----------
+        keys : dict
+            Key of each stage, including "read".
+        """
+        def file_key(name):
+            return name, self.get_file_creationtime(directory + name)
+
+        keys = {}
+        keys['read'] = (directory, file_key(signal_name),
+                        file_key(bg_name) if self.subtract_check else None,
+                        file_key(ref_name) if self.normalise_check else None,
+                        file_key(ref_bg_name) if self.subtract_check and self.normalise_check else None,
+                        self.sum_accumulations, self.series_accumulations, self.accumulation_mode,
+                        self.accumulation_sigma, np.dtype(self.working_dtype).str)
+        keys['cosmic'] = (keys['read'], self.cosmic_kill_check,
+                          (self.cosmic_threshold, self.cosmic_max_width) if self.cosmic_kill_check else None)
+        keys['exposure'] = (keys['cosmic'], self.exposure_check)
+        keys['subtract'] = (keys['exposure'], self.subtract_check)
+        keys['normalise'] = (keys['subtract'], self.normalise_check)
+        keys['downconvert'] = (keys['read'], self.downconvert_check,
+                               self.upconversion_line if self.downconvert_check else None)
+        keys['calibrate'] = (keys['downconvert'], self.calibrate_check,
+                             tuple(np.ravel(self.calibration_offset)) if self.calibrate_check else None)
+        return keys
+
+    def incremental_process(self, directory, signal_names, bg_names, ref_names, ref_bg_names):
+        """Read and process a list of files like process_files(), but only redo the stages that have changed.
+
+        The result of every stage (see stage_keys()) of every file is kept in stage_cache, and a stage is only
+        redone when its key is different to last time. So if only the calibration is changed, only the
+        calibration of the energy axis is redone, and the files aren't read again. Files that are no longer in
+        signal_names are dropped from stage_cache. The results of each stage are kept by reference, so this
+        costs little extra memory, but it can't be used with lean_memory, which overwrites them.
+
+        The file lists are in the same format as for populate_data_stores().
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_names : list
+            Contains filenames of the signal data files to be processed.
+        bg_names : list
+            Contains filenames of the background data files of the signal data files to be processed.
+        ref_names : list
+            Contains filenames of the reference data files to be processed.
+        ref_bg_names : list
+            Contains filenames of the background data files of the reference data files to be processed.
+
+        Returns
+        ----------
+        datastores : list
+            Contains the processed SFGDataStore objects, one per signal file, in the same order.
+        """
+        chains = {'intensity': (['cosmic', 'exposure', 'subtract', 'normalise'],
+                                ['signal_raw', 'background', 'ref_raw', 'ref_bg', 'signal_subtracted',
+                                 'ref_subtracted', 'signal_normalised', 'background_subtracted',
+                                 'refbackground_subtracted', 'normalised', 'exp_divided_sig', 'exp_divided_bg',
+                                 'exp_divided_ref', 'exp_divided_refbg', 'cosmic_sig', 'cosmic_bg', 'cosmic_ref',
+                                 'cosmic_refbg']),
+                  'axis': (['downconvert', 'calibrate'],
+                           ['xaxis', 'xaxis_raw', 'xaxis_uncalibrated', 'upconverter_used', 'applied_calibration',
+                            'downconverted', 'calibrated'])}
+        checks = (self.downconvert_check, self.subtract_check, self.normalise_check, self.exposure_check,
+                  self.calibrate_check, self.cosmic_kill_check)
+
+        stage_cache = {}
+        datastores = []
+        redone = 0
+        for i, name in enumerate(signal_names):
+            keys = self.stage_keys(directory, name,
+                                   bg_names[i] if self.subtract_check else None,
+                                   ref_names[i] if self.normalise_check else None,
+                                   ref_bg_names[i] if self.subtract_check and self.normalise_check else None)
+            cached = self.stage_cache.get((directory, name))
+
+            if cached is None or cached[1]['read'] != keys['read']:
+                datastore = self.create_data_stores(1)[0]
+                datastore.verbose = self.verbose
+                datastore.stupidly_verbose = self.stupidly_verbose
+                self.populate_data_stores([datastore], directory, signal_names[i:i + 1], bg_names[i:i + 1],
+                                          ref_names[i:i + 1], ref_bg_names[i:i + 1])
+                snapshots = {}
+                for chain, attributes in chains.values():
+                    snapshots[chain[0] + '_input'] = {a: getattr(datastore, a) for a in attributes}
+                cached = (datastore, {'read': keys['read']}, snapshots)
+            datastore, old_keys, snapshots = cached
+
+            for chain, attributes in chains.values():
+                # JDP find the last stage of the chain that is still valid, and redo everything after it
+                start = 0
+                while start < len(chain) and old_keys.get(chain[start]) == keys[chain[start]]:
+                    start = start + 1
+                restore = snapshots[chain[start - 1]] if start > 0 else snapshots[chain[0] + '_input']
+                for attribute, value in restore.items():
+                    setattr(datastore, attribute, value)
+                for stage in chain[start:]:
+                    self.process_stage(datastore, stage, *checks, self.global_force)
+                    snapshots[stage] = {a: getattr(datastore, a) for a in attributes}
+                    old_keys[stage] = keys[stage]
+                    redone = redone + 1
+
+            stage_cache[(directory, name)] = (datastore, old_keys, snapshots)
+            datastores.append(datastore)
+            if self.file_done(datastore, i, len(signal_names)):
+                # JDP keep the stages of the files that weren't reached for next time
+                stage_cache = {**self.stage_cache, **stage_cache}
+                break
+
+        self.stage_cache = stage_cache
+        if self.verbose:
+            print('Redid', redone, 'processing stages for', len(datastores), 'files.')
+        return datastores
+
+    def batch_process(self, datastores, plot=True):
         """Process all data in the instances contained in datastores.
 
         Assumes you have a list of populated SFGDataStore objects to process (one per file).
@@ -255,23 +572,67 @@ class SFGProcessTools:
         -----------
         datastores : list
             Contains SFGDataStore objects, one per file to be processed.
+        plot : bool, optional
+            If False then nothing is plotted, even if plot_data_check is set. Default True.
+
+        Returns
+        ----------
+        datastores : list
+            The SFGDataStore objects that were processed. All of them, unless cancel_event was set.
         """
 
         num_files = len(datastores)
         if self.verbose:
             print('Processing ' + f'{num_files:d}' + ' files.')
-        for i, datastore in enumerate(datastores):
-            if self.verbose:
-                print('Processing file ' + f'{i + 1:d}' + '/' + f'{num_files:d}')
-            self.process_data(datastore, self.downconvert_check, self.subtract_check, self.normalise_check,
-                              self.exposure_check, self.calibrate_check, self.cosmic_kill_check,
-                              self.global_force)
-            if self.write_file_check:
-                self.write_data_to_file(datastore, self.write_directory)
-            if self.plot_data_check:
-                self.current_figure = self.plot_data(datastore, i, num_files, self.current_figure)
+        with self.create_writer() as writer:
+            for i, datastore in enumerate(datastores):
+                if self.verbose:
+                    print('Processing file ' + f'{i + 1:d}' + '/' + f'{num_files:d}')
+                self.process_data(datastore, self.downconvert_check, self.subtract_check, self.normalise_check,
+                                  self.exposure_check, self.calibrate_check, self.cosmic_kill_check,
+                                  self.global_force)
+                if self.write_file_check:
+                    writer.put(datastore)
+                if plot and self.plot_data_check:
+                    self.current_figure = self.plot_data(datastore, i, num_files, self.current_figure)
+                if self.file_done(datastore, i, num_files):
+                    datastores = datastores[:i + 1]
+                    break
+        return datastores
 
-        return
+    def create_writer(self):
+        """Return an SFGFileWriter that writes datastores to write_directory, set up by the class attributes.
+
+        If async_write_check is set the writer works on a background thread, so that files are written while
+        the next ones are processed, otherwise each file is written as soon as it is given to the writer.
+        """
+        writer = SFGFileWriter(self, self.write_directory, self.write_queue_size if self.async_write_check else 0)
+        return writer
+
+    def file_done(self, datastore, index, num_files):
+        """Report that a file has been processed, and return True if processing has been cancelled.
+
+        Calls progress_callback, if it is set. Every loop over files in pull_trigger() calls this after each
+        file and stops if it returns True, so setting cancel_event stops processing between files, with the
+        files processed so far still written.
+
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            The processed file.
+        index : int
+            Index of the file in the batch.
+        num_files : int
+            Total number of files in the batch.
+
+        Returns
+        ----------
+        cancelled : bool
+            True if cancel_event is set.
+        """
+        if self.progress_callback is not None:
+            self.progress_callback(index, num_files, datastore)
+        return self.cancel_event.is_set()
 
     def plot_data(self, datastore, iteration, num_files, figure):
         """Plot processed SFG data from datastore to figure.
@@ -281,7 +642,9 @@ class SFGProcessTools:
         then it will constrain the x axis to that region and rescale y, otherwise full range is plotted.
 
         Class attributes are used to determine other parameters that are mostly set by the GUI or plotting
-        script.
+        script. If fast_plot_check is set then all the rows of the file are drawn as one LineCollection,
+        decimated with decimate_minmax(), and the layout and drawing are only done after the last file, rather
+        than once per file, which makes plotting large or stacked batches much faster.
 
         Parameters
         -----------
@@ -302,6 +665,78 @@ class SFGProcessTools:
         if self.close_plots_check:
             plt.close('all')
 
+        signal, titleflag, leftwindow, rightwindow, mask = self.plot_selection(datastore)
+
+        if iteration == 0:
+            figure = plt.figure()
+
+        elif not self.stack_plots_check:
+            figure = plt.figure()
+
+        ax = figure.gca()
+
+        if self.fast_plot_check:
+            xaxis, rows = self.decimate_minmax(datastore.xaxis[mask], signal[:, mask], self.plot_max_points)
+            # JDP carry on round the colour cycle from the rows already on the axes, like ax.plot does
+            colours = plt.rcParams['axes.prop_cycle'].by_key()['color']
+            start = sum([len(collection.get_paths()) for collection in ax.collections])
+            ax.add_collection(mcollections.LineCollection(np.stack((xaxis, rows), axis=-1),
+                                                          colors=[colours[(start + i) % len(colours)]
+                                                                  for i in range(len(rows))]))
+        else:
+            for i in range(datastore.frameheight):
+                ax.plot(datastore.xaxis[mask], signal[int(i), mask])
+
+        ax.set_ylabel(r'SFG Intensity [a. u.]')
+        ax.set_xlabel(r'Wavenumber [cm$^{-1}$]')
+
+        title = pathlib.Path(datastore.filename_sig).name.replace('.spe', '')
+        ax.set_title(str(title)+'\n'+titleflag)
+        ax.set_xlim(leftwindow, rightwindow)
+        if self.fast_plot_check:
+            ax.autoscale_view(scalex=False)
+            if iteration == num_files-1:
+                for number in plt.get_fignums():
+                    plt.figure(number).tight_layout()
+                plt.show()
+            return figure
+
+        plt.tight_layout()
+        ax.autoscale(axis='y')
+
+        if self.stack_plots_check:
+            if iteration == num_files-1:
+                plt.show()
+        else:
+            plt.show()
+
+        return figure
+
+    def plot_selection(self, datastore):
+        """Choose what to plot from datastore, for plot_data() and write_preview().
+
+        The normalised and subtracted data are plotted if present, otherwise the subtracted data, otherwise
+        the raw data. The x axis window is custom_region_start to custom_region_end if they are set,
+        otherwise the full energy axis.
+
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            Contains data to be plotted.
+
+        Returns
+        ----------
+        signal : np array
+            Data to be plotted, one spectrum per row.
+        titleflag : str
+            Describes which data signal is, for the plot title.
+        leftwindow : float
+            Lower limit of the x axis.
+        rightwindow : float
+            Upper limit of the x axis.
+        mask : np array
+            True for the points of the energy axis inside the x axis limits.
+        """
         if datastore.normalised:
             signal = datastore.signal_normalised
             titleflag = '(normalised and subtracted)'
@@ -323,48 +758,148 @@ class SFGProcessTools:
             rightwindow = datastore.xaxis[0]
 
         mask = (datastore.xaxis >= leftwindow) & (datastore.xaxis <= rightwindow)
+        return signal, titleflag, leftwindow, rightwindow, mask
 
-        if iteration == 0:
-            figure = plt.figure()
+    def get_preview_template(self):
+        """Return the figure that write_preview() draws on, creating it the first time.
 
-        elif not self.stack_plots_check:
-            figure = plt.figure()
+        The figure is made directly with the Agg canvas rather than through pyplot, so it needs no display,
+        is never shown, and can be used in worker processes and threads. It is created once per process with
+        an empty LineCollection and its labels and layout, and only the lines, limits and title are changed
+        for each file.
 
-        ax = figure.gca()
+        Returns
+        ----------
+        template : tuple
+            The figure, its axes, and its LineCollection.
+        """
+        if self.preview_template is None:
+            figure = mfigure.Figure(figsize=self.preview_size, dpi=self.preview_dpi)
+            backend_agg.FigureCanvasAgg(figure)
+            ax = figure.add_subplot()
+            lines = mcollections.LineCollection([], linewidths=0.8)
+            ax.add_collection(lines)
+            ax.set_ylabel(r'SFG Intensity [a. u.]')
+            ax.set_xlabel(r'Wavenumber [cm$^{-1}$]')
+            ax.set_title('title\n(flag)')
+            figure.tight_layout()
+            self.preview_template = (figure, ax, lines)
+        return self.preview_template
+
+    def write_preview(self, datastore, directory):
+        """Draw the data in datastore, as plot_data() would, to a PNG image in directory.
+
+        The image is drawn offscreen on the figure from get_preview_template(), with every row decimated
+        to twice the width of the image in pixels by decimate_minmax(), and is preview_size inches at
+        preview_dpi.
 
-        for i in range(datastore.frameheight):
-            ax.plot(datastore.xaxis[mask], signal[int(i), mask])
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            Contains data to be plotted.
+        directory : str
+            Where the resulting .png file is to be saved.
+        """
+        figure, ax, lines = self.get_preview_template()
+        signal, titleflag, leftwindow, rightwindow, mask = self.plot_selection(datastore)
 
-        ax.set_ylabel(r'SFG Intensity [a. u.]')
-        ax.set_xlabel(r'Wavenumber [cm$^{-1}$]')
+        max_points = min(self.plot_max_points, int(2 * self.preview_size[0] * self.preview_dpi))
+        xaxis, rows = self.decimate_minmax(datastore.xaxis[mask], signal[:, mask], max_points)
+        colours = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+        lines.set_segments(np.stack((xaxis, rows), axis=-1))
+        lines.set_colors([colours[i % len(colours)] for i in range(len(rows))])
 
-        title = pathlib.Path(datastore.filename_sig).name.replace('.spe', '')
-        ax.set_title(str(title)+'\n'+titleflag)
         ax.set_xlim(leftwindow, rightwindow)
-        plt.tight_layout()
-        ax.autoscale(axis='y')
+        finite = rows[np.isfinite(rows)]
+        if finite.size > 0:
+            bottom, top = np.min(finite), np.max(finite)
+            margin = 0.05 * (top - bottom) if top > bottom else 1
+            ax.set_ylim(bottom - margin, top + margin)
+        ax.set_title(pathlib.Path(datastore.filename_sig).name.replace('.spe', '') + '\n' + titleflag)
 
-        if self.stack_plots_check:
-            if iteration == num_files-1:
-                plt.show()
+        title = pathlib.Path(datastore.filename_sig).stem
+        figure.savefig(os.path.join(directory, title + "_preview.png"))
+        return
+
+    def write_previews(self, datastores, directory):
+        """Write a PNG preview of every datastore in datastores to directory with write_preview().
+
+        The previews are drawn by num_workers processes, each of which reuses its own figure template, so
+        thousands of previews can be made without a display.
+
+        Parameters
+        -----------
+        datastores : list
+            Contains processed SFGDataStore objects.
+        directory : str
+            Where the resulting .png files are to be saved.
+        """
+        if self.num_workers > 1 and len(datastores) > 1:
+            chunksize = max(1, int(np.ceil(len(datastores) / (4 * self.num_workers))))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                for _ in executor.map(self.write_preview, datastores, itertools.repeat(directory),
+                                      chunksize=chunksize):
+                    pass
         else:
-            plt.show()
+            for datastore in datastores:
+                self.write_preview(datastore, directory)
+        return
 
-        return figure
+    @staticmethod
+    def decimate_minmax(xaxis, data, max_points):
+        """Reduce spectra to at most max_points points each for plotting, keeping every peak and dip.
 
-    def write_data_to_file(self, datastore, directory):
-        """Write data in datastore to a text file in directory.
+        The points are split into max_points/2 bins and only the lowest and highest point of each bin are
+        kept, in their original order, so the decimated line covers exactly the same range as the full one
+        at any zoom where a bin is narrower than a pixel.
+
+        Parameters
+        -----------
+        xaxis : np array
+            1D energy axis, of length N.
+        data : np array
+            2D array of spectra, one per row, each of length N.
+        max_points : int
+            Maximum number of points to keep per row.
 
-        Data is written into a text file as columns with a 12 line header explaining what the data is and
-        how it has been processed. Nine columns are written with different types of data, but column 0 and
-        1 are the ones that contain the useful data in most cases.
+        Returns
+        ----------
+        xaxis_out : np array
+            2D array of the energy axis of each kept point, one row per spectrum.
+        data_out : np array
+            2D array of the kept points of each spectrum.
+        """
+        numrows, numpoints = np.shape(data)
+        numbins = max(max_points // 2, 1)
+        if numpoints <= max_points:
+            return np.broadcast_to(xaxis, (numrows, numpoints)), data
+
+        # JDP pad the last bin by repeating the last point, which can't change its minimum or maximum
+        binsize = -(-numpoints // numbins)
+        padded = np.pad(data, ((0, 0), (0, numbins * binsize - numpoints)), mode='edge')
+        padded = padded.reshape(numrows, numbins, binsize)
+        offsets = np.arange(numbins) * binsize
+        lowest = np.argmin(padded, axis=2) + offsets
+        highest = np.argmax(padded, axis=2) + offsets
+        index = np.stack((np.minimum(lowest, highest), np.maximum(lowest, highest)), axis=2)
+        index = np.minimum(index.reshape(numrows, 2 * numbins), numpoints - 1)
+        return xaxis[index], np.take_along_axis(data, index, axis=1)
+
+    def make_header(self, datastore):
+        """Return the description of where the data in datastore came from and how it has been processed.
+
+        Used as the header of the text files written by write_data_to_file(), and stored as the provenance
+        of the binary files.
 
         Parameters
         -----------
         datastore : SFGDataStore object
-            Where the data to be written is stored.
-        directory : str
-            Where the resulting .txt file is to be saved.
+            Where the data to be described is stored.
+
+        Returns
+        -----------
+        headstring : str
+            The description, one item per line.
         """
         headstring = " Signal Data File: " + datastore.filename_sig + \
                      "\n Background Data File: " + datastore.filename_bg + \
@@ -389,7 +924,7 @@ class SFGProcessTools:
 
         if datastore.calibrated:
             headstring = headstring + "\n Calibrated? YES. Calibration Coefficients: " \
-                         + f'{np.array2string( datastore.calibration_offset, sep="," )}'
+                         + f'{np.array2string(datastore.applied_calibration, separator=",")}'
         else:
             headstring = headstring + "\n Calibrated? NO"
 
@@ -417,44 +952,305 @@ class SFGProcessTools:
         else:
             headstring = headstring + "\n Exposure Corrected for Reference Background? NO"
 
-        headstring = headstring + "\n 0: Energy Axis, 1: Signal Normalised, 2: Reference, " \
-                                  "3: Signal Pre-Normalise, " \
-                                  "4: Signal Pre-Subtract, 5: Background, 6:Reference Pre-Subtract, " \
-                                  "7: Energy Axis Raw"
+        return headstring
+
+    def write_data_to_file(self, datastore, directory):
+        """Write data in datastore to a file in directory in each of the formats in write_formats.
+
+        For "txt" data is written into a text file as columns with a 12 line header explaining what the data
+        is and how it has been processed. Nine columns are written with different types of data, but column 0
+        and 1 are the ones that contain the useful data in most cases. Only the first row of each array is
+        written. For "npz" and "hdf5" the full arrays are written with write_data_to_npz() and
+        write_data_to_hdf5(), and for "png" a preview image is drawn with write_preview().
+
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            Where the data to be written is stored.
+        directory : str
+            Where the resulting files are to be saved.
+        """
+        if 'npz' in self.write_formats:
+            self.write_data_to_npz(datastore, directory)
+        if 'hdf5' in self.write_formats:
+            self.write_data_to_hdf5(datastore, directory)
+        if 'png' in self.write_formats:
+            self.write_preview(datastore, directory)
+        if 'txt' not in self.write_formats:
+            return
+
+        headstring = self.make_header(datastore) + self.text_columns
 
         modelarray = np.empty((1, datastore.framewidth))
         modelarray_xaxis = np.empty((datastore.framewidth))
 
         # JDP  - this is to just print a column of NaNs if you havent done part of the processing. Theres
-        # probably a less clunky way to do this but whatever.
-        if datastore.xaxis is None:
-            datastore.xaxis = np.full_like(modelarray_xaxis, fill_value=np.nan)
-        if datastore.xaxis_raw is None:
-            datastore.xaxis_raw = np.full_like(modelarray_xaxis, fill_value=np.nan)
-        if datastore.signal_normalised is None:
-            datastore.signal_normalised = np.full_like(modelarray, fill_value=np.nan)
-        if datastore.ref_subtracted is None:
-            datastore.ref_subtracted = np.full_like(modelarray, fill_value=np.nan)
-        if datastore.signal_subtracted is None:
-            datastore.signal_subtracted = np.full_like(modelarray, fill_value=np.nan)
-        if datastore.signal_normalised is None:
-            datastore.signal_normalised = np.full_like(modelarray, fill_value=np.nan)
-        if datastore.signal_raw is None:
-            datastore.signal_raw = np.full_like(modelarray, fill_value=np.nan)
-        if datastore.background is None:
-            datastore.background = np.full_like(modelarray, fill_value=np.nan)
-        if datastore.ref_raw is None:
-            datastore.ref_raw = np.full_like(modelarray, fill_value=np.nan)
-
-        data_arrays = np.array([datastore.xaxis, datastore.signal_normalised[0], datastore.ref_subtracted[0],
-                                datastore.signal_subtracted[0], datastore.signal_raw[0], datastore.background[0],
-                                datastore.ref_raw[0], datastore.ref_subtracted[0], datastore.xaxis_raw])
+        # probably a less clunky way to do this but whatever. The datastore itself is left alone, so it can be
+        # written on another thread while it is being plotted.
+        def column(array, model):
+            if array is None:
+                return np.full_like(model, fill_value=np.nan)
+            return array
+
+        xaxis = column(datastore.xaxis, modelarray_xaxis)
+        xaxis_raw = column(datastore.xaxis_raw, modelarray_xaxis)
+        signal_normalised = column(datastore.signal_normalised, modelarray)
+        ref_subtracted = column(datastore.ref_subtracted, modelarray)
+        signal_subtracted = column(datastore.signal_subtracted, modelarray)
+        signal_raw = column(datastore.signal_raw, modelarray)
+        background = column(datastore.background, modelarray)
+        ref_raw = column(datastore.ref_raw, modelarray)
+
+        data_arrays = np.array([xaxis, signal_normalised[0], ref_subtracted[0], signal_subtracted[0], signal_raw[0],
+                                background[0], ref_raw[0], ref_subtracted[0], xaxis_raw])
+
+        title = pathlib.Path(datastore.filename_sig).stem
+
+        self.write_text_file(directory + "/" + title + "_processed.txt", data_arrays.T, headstring)
+
+        return
+
+    def write_text_file(self, fname, data, headstring):
+        """Write data to a text file exactly as np.savetxt(fname, data, header=headstring, fmt='%-10.5f') would.
+
+        np.savetxt formats the file one row at a time in Python. Here the format string for the whole file is
+        built once and kept in text_templates for the next file of the same size (normally the whole batch),
+        and every value is formatted in one go by a single % operation, which is noticeably faster. The
+        output is byte-for-byte the same.
+
+        Parameters
+        -----------
+        fname : str
+            Path of the text file.
+        data : np array
+            2D array to write, one row per line.
+        headstring : str
+            Header, written with "# " at the start of each line.
+        """
+        numrows, numcols = np.shape(data)
+        template = self.text_templates.get((numrows, numcols))
+        if template is None:
+            template = (' '.join(['%-10.5f'] * numcols) + '\n') * numrows
+            self.text_templates[(numrows, numcols)] = template
+
+        with open(fname, 'wt') as textfile:
+            textfile.write('# ' + headstring.replace('\n', '\n# ') + '\n')
+            textfile.write(template % tuple(np.ravel(data).tolist()))
+        return
+
+    def write_batch_file(self, datastores):
+        """Add the data in datastores to batch_filename in write_directory, if "hdf5_batch" is in write_formats.
+
+        Called once per batch by pull_trigger(), after all the files are processed, so that parallel workers
+        never write to the same file. See write_batch_to_hdf5().
+
+        Parameters
+        -----------
+        datastores : list
+            Contains the processed SFGDataStore objects.
+        """
+        if self.write_file_check and 'hdf5_batch' in self.write_formats:
+            self.write_batch_to_hdf5(datastores, os.path.join(self.write_directory, self.batch_filename))
+        return
+
+    @staticmethod
+    def batch_metadata_dtype():
+        """Return the numpy structured datatype of the "metadata" table in the files from write_batch_to_hdf5().
+
+        filename (the absolute path of the signal file) and sample are variable length UTF-8 strings, so they are
+        never truncated. Missing numbers are -1 (or NaN for floats). Needs h5py.
+        """
+        batch_metadata_dtype = np.dtype([('filename', h5py.string_dtype()), ('sample', h5py.string_dtype()),
+                                         ('group', np.int64),
+                                         ('index', np.int64), ('wavelength', np.int64), ('polarisation', 'S3'),
+                                         ('acqtime', np.float64), ('upconverter_used', np.float64),
+                                         ('downconverted', np.bool_), ('calibrated', np.bool_),
+                                         ('background_subtracted', np.bool_), ('refbackground_subtracted', np.bool_),
+                                         ('normalised', np.bool_), ('exp_divided_sig', np.bool_),
+                                         ('cosmic_sig', np.bool_)])
+        return batch_metadata_dtype
+
+    def write_batch_to_hdf5(self, datastores, fname):
+        """Add the data in datastores to a single HDF5 file holding a whole batch (or campaign) of spectra.
+
+        Each array of output_arrays() is stored as one chunked, gzip compressed dataset with a row per signal
+        file, e.g. "signal_normalised" has shape (numfiles, frameheight, framewidth), so a whole campaign can be
+        sliced with one open. Rows that a file doesn't have are NaN. The "metadata" dataset is a table (see
+        batch_metadata_dtype()) of the filename info from parse_filename() and the processing flags, and
+        "provenance" holds the text file header of each row.
+
+        The file is created if it doesn't exist. Files already in it (by the absolute path of the signal file)
+        are overwritten, new ones are appended. A file with no data, or whose arrays are a different shape to
+        those already stored, is skipped with a message and gets no row. Needs h5py.
+
+        Parameters
+        -----------
+        datastores : list
+            Contains the processed SFGDataStore objects.
+        fname : str
+            Path of the HDF5 file.
+        """
+        if h5py is None:
+            print('h5py is not installed, so HDF5 files cannot be written. Install it with "pip install h5py".')
+            return
+        if not datastores:
+            return
+
+        with h5py.File(fname, 'a') as h5file:
+            if 'metadata' in h5file:
+                existing = [name.decode() if isinstance(name, bytes) else name
+                            for name in h5file['metadata']['filename']]
+            else:
+                existing = []
+                h5file.create_dataset('metadata', shape=(0,), maxshape=(None,), dtype=self.batch_metadata_dtype(),
+                                      chunks=True)
+                h5file.create_dataset('provenance', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                                      chunks=True)
+
+            # JDP check every file against the shapes already stored before giving it a row, so that skipped
+            # JDP files don't leave rows of NaN behind
+            shapes = {name: h5file[name].shape[1:] for name in h5file if name not in ['metadata', 'provenance']}
+            accepted = []
+            for datastore in datastores:
+                arrays = self.output_arrays(datastore)[0]
+                if datastore.filename_sig is None or not arrays:
+                    print('No data in', datastore.filename_sig, 'so it was not written to', fname)
+                    continue
+                mismatched = [name for name, value in arrays.items()
+                              if name in shapes and shapes[name] != np.shape(value)]
+                if mismatched:
+                    print('The shape of', mismatched, 'in', datastore.filename_sig, 'does not match the batch file,',
+                          'so it was not written to', fname)
+                    continue
+                for name, value in arrays.items():
+                    shapes.setdefault(name, np.shape(value))
+                accepted.append((os.path.abspath(datastore.filename_sig), datastore, arrays))
+
+            rows = {os.path.abspath(name): i for i, name in enumerate(existing)}
+            for filename, datastore, arrays in accepted:
+                if filename not in rows:
+                    rows[filename] = len(rows)
+            numrows = len(rows)
+
+            for filename, datastore, arrays in accepted:
+                for name, value in arrays.items():
+                    if name not in h5file:
+                        # JDP aim for chunks of about 64 kB, a whole number of rows each
+                        rowsize = max(1, int(np.prod(np.shape(value))))
+                        chunkrows = max(1, 16384 // rowsize)
+                        h5file.create_dataset(name, shape=(numrows,) + np.shape(value),
+                                              maxshape=(None,) + np.shape(value), dtype=value.dtype,
+                                              chunks=(chunkrows,) + np.shape(value), compression='gzip',
+                                              fillvalue=np.nan)
+            for name in h5file:
+                if h5file[name].shape[0] < numrows:
+                    h5file[name].resize(numrows, axis=0)
+
+            for filename, datastore, arrays in accepted:
+                row = rows[filename]
+                for name, value in arrays.items():
+                    h5file[name][row] = value
+
+                h5file['metadata'][row] = np.array((
+                    filename, str(datastore.sample or ''),
+                    -1 if datastore.group is None else datastore.group,
+                    -1 if datastore.index is None else datastore.index,
+                    -1 if datastore.wavelength is None else datastore.wavelength,
+                    str(datastore.polarisation or '').encode(),
+                    np.nan if datastore.acqtime is None else datastore.acqtime,
+                    np.nan if datastore.upconverter_used is None else datastore.upconverter_used,
+                    datastore.downconverted, datastore.calibrated, datastore.background_subtracted,
+                    datastore.refbackground_subtracted, datastore.normalised, datastore.exp_divided_sig,
+                    datastore.cosmic_sig), dtype=self.batch_metadata_dtype())
+                h5file['provenance'][row] = self.make_header(datastore)
+
+        if self.verbose:
+            print('Wrote', len(accepted), 'files to', fname)
+        return
+
+    @staticmethod
+    def output_arrays(datastore):
+        """Return the arrays and metadata of datastore that are written to the binary output formats.
+
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            Where the data to be written is stored.
+
+        Returns
+        -----------
+        arrays : dict
+            The full arrays of datastore that exist, by attribute name.
+        metadata : dict
+            Filenames, exposure times, and processing flags of datastore that exist, by attribute name.
+        """
+        arrays = {}
+        for attribute in ['xaxis', 'xaxis_raw', 'signal_raw', 'background', 'ref_raw', 'ref_bg', 'signal_subtracted',
+                          'ref_subtracted', 'signal_normalised', 'timestamps', 'applied_calibration']:
+            value = getattr(datastore, attribute)
+            if value is not None:
+                arrays[attribute] = np.asarray(value)
+
+        metadata = {}
+        for attribute in ['filename_sig', 'filename_bg', 'filename_ref', 'filename_refbg', 'sample', 'group', 'index',
+                          'wavelength', 'polarisation', 'acqtime', 'acqtime_bg', 'acqtime_ref', 'acqtime_refbg',
+                          'upconverter_used', 'numframes', 'calibrated', 'downconverted', 'background_subtracted',
+                          'refbackground_subtracted', 'normalised', 'exp_divided_sig', 'exp_divided_bg',
+                          'exp_divided_ref', 'exp_divided_refbg', 'cosmic_sig', 'cosmic_bg', 'cosmic_ref',
+                          'cosmic_refbg']:
+            value = getattr(datastore, attribute)
+            if value is not None:
+                metadata[attribute] = value
+        return arrays, metadata
+
+    def write_data_to_npz(self, datastore, directory):
+        """Write data in datastore to an uncompressed .npz file in directory.
+
+        Unlike the text file, every array is written in full, e.g. (frameheight, framewidth) or a series, and
+        is read back with np.load() without any parsing. The text file header is stored as "provenance",
+        and the metadata from output_arrays() as 0-d arrays under their attribute names.
+
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            Where the data to be written is stored.
+        directory : str
+            Where the resulting .npz file is to be saved.
+        """
+        arrays, metadata = self.output_arrays(datastore)
+        for attribute, value in metadata.items():
+            arrays[attribute] = np.asarray(value)
+        arrays['provenance'] = np.asarray(self.make_header(datastore))
 
         title = pathlib.Path(datastore.filename_sig).stem
+        np.savez(os.path.join(directory, title + "_processed.npz"), **arrays)
+        return
+
+    def write_data_to_hdf5(self, datastore, directory):
+        """Write data in datastore to an HDF5 file in directory.
 
-        np.savetxt(directory + "/" + title + "_processed.txt", data_arrays.T, header=headstring,
-                   fmt='%-10.5f')
+        Every array is written in full as a dataset, with the text file header as the "provenance" attribute
+        of the file and the metadata from output_arrays() as the other attributes. Needs h5py.
 
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            Where the data to be written is stored.
+        directory : str
+            Where the resulting .h5 file is to be saved.
+        """
+        if h5py is None:
+            print('h5py is not installed, so HDF5 files cannot be written. Install it with "pip install h5py".')
+            return
+
+        arrays, metadata = self.output_arrays(datastore)
+        title = pathlib.Path(datastore.filename_sig).stem
+        with h5py.File(os.path.join(directory, title + "_processed.h5"), 'w') as h5file:
+            h5file.attrs['provenance'] = self.make_header(datastore)
+            for attribute, value in metadata.items():
+                h5file.attrs[attribute] = value
+            for attribute, value in arrays.items():
+                h5file.create_dataset(attribute, data=value)
         return
 
     def create_data_stores(self, num_files):
@@ -477,6 +1273,9 @@ class SFGProcessTools:
             
         
         datastores = [SFGDataStore() for _ in range(num_files)]
+        self.set_attr_list(datastores, 'dtype', self.working_dtype)
+        self.set_attr_list(datastores, 'lean', self.lean_memory)
+        self.set_attr_list(datastores, 'keep_intermediates', list(self.keep_intermediates))
 
         return datastores
 
@@ -491,6 +1290,9 @@ class SFGProcessTools:
         can be sorted manually in the command line, but the match_files method does it automatically for
         the GUI.
 
+        Reference, reference background, and background files are normally shared by many signal files,
+        so they are read through read_files_cached() and each is only read once per batch.
+
         Parameters
         -----------
         datastores : list
@@ -517,21 +1319,21 @@ class SFGProcessTools:
 
             if self.normalise_check:
                 if ref_names:
-                    self.read_files(directory + ref_names[i], datastore, 'ref')
+                    self.read_files_cached(directory + ref_names[i], datastore, 'ref')
                 else:
                     print('No reference filenames loaded, even though normalise is ticked. Check input. Exiting...')
                     return
                     
                 if self.subtract_check:
                     if ref_bg_names:
-                        self.read_files(directory + ref_bg_names[i], datastore, 'refbg')
+                        self.read_files_cached(directory + ref_bg_names[i], datastore, 'refbg')
                     else:
                         print('No reference background filenames loaded, even though normalise and subtracted ticked. Check input. Exiting...')
                         return
 
             if self.subtract_check:
                 if bg_names:
-                    self.read_files(directory + bg_names[i], datastore, 'bg')
+                    self.read_files_cached(directory + bg_names[i], datastore, 'bg')
                 else:
                     print('No background filenames loaded, even though subtract is ticked. Check input. Exiting...')
                     return
@@ -557,55 +1359,84 @@ class SFGProcessTools:
 
         """
 
-        if file.endswith(".spe"):
-            names_nospe = file.replace(".spe", "").split('_')
-       # elif file.endswith(".txt"):
-           # names_nospe = file.replace(".txt", "").split('_')
-        else:
+        if not file.endswith(".spe"):
             print("Non .spe file loaded, this is not yet supported. Exiting...")
             return
 
+        sample, group, index, wavelength, polarisation = self.parse_filename_tokens(file)
+
         # JDP checks if a sample string has been defined by the user, if not then reads from filename.
         if self.samplestring is not None:
             datastore.sample = self.samplestring
         else:
-            datastore.sample = names_nospe[0]
+            datastore.sample = sample
 
-        # JDP checks if the penultimate element is numeric, if it is then define this as the group
-        if len(names_nospe) >= 2 and names_nospe[-2].isnumeric():
-            datastore.group = int(names_nospe[-2])
+        if group is not None:
+            datastore.group = group
+        if index is not None:
+            datastore.index = index
+        if wavelength is not None:
+            datastore.wavelength = wavelength
+        if polarisation is not None:
+            datastore.polarisation = polarisation
 
-        # JDP checks if the final element is numeric, if it is then define this as the index
-        if len(names_nospe) > 1 and names_nospe[-1].isnumeric():
-            datastore.index = int(names_nospe[-1])
+        # JDP gets the time that the file was created
+        datastore.creationtime = self.get_file_creationtime(directory + file)
+
+        return
+
+    @staticmethod
+    def parse_filename_tokens(file):
+        """Split the name of an .spe file into the info that can be stored in it.
+
+        Used by parse_filename(), and also by scan_metadata() where no datastore is needed. Anything that
+        cannot be found in the filename is returned as None.
+
+        Parameters
+        -----------
+        file : str
+            The name of the file to be parsed.
+
+        Returns
+        -----------
+        sample : str
+            The first element of the filename.
+        group : int
+            The penultimate element of the filename, if numeric.
+        index : int
+            The final element of the filename, if numeric.
+        wavelength : int
+            Any element of the filename of the form <number>nm.
+        polarisation : str
+            Polarisation combination, e.g. "PPP" or "SSP".
+        """
+        names_nospe = pathlib.PurePath(file).name.replace(".spe", "").split('_')
+        sample = names_nospe[0]
+        group = None
+        index = None
+        wavelength = None
+        polarisation = None
+
+        # JDP checks if the penultimate element is numeric, if it is then define this as the group
+        if len(names_nospe) >= 2 and names_nospe[-2].isnumeric():
+            group = int(names_nospe[-2])
+
+        # JDP checks if the final element is numeric, if it is then define this as the index
+        if len(names_nospe) > 1 and names_nospe[-1].isnumeric():
+            index = int(names_nospe[-1])
 
         # JDP if there is something ending in "nm" then define this as the wavelength.
         for string in names_nospe:
             if string.endswith('nm') & string.replace('nm', '').isnumeric():
-                datastore.wavelength = int(string.replace('nm', ''))
+                wavelength = int(string.replace('nm', ''))
 
         # JDP set the polarisation according to what is in the name. If it is not, then defaults to None.
-        if 'PPP' in names_nospe:
-            datastore.polarisation = 'PPP'
-        elif 'SPP' in names_nospe:
-            datastore.polarisation = 'SPP'
-        elif 'PSP' in names_nospe:
-            datastore.polarisation = 'PSP'
-        elif 'PPS' in names_nospe:
-            datastore.polarisation = 'PPS'
-        elif 'SSP' in names_nospe:
-            datastore.polarisation = 'SSP'
-        elif 'SPS' in names_nospe:
-            datastore.polarisation = 'SPS'
-        elif 'PSS' in names_nospe:
-            datastore.polarisation = 'PSS'
-        elif 'SSS' in names_nospe:
-            datastore.polarisation = 'SSS'
-
-        # JDP gets the time that the file was created
-        datastore.creationtime = self.get_file_creationtime(directory + file)
+        for pol in ['PPP', 'SPP', 'PSP', 'PPS', 'SSP', 'SPS', 'PSS', 'SSS']:
+            if pol in names_nospe:
+                polarisation = pol
+                break
 
-        return
+        return sample, group, index, wavelength, polarisation
 
     def get_filenames_smart(self):
         """Globs all .spe files in the current data directory and sorts them into lists.
@@ -643,7 +1474,11 @@ class SFGProcessTools:
             Contains indexes for each unique reference file (later associated with a corresponding signal
             file).
         """
-        names = glob.glob(self.data_directory+'*.spe')
+        if self.metadata_index_check:
+            self.metadata_index = self.update_metadata_index(self.data_directory)
+            names = [os.path.join(self.data_directory, i) for i in self.metadata_index['filename']]
+        else:
+            names = glob.glob(self.data_directory+'*.spe')
 
         signal_names = [pathlib.PurePath(i).name for i in names if self.bg_string not in
                         pathlib.PurePath(i).name and pathlib.PurePath(i).name.startswith(self.samplestring)]
@@ -654,30 +1489,969 @@ class SFGProcessTools:
         ref_names = [pathlib.PurePath(i).name for i in names if self.bg_string not in i and
                      pathlib.PurePath(i).name.startswith(self.refstring)]
 
-        ref_bg_names = [pathlib.PurePath(i).name for i in names if self.bg_string in i and
-                        pathlib.PurePath(i).name.startswith(self.refstring)]
+        ref_bg_names = [pathlib.PurePath(i).name for i in names if self.bg_string in i and
+                        pathlib.PurePath(i).name.startswith(self.refstring)]
+
+        ref_id = [ref_names.index(i)+1 for i in ref_names]
+
+        return signal_names, bg_names, ref_names, ref_bg_names, ref_id
+
+    def read_metadata(self, fname):
+        """Read the metadata of a single .spe file without reading any of the pixel data.
+
+        For SPE 2.x files only the binary header is read. For SPE 3.0 files the binary header and the XML
+        footer are read. The filename is parsed with parse_filename_tokens(), with missing numbers given as -1
+        and missing strings as empty strings so the result fits in a structured array.
+
+        Parameters
+        -----------
+        fname : str
+            Path to the .spe file.
+
+        Returns
+        -----------
+        row : tuple
+            One row of the table returned by scan_metadata(), with fields as given by metadata_dtype().
+        """
+        path = pathlib.Path(fname)
+        stat = path.stat()
+        header = self.read_spe_header(fname)
+        spe_version = float(header['spe_version'])
+
+        if spe_version < 3.0:
+            framewidth = int(header['framewidth'])
+            frameheight = int(header['frameheight'])
+            numframes = int(header['numframes'])
+            pixeltype = str(header['pixeltype'])
+            acqtime = float(header['acqtime'])
+        else:
+            xmltree = self.read_spe3x_footer(fname, header['footer_offset'])
+            framewidth, frameheight, numframes, framestride, pixeltype, acqtime = self.decode_spe3x_footer(xmltree)
+            acqtime = float(acqtime)
+
+        sample, group, index, wavelength, polarisation = self.parse_filename_tokens(path.name)
+
+        row = (path.name, stat.st_mtime, stat.st_size, spe_version, framewidth, frameheight, numframes,
+               pixeltype, acqtime, sample, -1 if group is None else group, -1 if index is None else index,
+               -1 if wavelength is None else wavelength, '' if polarisation is None else polarisation)
+        return row
+
+    @staticmethod
+    def metadata_dtype(namelength=256):
+        """Return the numpy structured datatype of the table returned by scan_metadata().
+
+        Parameters
+        -----------
+        namelength : int, optional
+            Maximum number of characters stored for the filename and sample name. Default 256.
+
+        Returns
+        -----------
+        metadata_dtype : np.dtype
+            Structured datatype with one field per column of the table.
+        """
+        metadata_dtype = np.dtype([('filename', 'U' + str(namelength)), ('mtime', np.float64),
+                                   ('size', np.int64), ('spe_version', np.float32), ('framewidth', np.int32),
+                                   ('frameheight', np.int32), ('numframes', np.int32), ('pixeltype', 'U32'),
+                                   ('acqtime', np.float64), ('sample', 'U' + str(namelength)),
+                                   ('group', np.int64), ('index', np.int64), ('wavelength', np.int64),
+                                   ('polarisation', 'U3')])
+        return metadata_dtype
+
+    def scan_metadata(self, directory):
+        """Read the metadata of every .spe file in directory without reading any pixel data.
+
+        Much faster than reading the files, so is suitable for populating tables and checking that files have
+        consistent frame sizes before any processing is done. Files whose headers cannot be read are skipped
+        with a message.
+
+        Parameters
+        -----------
+        directory : str
+            Directory containing the .spe files.
+
+        Returns
+        -----------
+        metadata : np.ndarray
+            Structured array with one row per file, sorted by filename, with the fields given by
+            metadata_dtype(). Columns are accessed like metadata['filename'] or metadata['acqtime'].
+        """
+        names = sorted(glob.glob(os.path.join(directory, '*.spe')))
+        rows = []
+        for name in names:
+            try:
+                rows.append(self.read_metadata(name))
+            except (OSError, ValueError, IndexError, KeyError, AttributeError, etree.XMLSyntaxError):
+                print('Could not read the metadata of', name, ', skipping.')
+
+        namelength = max([max(len(row[0]), len(row[9])) for row in rows], default=1)
+        metadata = np.array(rows, dtype=self.metadata_dtype(namelength))
+
+        if self.verbose:
+            print('Read metadata of', len(metadata), 'files in', directory)
+
+        return metadata
+
+    @staticmethod
+    def get_index_filename(directory):
+        """Return the path of the SQLite metadata index used for directory.
+
+        The index is kept in the data directory itself if it is writable, so it follows the data around.
+        Otherwise it goes in a per-user cache directory, shared between all read-only data directories.
+
+        Parameters
+        -----------
+        directory : str
+            Data directory to be indexed.
+
+        Returns
+        -----------
+        indexfile : str
+            Path to the SQLite database file.
+        """
+        if os.access(directory, os.W_OK):
+            indexfile = os.path.join(directory, '.sfgtools_index.sqlite')
+        else:
+            cachedir = os.path.join(os.environ.get('LOCALAPPDATA', os.path.join(os.path.expanduser('~'), '.cache')),
+                                    'sfgtools')
+            os.makedirs(cachedir, exist_ok=True)
+            indexfile = os.path.join(cachedir, 'metadata_index.sqlite')
+        return indexfile
+
+    def update_metadata_index(self, directory):
+        """Bring the persistent metadata index for directory up to date and return its contents.
+
+        The index is an SQLite database (see get_index_filename()) holding one row per .spe file, keyed by the
+        absolute path and storing the file size and modification time alongside everything read_metadata()
+        returns. Only files that are new, or whose size or modification time have changed, are read again.
+        Files that no longer exist are dropped from the index. Directories that grow by a few files between
+        runs therefore only cost a directory listing and a few header reads.
+
+        Parameters
+        -----------
+        directory : str
+            Directory containing the .spe files.
+
+        Returns
+        -----------
+        metadata : np.ndarray
+            Structured array with one row per file, sorted by filename, in the same format as
+            scan_metadata().
+        """
+        # JDP column names are quoted as "group" and "index" are SQL keywords
+        columns = ', '.join(['"' + name + '"' for name in self.metadata_dtype().names])
+        numcolumns = len(self.metadata_dtype().names)
+        directory_abs = os.path.abspath(directory)
+        connection = sqlite3.connect(self.get_index_filename(directory))
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS spe_metadata (path TEXT PRIMARY KEY, '
+                                   'directory TEXT, ' + columns + ')')
+                stored = {path: (size, mtime) for path, size, mtime in
+                          connection.execute('SELECT path, size, mtime FROM spe_metadata WHERE directory = ?',
+                                             (directory_abs,))}
+
+                present = set()
+                updated = 0
+                for entry in os.scandir(directory_abs):
+                    if not entry.name.endswith('.spe') or not entry.is_file():
+                        continue
+                    present.add(entry.path)
+                    stat = entry.stat()
+                    if stored.get(entry.path) == (stat.st_size, stat.st_mtime):
+                        continue
+                    try:
+                        row = self.read_metadata(entry.path)
+                    except (OSError, ValueError, IndexError, KeyError, AttributeError, etree.XMLSyntaxError):
+                        print('Could not read the metadata of', entry.path, ', skipping.')
+                        continue
+                    connection.execute('INSERT OR REPLACE INTO spe_metadata VALUES (' +
+                                       ', '.join(['?'] * (numcolumns + 2)) + ')',
+                                       (entry.path, directory_abs) + row)
+                    updated = updated + 1
+
+                removed = [(path,) for path in stored if path not in present]
+                connection.executemany('DELETE FROM spe_metadata WHERE path = ?', removed)
+
+                rows = connection.execute('SELECT ' + columns + ' FROM spe_metadata WHERE directory = ? '
+                                          'ORDER BY filename', (directory_abs,)).fetchall()
+        finally:
+            connection.close()
+
+        namelength = max([max(len(row[0]), len(row[9])) for row in rows], default=1)
+        metadata = np.array(rows, dtype=self.metadata_dtype(namelength))
+
+        if self.verbose:
+            print('Metadata index for', directory, 'holds', len(metadata), 'files,', updated, 'updated and',
+                  len(removed), 'removed.')
+
+        return metadata
+
+    def pull_trigger(self, plot=True):
+        """Start the processing sequence.
+
+        Used mainly in the GUI. When all files are read in and sorted properly, this will create
+        datastores, populate datastores, and process all the data using batch_process() according to the
+        flags supplied. Parameters are all class attributes.
+
+        The lists containing data files all need to be properly matched and sorted for this to make sense.
+
+        Only one of these processing paths is used, in this order of precedence. If stacked_check is set then
+        all the files are processed together as one SFGBatchStore, and num_workers, result_cache_check,
+        incremental_check, and lean_memory are ignored (a message says so if any of them are set). Otherwise,
+        if num_workers is more than 1 the files are read, processed, and written in parallel by
+        parallel_process(), and then plotted here in the original order. Otherwise, if result_cache_check is
+        set then results are loaded from the on-disk result cache where possible (see process_files_cached()).
+        Otherwise, if incremental_check is set and lean_memory isn't then only the stages that have changed
+        since the last call are redone, by incremental_process(). Otherwise the files are processed one at a
+        time by batch_process(). incremental_check is ignored (with a message) whenever an earlier path is
+        used, or lean_memory is set.
+
+        If "hdf5_batch" is in write_formats then all the results are also added to one HDF5 file with
+        write_batch_file().
+
+        progress_callback is called after each file, and setting cancel_event stops processing after the
+        current file (see file_done()). cancel_event isn't cleared here, so that a cancel made just after the
+        run is started is never lost. The GUI runs this on a worker thread with plot=False and does the
+        plotting itself from progress_callback, as figures can only be made on the GUI thread.
+
+        Parameters
+        -----------
+        plot : bool, optional
+            If False then nothing is plotted, even if plot_data_check is set. Default True.
+
+        Returns
+        ----------
+        datastores : list
+            The processed SFGDataStore objects, in the same order as signal_names. Only the files processed
+            before cancelling, if processing was cancelled.
+        """
+        numfiles = len(self.signal_names)
+        if self.stacked_check and numfiles > 0:
+            batchstore = self.create_batch_store(self.data_directory, self.signal_names, self.bg_names,
+                                                 self.ref_names, self.ref_bg_names)
+            if batchstore is not None:
+                ignored = [name for name, value in (('num_workers', self.num_workers > 1),
+                                                    ('result_cache_check', self.result_cache_check),
+                                                    ('incremental_check', self.incremental_check),
+                                                    ('lean_memory', self.lean_memory)) if value]
+                if ignored:
+                    print('Stacked processing takes precedence, ignoring: ' + ', '.join(ignored))
+                self.process_batch_store(batchstore)
+                datastores = batchstore.to_datastores()
+                with self.create_writer() as writer:
+                    for i, datastore in enumerate(datastores):
+                        self.parse_filename(self.data_directory, self.signal_names[i], datastore)
+                        if self.write_file_check:
+                            writer.put(datastore)
+                        if plot and self.plot_data_check:
+                            self.current_figure = self.plot_data(datastore, i, numfiles, self.current_figure)
+                        if self.file_done(datastore, i, numfiles):
+                            datastores = datastores[:i + 1]
+                            break
+                return self.finish_batch(datastores)
+            print('Could not stack the files, processing them one at a time instead.')
+
+        if self.incremental_check:
+            overriding = [name for name, value in (('num_workers', self.num_workers > 1 and numfiles > 1),
+                                                   ('result_cache_check', self.result_cache_check),
+                                                   ('lean_memory', self.lean_memory)) if value]
+            if overriding:
+                print('Ignoring incremental_check, which cannot be combined with: ' + ', '.join(overriding))
+
+        if self.num_workers > 1 and numfiles > 1:
+            datastores = self.parallel_process(self.data_directory, self.signal_names, self.bg_names,
+                                               self.ref_names, self.ref_bg_names)
+            if plot and self.plot_data_check:
+                for i, datastore in enumerate(datastores):
+                    self.current_figure = self.plot_data(datastore, i, numfiles, self.current_figure)
+            return self.finish_batch(datastores)
+
+        if self.result_cache_check:
+            datastores = self.process_files(self.data_directory, self.signal_names, self.bg_names,
+                                            self.ref_names, self.ref_bg_names)
+            if plot and self.plot_data_check:
+                for i, datastore in enumerate(datastores):
+                    self.current_figure = self.plot_data(datastore, i, numfiles, self.current_figure)
+            return self.finish_batch(datastores)
+
+        if self.incremental_check and not self.lean_memory:
+            datastores = self.incremental_process(self.data_directory, self.signal_names, self.bg_names,
+                                                  self.ref_names, self.ref_bg_names)
+            with self.create_writer() as writer:
+                for i, datastore in enumerate(datastores):
+                    if self.write_file_check:
+                        writer.put(datastore)
+                    if plot and self.plot_data_check:
+                        self.current_figure = self.plot_data(datastore, i, numfiles, self.current_figure)
+            return self.finish_batch(datastores)
+
+        datastores = self.create_data_stores(numfiles)
+        self.set_attr_list(datastores, 'verbose', self.verbose)
+        self.set_attr_list(datastores, 'stupidly_verbose', self.stupidly_verbose)
+        self.populate_data_stores(datastores, self.data_directory, self.signal_names, self.bg_names,
+                                  self.ref_names, self.ref_bg_names)
+        datastores = self.batch_process(datastores, plot)
+        return self.finish_batch(datastores)
+
+    def finish_batch(self, datastores):
+        """Finish off a batch processed by pull_trigger(), returning datastores.
+
+        Writes the batch HDF5 file with write_batch_file(), and says so if processing was cancelled.
+        """
+        self.write_batch_file(datastores)
+        if self.cancel_event.is_set():
+            print('Processing cancelled after', len(datastores), 'of', len(self.signal_names), 'files.')
+        return datastores
+
+    def process_directory(self, directory):
+        """Find, match, process, and write all the data in directory, as the GUI does, but without plotting.
+
+        The files are found with get_filenames_smart() using samplestring, refstring, and bg_string, matched
+        with match_files(), and processed and written with pull_trigger(). Everything else is set by the class
+        attributes as usual. If write_directory isn't set the files are written to directory. This is what
+        "python -m sfgtools process" runs.
+
+        Parameters
+        -----------
+        directory : str
+            Directory containing the .spe files.
+
+        Returns
+        ----------
+        summary : dict
+            Summary of the run, which can be saved as JSON.
+        """
+        start = time.perf_counter()
+        if not os.path.isdir(directory):
+            raise FileNotFoundError('Data directory ' + str(directory) + ' does not exist.')
+        self.data_directory = os.path.join(directory, '')
+        if self.write_directory is None:
+            self.write_directory = self.data_directory
+
+        self.signal_names, self.bg_names, self.ref_names, self.ref_bg_names, self.ref_num = \
+            self.get_filenames_smart()
+        self.signal_names, self.bg_names, self.ref_names, self.ref_bg_names, self.sig_ref_num, self.ref_num = \
+            self.match_files(self.signal_names, self.bg_names, self.ref_names, self.ref_bg_names, self.ref_num,
+                             self.data_directory)
+        datastores = self.pull_trigger(plot=False)
+
+        summary = {'directory': self.data_directory,
+                   'write_directory': self.write_directory,
+                   'num_files': len(self.signal_names),
+                   'num_processed': len(datastores),
+                   'signal_files': list(self.signal_names),
+                   'background_files': list(self.bg_names),
+                   'reference_files': list(self.ref_names),
+                   'reference_background_files': list(self.ref_bg_names),
+                   'write_formats': list(self.write_formats) if self.write_file_check else [],
+                   'num_workers': self.num_workers,
+                   'elapsed_seconds': round(time.perf_counter() - start, 3)}
+        return summary
+
+    def process_files(self, directory, signal_names, bg_names, ref_names, ref_bg_names):
+        """Read, process, and write (but don't plot) a list of files, returning the datastores.
+
+        This is the work done by each worker process in parallel_process(), but can also be called directly.
+        The file lists are in the same format as for populate_data_stores().
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_names : list
+            Contains filenames of the signal data files to be processed.
+        bg_names : list
+            Contains filenames of the background data files of the signal data files to be processed.
+        ref_names : list
+            Contains filenames of the reference data files to be processed.
+        ref_bg_names : list
+            Contains filenames of the background data files of the reference data files to be processed.
+
+        Returns
+        ----------
+        datastores : list
+            Contains the processed SFGDataStore objects, one per signal file, in the same order.
+        """
+        if self.result_cache_check:
+            return self.process_files_cached(directory, signal_names, bg_names, ref_names, ref_bg_names)
+
+        datastores = self.create_data_stores(len(signal_names))
+        self.set_attr_list(datastores, 'verbose', self.verbose)
+        self.set_attr_list(datastores, 'stupidly_verbose', self.stupidly_verbose)
+        self.populate_data_stores(datastores, directory, signal_names, bg_names, ref_names, ref_bg_names)
+        with self.create_writer() as writer:
+            for i, datastore in enumerate(datastores):
+                self.process_data(datastore, self.downconvert_check, self.subtract_check, self.normalise_check,
+                                  self.exposure_check, self.calibrate_check, self.cosmic_kill_check,
+                                  self.global_force)
+                if self.write_file_check:
+                    writer.put(datastore)
+                if self.file_done(datastore, i, len(datastores)):
+                    datastores = datastores[:i + 1]
+                    break
+        return datastores
+
+    def process_files_cached(self, directory, signal_names, bg_names, ref_names, ref_bg_names):
+        """Read, process, and write a list of files like process_files(), using the on-disk result cache.
+
+        Files whose result_key() is already in the result cache are loaded from it without reading or
+        processing anything. The rest are processed as usual and their results added to the cache, which is
+        then pruned back to result_cache_max_size with prune_result_cache().
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_names : list
+            Contains filenames of the signal data files to be processed.
+        bg_names : list
+            Contains filenames of the background data files of the signal data files to be processed.
+        ref_names : list
+            Contains filenames of the reference data files to be processed.
+        ref_bg_names : list
+            Contains filenames of the background data files of the reference data files to be processed.
+
+        Returns
+        ----------
+        datastores : list
+            Contains the processed SFGDataStore objects, one per signal file, in the same order.
+        """
+        datastores = []
+        misses = 0
+        with self.create_writer() as writer:
+            for i, name in enumerate(signal_names):
+                key = self.result_key(directory, name,
+                                      bg_names[i] if self.subtract_check else None,
+                                      ref_names[i] if self.normalise_check else None,
+                                      ref_bg_names[i] if self.subtract_check and self.normalise_check else None)
+                datastore = self.load_result(key)
+                if datastore is None:
+                    misses = misses + 1
+                    datastore = self.create_data_stores(1)[0]
+                    datastore.verbose = self.verbose
+                    datastore.stupidly_verbose = self.stupidly_verbose
+                    self.populate_data_stores([datastore], directory, signal_names[i:i + 1], bg_names[i:i + 1],
+                                              ref_names[i:i + 1], ref_bg_names[i:i + 1])
+                    self.process_data(datastore, self.downconvert_check, self.subtract_check, self.normalise_check,
+                                      self.exposure_check, self.calibrate_check, self.cosmic_kill_check,
+                                      self.global_force)
+                    self.save_result(datastore, key)
+                if self.write_file_check:
+                    writer.put(datastore)
+                datastores.append(datastore)
+                if self.file_done(datastore, i, len(signal_names)):
+                    break
+
+        if self.verbose:
+            print(len(datastores) - misses, 'of', len(datastores), 'files loaded from the result cache.')
+        if misses:
+            self.prune_result_cache()
+        return datastores
+
+    def get_result_cache_directory(self):
+        """Return the directory of the on-disk result cache, creating it if needed.
+
+        This is result_cache_directory if it is set, otherwise a per-user cache directory.
+        """
+        cachedir = self.result_cache_directory
+        if cachedir is None:
+            cachedir = os.path.join(os.environ.get('LOCALAPPDATA', os.path.join(os.path.expanduser('~'), '.cache')),
+                                    'sfgtools', 'results')
+        os.makedirs(cachedir, exist_ok=True)
+        return cachedir
+
+    def result_key(self, directory, signal_name, bg_name, ref_name, ref_bg_name):
+        """Return the key that the processed result of one signal file is stored under in the result cache.
+
+        The key is a SHA-256 hash of the path, size, and time of last modification of every file used, and of
+        every class attribute that changes the result of reading or processing them. Changing any file or
+        option therefore gives a different key, and old results are never returned.
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_name, bg_name, ref_name, ref_bg_name : str
+            Filenames of the signal file and its background, reference, and reference background. The ones
+            that aren't used with the current flags can be None.
+
+        Returns
+        ----------
+        key : str
+            Hexadecimal hash.
+        """
+        files = []
+        for name in [signal_name, bg_name, ref_name, ref_bg_name]:
+            if name is None:
+                files.append(None)
+            else:
+                stat = os.stat(directory + name)
+                files.append((os.path.abspath(directory + name), stat.st_size, stat.st_mtime_ns))
+        parameters = (self.sum_accumulations, self.series_accumulations, self.accumulation_mode,
+                      self.accumulation_sigma, np.dtype(self.working_dtype).str, self.downconvert_check,
+                      self.upconversion_line, self.subtract_check, self.normalise_check, self.exposure_check,
+                      self.calibrate_check,
+                      None if self.calibration_offset is None else np.ravel(self.calibration_offset).tolist(),
+                      self.cosmic_kill_check, self.cosmic_threshold, self.cosmic_max_width, self.global_force,
+                      self.lean_memory, sorted(self.keep_intermediates))
+        key = hashlib.sha256(repr(('sfgtools result 3', files, parameters)).encode()).hexdigest()
+        return key
+
+    def save_result(self, datastore, key):
+        """Save a processed datastore to the result cache under key, as an .npz file.
+
+        Every attribute of datastore that isn't None is saved as an array. The file is written under a temporary
+        name and then renamed, so a cache file is never seen half written.
+
+        Parameters
+        -----------
+        datastore : SFGDataStore object
+            The processed datastore.
+        key : str
+            Key from result_key().
+        """
+        arrays = {}
+        for attribute in SFGDataStore.__slots__:
+            value = getattr(datastore, attribute)
+            if value is None:
+                continue
+            if attribute == 'dtype':
+                value = np.dtype(value).str
+            arrays[attribute] = np.asarray(value)
+
+        fname = os.path.join(self.get_result_cache_directory(), key + '.npz')
+        tempname = fname + '.' + str(os.getpid()) + '.tmp'
+        with open(tempname, 'wb') as cachefile:
+            np.savez(cachefile, **arrays)
+        os.replace(tempname, fname)
+        return
+
+    def load_result(self, key):
+        """Load a processed datastore from the result cache.
+
+        Parameters
+        -----------
+        key : str
+            Key from result_key().
+
+        Returns
+        ----------
+        datastore : SFGDataStore object
+            The datastore saved by save_result(), or None if key isn't in the cache.
+        """
+        fname = os.path.join(self.get_result_cache_directory(), key + '.npz')
+        try:
+            cachefile = np.load(fname, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+        datastore = SFGDataStore()
+        with cachefile:
+            for attribute in cachefile.files:
+                value = cachefile[attribute]
+                if attribute == 'dtype':
+                    value = np.dtype(str(value)).type
+                elif attribute == 'keep_intermediates':
+                    value = [str(item) for item in value]
+                elif value.ndim == 0:
+                    # JDP keep numpy scalars as numpy scalars so they print the same as before
+                    value = value[()]
+                setattr(datastore, attribute, value)
+        datastore.verbose = self.verbose
+        datastore.stupidly_verbose = self.stupidly_verbose
+
+        # JDP mark it as recently used for prune_result_cache()
+        os.utime(fname)
+        if self.stupidly_verbose:
+            print('Loaded', datastore.filename_sig, 'from the result cache.')
+        return datastore
+
+    def prune_result_cache(self, max_size=None):
+        """Delete the least recently used results from the result cache until it is at most max_size bytes.
+
+        Parameters
+        -----------
+        max_size : int, optional
+            Maximum total size of the cache in bytes. Default result_cache_max_size, 0 empties the cache.
+
+        Returns
+        ----------
+        removed : int
+            Number of results deleted.
+        freed : int
+            Number of bytes freed.
+        """
+        if max_size is None:
+            max_size = self.result_cache_max_size
+        cachedir = self.get_result_cache_directory()
+
+        entries = []
+        for fname in glob.glob(os.path.join(cachedir, '*.npz')):
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        entries.sort()
+
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        freed = 0
+        for mtime, size, fname in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total = total - size
+            removed = removed + 1
+            freed = freed + size
+
+        if self.verbose and removed:
+            print('Removed', removed, 'results (' + str(freed), 'bytes) from the result cache.')
+        return removed, freed
+
+    def parallel_process(self, directory, signal_names, bg_names, ref_names, ref_bg_names):
+        """Read, process, and write files using num_workers processes.
+
+        The file lists are split into contiguous chunks (so that neighbouring signal files, which tend to share
+        references and backgrounds, hit the same worker's read cache) and each chunk is handed to
+        process_files() in a concurrent.futures.ProcessPoolExecutor. All the processing flags are taken from
+        the class attributes. Nothing is plotted, as plotting has to stay in the main process.
+
+        file_done() is called for each file as its chunk comes back. If processing is cancelled the chunks
+        that haven't started are dropped, and the ones already running are finished (and written) but not
+        returned.
+
+        Note that on Windows the worker processes re-import the script that started them, so any script
+        using this needs the usual "if __name__ == '__main__':" guard.
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_names : list
+            Contains filenames of the signal data files to be processed.
+        bg_names : list
+            Contains filenames of the background data files of the signal data files to be processed.
+        ref_names : list
+            Contains filenames of the reference data files to be processed.
+        ref_bg_names : list
+            Contains filenames of the background data files of the reference data files to be processed.
+
+        Returns
+        ----------
+        datastores : list
+            Contains the processed SFGDataStore objects, one per signal file, in the same order as
+            signal_names.
+        """
+        numfiles = len(signal_names)
+        if numfiles == 0:
+            print('No files or filenames loaded, nothing to process. Exiting...')
+            return []
+
+        if self.verbose:
+            print('Processing ' + f'{numfiles:d}' + ' files with ' + f'{self.num_workers:d}' + ' workers.')
+
+        # JDP a few chunks per worker so that the load stays balanced if some files are slower than others
+        chunksize = max(1, int(np.ceil(numfiles / (4 * self.num_workers))))
+        chunks = [[names[start:start + chunksize] for names in [signal_names, bg_names, ref_names, ref_bg_names]]
+                  for start in range(0, numfiles, chunksize)]
+
+        datastores = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            results = executor.map(self.process_files, itertools.repeat(directory), *zip(*chunks))
+            for chunk in results:
+                for datastore in chunk:
+                    self.file_done(datastore, len(datastores), numfiles)
+                    datastores.append(datastore)
+                if self.cancel_event.is_set():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+
+        return datastores
+
+    def read_stacked(self, directory, names):
+        """Read a list of files into one stacked array.
+
+        Every file must hold a single (frameheight, framewidth) spectrum (or be summed into one), with the
+        same frame size as all the others.
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        names : list
+            Contains the filenames of the files to read.
+
+        Returns
+        ----------
+        stack : np array
+            (len(names), frameheight, framewidth) array of the data, or None if the files couldn't be stacked.
+        acqtimes : np array
+            Exposure time of each file.
+        xaxes : np array
+            (len(names), framewidth) array of the energy axis of each file.
+        numframes : np array
+            Number of frames in each file.
+        """
+        stack = None
+        acqtimes = np.zeros(len(names))
+        xaxes = None
+        numframes = np.zeros(len(names), dtype=int)
+
+        for i, name in enumerate(names):
+            scratch = SFGDataStore()
+            self.read_files(directory + name, scratch, 'sig')
+            if scratch.signal_raw is None or np.ndim(scratch.signal_raw) != 2:
+                print('Could not read', name, 'as a single spectrum, so it cannot be stacked.')
+                return None, None, None, None
+            if stack is None:
+                stack = np.zeros((len(names),) + np.shape(scratch.signal_raw), dtype=self.working_dtype)
+                xaxes = np.zeros((len(names), np.size(scratch.xaxis)))
+            elif np.shape(scratch.signal_raw) != np.shape(stack)[1:]:
+                print('The frame size of', name, 'is', np.shape(scratch.signal_raw), 'but previous files are',
+                      np.shape(stack)[1:], 'so it cannot be stacked.')
+                return None, None, None, None
+            stack[i] = scratch.signal_raw
+            xaxes[i] = scratch.xaxis
+            acqtimes[i] = scratch.acqtime
+            numframes[i] = scratch.numframes
+
+        return stack, acqtimes, xaxes, numframes
+
+    def create_batch_store(self, directory, signal_names, bg_names, ref_names, ref_bg_names):
+        """Read files into an SFGBatchStore, ready to be processed together by process_batch_store().
+
+        The file lists are in the same format as for populate_data_stores(), and which of them are read
+        depends on subtract_check and normalise_check in the same way. Each unique background, and each unique
+        reference (with its background), is only read and stored once.
+
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_names : list
+            Contains filenames of the signal data files to be processed.
+        bg_names : list
+            Contains filenames of the background data files of the signal data files to be processed.
+        ref_names : list
+            Contains filenames of the reference data files to be processed.
+        ref_bg_names : list
+            Contains filenames of the background data files of the reference data files to be processed.
+
+        Returns
+        ----------
+        batchstore : SFGBatchStore object
+            Contains the stacked data, or None if the files couldn't be stacked.
+        """
+        batchstore = SFGBatchStore()
+        batchstore.verbose = self.verbose
+        batchstore.stupidly_verbose = self.stupidly_verbose
+        batchstore.dtype = self.working_dtype
+        batchstore.directory = directory
+        batchstore.signal_names = list(signal_names)
+
+        batchstore.signal_raw, batchstore.acqtime, batchstore.xaxis, batchstore.numframes = \
+            self.read_stacked(directory, signal_names)
+        if batchstore.signal_raw is None:
+            return None
+        batchstore.frameheight, batchstore.framewidth = np.shape(batchstore.signal_raw)[1:]
+        batchstore = self.read_batch_references(batchstore, directory, bg_names, ref_names, ref_bg_names)
+
+        if self.verbose and batchstore is not None:
+            print('Stacked', len(batchstore), 'signal files,', len(batchstore.bg_names), 'backgrounds and',
+                  len(batchstore.ref_names), 'references.')
+
+        return batchstore
+
+    def read_batch_references(self, batchstore, directory, bg_names, ref_names, ref_bg_names):
+        """Read the backgrounds and references of the signals in batchstore, each unique file only once.
+
+        Used by create_batch_store() and process_series(). Which files are read depends on subtract_check and
+        normalise_check in the same way as for populate_data_stores(), and they must all have the frame size
+        of the signals in batchstore.
+
+        Parameters
+        -----------
+        batchstore : SFGBatchStore object
+            Holds the signals already, with frameheight and framewidth set.
+        directory : str
+            Directory that the data files are stored in.
+        bg_names : list
+            Contains filenames of the background data files of the signal data files to be processed.
+        ref_names : list
+            Contains filenames of the reference data files to be processed.
+        ref_bg_names : list
+            Contains filenames of the background data files of the reference data files to be processed.
+
+        Returns
+        ----------
+        batchstore : SFGBatchStore object
+            The same batchstore with the backgrounds and references added, or None if they couldn't be stacked.
+        """
+        stackshape = (batchstore.frameheight, batchstore.framewidth)
+
+        if self.subtract_check:
+            if not bg_names:
+                print('No background filenames loaded, even though subtract is ticked. Check input. Exiting...')
+                return None
+            batchstore.bg_names = list(dict.fromkeys(bg_names))
+            bg_lookup = {name: i for i, name in enumerate(batchstore.bg_names)}
+            batchstore.bg_index = np.array([bg_lookup[name] for name in bg_names])
+            batchstore.background, batchstore.acqtime_bg = self.read_stacked(directory, batchstore.bg_names)[0:2]
+            if batchstore.background is None or np.shape(batchstore.background)[1:] != stackshape:
+                return None
+
+        if self.normalise_check:
+            if not ref_names:
+                print('No reference filenames loaded, even though normalise is ticked. Check input. Exiting...')
+                return None
+            if self.subtract_check:
+                if not ref_bg_names:
+                    print('No reference background filenames loaded, even though normalise and subtracted '
+                          'ticked. Check input. Exiting...')
+                    return None
+                pairs = list(zip(ref_names, ref_bg_names))
+            else:
+                pairs = [(name, None) for name in ref_names]
+            unique_pairs = list(dict.fromkeys(pairs))
+            pair_lookup = {pair: i for i, pair in enumerate(unique_pairs)}
+            batchstore.ref_index = np.array([pair_lookup[pair] for pair in pairs])
+            batchstore.ref_names = [pair[0] for pair in unique_pairs]
+            batchstore.ref_raw, batchstore.acqtime_ref = self.read_stacked(directory, batchstore.ref_names)[0:2]
+            if batchstore.ref_raw is None or np.shape(batchstore.ref_raw)[1:] != stackshape:
+                return None
+            if self.subtract_check:
+                batchstore.ref_bg_names = [pair[1] for pair in unique_pairs]
+                batchstore.ref_bg, batchstore.acqtime_refbg = self.read_stacked(directory,
+                                                                                batchstore.ref_bg_names)[0:2]
+                if batchstore.ref_bg is None or np.shape(batchstore.ref_bg)[1:] != stackshape:
+                    return None
+
+        return batchstore
+
+    def process_batch_store(self, batchstore):
+        """Process all the data in batchstore according to the class attribute flags.
+
+        The SFGBatchStore equivalent of process_data(), with the steps applied in the same order. Each step
+        is a single vectorised operation over the whole batch.
+
+        Parameters
+        -----------
+        batchstore : SFGBatchStore object
+            Contains the data to be processed.
+        """
+        if self.cosmic_kill_check:
+            batchstore.remove_cosmic_rays(self.cosmic_threshold, self.cosmic_max_width)
+
+        if self.downconvert_check:
+            upconverter = self.nm_to_cm(self.upconversion_line)
+            batchstore.downconvert_spectrum(upconverter, self.global_force)
+
+        if self.calibrate_check:
+            batchstore.calibrate_spectrum(np.float32(self.calibration_offset), self.global_force)
+
+        if self.exposure_check:
+            batchstore.divide_exposure(self.global_force)
+
+        if self.subtract_check:
+            batchstore.background_subtract(self.global_force)
+
+        if self.subtract_check and self.normalise_check:
+            batchstore.ref_background_subtract(self.global_force)
+
+        if self.normalise_check:
+            batchstore.normalise_data(self.global_force)
 
-        ref_id = [ref_names.index(i)+1 for i in ref_names]
+        return
 
-        return signal_names, bg_names, ref_names, ref_bg_names, ref_id
+    def process_series(self, directory, signal_name, bg_name, ref_name, ref_bg_name, chunk=64):
+        """Process a kinetic series one block of frames at a time, for series too large to hold in memory.
 
-    def pull_trigger(self):
-        """Start the processing sequence.
+        Every frame of signal_name is treated as a spectrum in its own right, with the same background and
+        reference. The frames are read chunk at a time with iter_frames() into an SFGBatchStore with one row
+        per frame, processed with process_batch_store() according to the class attribute flags, and yielded
+        before the next block is read. Each block can then be written or plotted (e.g. with to_datastores())
+        and dropped, so only the background, the references, and one block of frames are ever in memory.
 
-        Used mainly in the GUI. When all files are read in and sorted properly, this will create
-        datastores, populate datastores, and process all the data using batch_process() according to the
-        flags supplied. Parameters are all class attributes.
+        Parameters
+        -----------
+        directory : str
+            Directory that the data files are stored in.
+        signal_name : str
+            Filename of the series.
+        bg_name : str
+            Filename of the background of the series.
+        ref_name : str
+            Filename of the reference.
+        ref_bg_name : str
+            Filename of the background of the reference.
+        chunk : int, optional
+            Maximum number of frames in each block. Default 64.
+
+        Yields
+        -----------
+        batchstore : SFGBatchStore object
+            The processed block, with one row per frame.
+        timestamps : np array
+            Time of each frame in the block, see iter_frames().
+        """
+        framewidth, frameheight, numframes, framestride, pixeltype_np, acqtime, xaxis = \
+            self.decode_spe_layout(self.map_spe(directory + signal_name))
 
-        The lists containing data files all need to be properly matched and sorted for this to make sense.
+        template = SFGBatchStore()
+        template.frameheight, template.framewidth = frameheight, framewidth
+        template = self.read_batch_references(template, directory, [bg_name], [ref_name], [ref_bg_name])
+        if template is None:
+            return
+
+        for frames, timestamps in self.iter_frames(directory + signal_name, chunk):
+            numblock = len(frames)
+            batchstore = SFGBatchStore()
+            batchstore.verbose = self.verbose
+            batchstore.stupidly_verbose = self.stupidly_verbose
+            batchstore.dtype = self.working_dtype
+            batchstore.directory = directory
+            batchstore.signal_names = [signal_name] * numblock
+            batchstore.signal_raw = frames.astype(self.working_dtype)
+            batchstore.acqtime = np.full(numblock, acqtime, dtype=np.float64)
+            batchstore.xaxis = np.tile(xaxis, (numblock, 1))
+            batchstore.numframes = np.ones(numblock, dtype=int)
+            batchstore.frameheight, batchstore.framewidth = frameheight, framewidth
+            # JDP the background and references are shared by every frame, and are never changed in place
+            for name in ['bg_names', 'ref_names', 'ref_bg_names', 'background', 'ref_raw', 'ref_bg',
+                         'acqtime_bg', 'acqtime_ref', 'acqtime_refbg']:
+                setattr(batchstore, name, getattr(template, name))
+            batchstore.bg_index = np.zeros(numblock, dtype=int)
+            batchstore.ref_index = np.zeros(numblock, dtype=int)
+            self.process_batch_store(batchstore)
+            yield batchstore, timestamps
+
+    def __getstate__(self):
+        """Return the attributes to pickle when sending the class to a worker process.
+
+        The current figure, progress_callback, and cancel_event can't be sent between processes, and the read
+        and stage caches and the text and preview templates would only make the copy larger, so they are left
+        behind.
         """
-        numfiles = len(self.signal_names)
-        datastores = self.create_data_stores(numfiles)
-        self.set_attr_list(datastores, 'verbose', self.verbose)
-        self.set_attr_list(datastores, 'stupidly_verbose', self.stupidly_verbose)
-        self.populate_data_stores(datastores, self.data_directory, self.signal_names, self.bg_names,
-                                  self.ref_names, self.ref_bg_names)
-        self.batch_process(datastores)
-        return 
+        state = self.__dict__.copy()
+        state['current_figure'] = None
+        state['preview_template'] = None
+        state['progress_callback'] = None
+        del state['cancel_event']
+        state['read_cache'] = collections.OrderedDict()
+        state['stage_cache'] = {}
+        state['text_templates'] = {}
+        return state
+
+    def __setstate__(self, state):
+        """Restore the attributes pickled by __getstate__(), with a new cancel_event."""
+        self.__dict__.update(state)
+        self.cancel_event = threading.Event()
+        return
 
     def read_files(self, fname, datastore, flag):
         """Read fname and put the data in the right place in datastore using flag.
@@ -702,6 +2476,68 @@ class SFGProcessTools:
             return
         return
 
+    def read_files_cached(self, fname, datastore, flag):
+        """Read fname into datastore like read_files(), but reuse the data if the file has been read before.
+
+        The data, energy axis, exposure time, and frame info read from each file are kept in read_cache,
+        keyed by the path, time of last modification, accumulation mode, and working_dtype, so a file that is
+        changed on disk or read with different accumulation settings or precision is read again. Only reading
+        the signal file ("sig") sets the energy axis, frame size, number of frames, and timestamps of
+        datastore, unless they haven't been set yet. The cached arrays are shared between every datastore that
+        uses them (rather than copied) and are made read-only so that processing one datastore cannot change
+        another. The least recently used file is dropped once read_cache_size files are cached.
+
+        Parameters
+        -----------
+        fname : str
+            File to be read in.
+        datastore : SFGDataStore object
+            Datastore to put the data from the file into.
+        flag : str
+            Tells the .spe reader where to put this data in datastore. Options are "sig", "bg", "ref",
+            "refbg".
+        """
+        if self.read_cache_size <= 0:
+            self.read_files(fname, datastore, flag)
+            return
+
+        key = (os.path.abspath(fname), self.get_file_creationtime(fname), self.sum_accumulations,
+               self.series_accumulations, self.accumulation_mode, self.accumulation_sigma,
+               np.dtype(self.working_dtype).str)
+
+        if key in self.read_cache:
+            self.read_cache.move_to_end(key)
+            if self.stupidly_verbose:
+                print('Using cached data for', fname)
+        else:
+            # JDP read into a scratch datastore so the entry doesn't depend on what else is in datastore
+            scratch = SFGDataStore()
+            self.read_files(fname, scratch, 'sig')
+            if scratch.signal_raw is None:
+                return
+            for array in [scratch.signal_raw, scratch.xaxis, scratch.timestamps]:
+                if array is not None:
+                    array.setflags(write=False)
+            self.read_cache[key] = (scratch.signal_raw, scratch.acqtime, scratch.xaxis, scratch.framewidth,
+                                    scratch.frameheight, scratch.numframes, scratch.timestamps)
+            while len(self.read_cache) > self.read_cache_size:
+                self.read_cache.popitem(last=False)
+
+        data, acqtime, xaxis, framewidth, frameheight, numframes, timestamps = self.read_cache[key]
+        self.assign_filename_to_storage(flag, datastore, fname)
+        self.assign_data_to_storage(flag, datastore, data)
+        self.assign_acqtime_to_storage(flag, datastore, acqtime)
+        # JDP the energy axis and frame info belong to the signal file, the other files only fill them in if
+        # JDP there is no signal yet, so reading a background or reference can't overwrite them
+        if flag == 'sig' or datastore.xaxis is None:
+            datastore.xaxis = xaxis
+            datastore.framewidth = framewidth
+            datastore.frameheight = frameheight
+            datastore.numframes = numframes
+            if timestamps is not None:
+                datastore.timestamps = timestamps
+        return
+
     @staticmethod
     def match_polarisations_bg(pol, bg_names):
         """UNUSED. Identify bg files with different polarisations to signal files.
@@ -792,12 +2628,75 @@ class SFGProcessTools:
         closest_file : str
             The element of files that was created at the closest time to target.
         """
-        target_time = self.get_file_creationtime(target)
-        times = [self.get_file_creationtime(i) for i in files]
-        index = min(range(len(times)), key=lambda k: abs(times[k] - target_time))
+        target_time = np.array([self.get_file_creationtime(target)])
+        times = np.array([self.get_file_creationtime(i) for i in files])
+        index = self.find_closest_times(target_time, times)[0]
         closest_file = files[index]
         return closest_file
 
+    def get_file_mtimes(self, directory, files):
+        """Return the time of last modification of every file in files as an array.
+
+        If the metadata index for directory has been loaded (see update_metadata_index()) the times are taken
+        from it, otherwise each file is stat-ed once.
+
+        Parameters
+        -----------
+        directory : str
+            The directory containing the files.
+        files : list
+            Contains the names of the files.
+
+        Returns
+        -----------
+        mtimes : np array
+            Time of last modification of each file, in the same order as files.
+        """
+        indexed = {}
+        if self.metadata_index is not None and directory == self.data_directory:
+            indexed = dict(zip(self.metadata_index['filename'], self.metadata_index['mtime']))
+
+        mtimes = np.array([indexed[i] if i in indexed else self.get_file_creationtime(directory + i)
+                           for i in files], dtype=np.float64)
+        return mtimes
+
+    @staticmethod
+    def find_closest_times(target_times, times):
+        """Find the element of times closest to each element of target_times.
+
+        The candidate times are sorted once and each target is located with a binary search, so matching N
+        targets to M candidates costs O((N + M) log M) rather than O(N M). Where two candidates are equally
+        close the one that comes first in times is chosen.
+
+        Parameters
+        -----------
+        target_times : np array
+            Times to find the closest candidate to.
+        times : np array
+            Candidate times.
+
+        Returns
+        -----------
+        indices : np array
+            Index into times of the closest candidate to each element of target_times.
+        """
+        target_times = np.asarray(target_times, dtype=np.float64)
+        times = np.asarray(times, dtype=np.float64)
+        order = np.argsort(times, kind='stable')
+        sorted_times = times[order]
+        last = np.size(times) - 1
+
+        # JDP first candidate at or after each target, and the first of the candidates just before it
+        right = np.clip(np.searchsorted(sorted_times, target_times, side='left'), 0, last)
+        left = np.clip(right - 1, 0, last)
+        left = np.searchsorted(sorted_times, sorted_times[left], side='left')
+
+        dist_left = np.abs(target_times - sorted_times[left])
+        dist_right = np.abs(sorted_times[right] - target_times)
+        use_right = (dist_right < dist_left) | ((dist_right == dist_left) & (order[right] < order[left]))
+        indices = np.where(use_right, order[right], order[left])
+        return indices
+
     def open_spe(self, fname, datastore, flag):
         """Open an .spe file and send it to the correct reader method.
 
@@ -820,9 +2719,9 @@ class SFGProcessTools:
 
         """
 
-        binaryfile = open(fname, 'rb')
+        spefile = self.map_spe(fname)
 
-        spe_version = self.read_at(binaryfile, self.spe_version_loc, -1, np.float32)[0]
+        spe_version = self.decode_spe_header(spefile)['spe_version']
 
         if self.stupidly_verbose:
             print("SPE Version is", spe_version)
@@ -830,13 +2729,206 @@ class SFGProcessTools:
         self.assign_filename_to_storage(flag, datastore, fname)
 
         if spe_version < 3.0:
-            self.process_spe2x(binaryfile, datastore, flag)
+            self.process_spe2x(spefile, datastore, flag)
 
         if spe_version >= 3.0:
-            self.process_spe3x(binaryfile, datastore, flag)
+            self.process_spe3x(spefile, datastore, flag)
 
         return
-    
+
+    @staticmethod
+    def map_spe(fname):
+        """Memory-map an .spe file as a read-only array of bytes.
+
+        The whole file is mapped once, and the header, footer and frame data are all decoded from this one
+        mapping rather than by seeking and reading each field separately. Nothing is read from disk until
+        the relevant bytes are touched, and the file is released when the mapping is garbage collected,
+        so there is no file handle to close.
+
+        Parameters
+        -----------
+        fname : str
+            Name of the .spe file to map.
+
+        Returns
+        -----------
+        spefile : np.memmap
+            Read-only uint8 mapping of the whole file.
+        """
+        spefile = np.memmap(fname, dtype=np.uint8, mode='r')
+        return spefile
+
+    @staticmethod
+    def map_frames(spefile, pos, numframes, frameheight, framewidth, framestride, ntype):
+        """Return every frame stored in a memory-mapped .spe file as one array.
+
+        The array is a zero-copy view into the mapping with shape (numframes, frameheight, framewidth).
+        framestride is the distance in bytes between the start of successive frames, which for SPE 3.0 can be
+        larger than the frame itself if per-frame metadata is stored after each frame.
+
+        Parameters
+        -----------
+        spefile : np.memmap
+            Mapped file that you want to read from.
+        pos : int
+            Location (in bytes) of the first frame.
+        numframes : int
+            Number of frames stored in the file.
+        frameheight : int
+            Height of each frame in pixels.
+        framewidth : int
+            Width of each frame in pixels.
+        framestride : int
+            Distance (in bytes) from the start of one frame to the start of the next.
+        ntype : data type
+            Data type the pixels are encoded in.
+
+        Returns
+        -----------
+        frames : np array
+            Read-only view of shape (numframes, frameheight, framewidth).
+        """
+        pixelsize = np.dtype(ntype).itemsize
+        frames = np.ndarray((numframes, frameheight, framewidth), dtype=ntype, buffer=spefile, offset=int(pos),
+                            strides=(int(framestride), framewidth * pixelsize, pixelsize))
+        return frames
+
+    def decode_spe_layout(self, spefile):
+        """Decode how the frames are laid out in a memory-mapped .spe file, without touching the frames.
+
+        Parameters
+        -----------
+        spefile : np.memmap
+            The .spe file, mapped with map_spe().
+
+        Returns
+        -----------
+        framewidth : int
+            Width of each frame in pixels.
+        frameheight : int
+            Height of each frame in pixels.
+        numframes : int
+            Number of frames stored in the file.
+        framestride : int
+            Distance (in bytes) from the start of one frame to the start of the next.
+        pixeltype_np : numpy datatype
+            Data type the pixels are encoded in.
+        acqtime : float
+            Exposure time of each frame.
+        xaxis : np array
+            Energy axis in wavenumbers.
+        """
+        header = self.decode_spe_header(spefile)
+
+        if header['spe_version'] < 3.0:
+            framewidth = int(header['framewidth'])
+            frameheight = int(header['frameheight'])
+            numframes = int(header['numframes'])
+            pixeltype_np, pixelsize = self.get_pixel_type(header['pixeltype'])
+            framestride = framewidth * frameheight * pixelsize
+            acqtime = header['acqtime']
+            xaxis = self.spe2x_xaxis(header)
+        else:
+            xmltree = etree.fromstring(spefile[int(header['footer_offset']):].tobytes())
+            framewidth, frameheight, numframes, framestride, pixeltype, acqtime = self.decode_spe3x_footer(xmltree)
+            pixeltype_np, pixelsize = self.get_pixel_type(pixeltype)
+            xaxis = self.spe3x_xaxis(xmltree)
+        return framewidth, frameheight, numframes, framestride, pixeltype_np, acqtime, xaxis
+
+    def iter_frames(self, fname, chunk=64):
+        """Iterate over the frames of an .spe file in blocks, reading each block from disk only when it is reached.
+
+        Meant for kinetic series too large to hold in memory with series_accumulations, where combine_frames()
+        would need all the frames at once in working_dtype. Each block is kept in the native pixel type of the
+        file, so only chunk frames of the file are ever in memory at once, and can be processed, written, or
+        plotted before the next block is read. The timestamps follow the same convention as
+        series_accumulations, with frame i at i * acqtime. process_series() uses this to process a whole
+        series through the usual pipeline.
+
+        Parameters
+        -----------
+        fname : str
+            Path to the .spe file.
+        chunk : int, optional
+            Maximum number of frames in each block. Default 64.
+
+        Yields
+        -----------
+        frames : np array
+            (n, frameheight, framewidth) array of the next n <= chunk frames, in the pixel type of the file.
+        timestamps : np array
+            Time of each frame in frames in the same units as the exposure time.
+        """
+        spefile = self.map_spe(fname)
+        framewidth, frameheight, numframes, framestride, pixeltype_np, acqtime = self.decode_spe_layout(spefile)[:6]
+        frames = self.map_frames(spefile, self.data_offset_loc_loc, numframes, frameheight, framewidth,
+                                 framestride, pixeltype_np)
+        chunk = max(1, int(chunk))
+        for start in range(0, numframes, chunk):
+            # JDP copy the block out of the mapping so that only this block is read from disk
+            block = np.array(frames[start:start + chunk])
+            timestamps = np.arange(start, start + len(block)) * acqtime
+            yield block, timestamps
+
+    def spe_header_dtype(self):
+        """Return a numpy structured datatype describing the fixed binary header of an .spe file.
+
+        The header is the first data_offset_loc_loc (4100) bytes of every .spe file. Only the fields that are
+        actually used are named, at the locations given by the *_loc class attributes, so the whole header
+        can be decoded in one go rather than field by field. footer_offset is only meaningful for SPE 3.0
+        files, and the calibration fields only for SPE 2.x files.
+
+        Returns
+        -----------
+        header_dtype : np.dtype
+            Structured datatype with an itemsize of data_offset_loc_loc bytes.
+        """
+        header_dtype = np.dtype({'names': ['acqtime', 'framewidth', 'pixeltype', 'frameheight', 'footer_offset',
+                                           'numframes', 'spe_version', 'calib_polyorder', 'calib_polycoeffs'],
+                                 'formats': [np.float32, np.uint16, np.int16, np.uint16, np.uint64, np.int32,
+                                             np.float32, np.int8, (np.float64, 6)],
+                                 'offsets': [self.acqtime_loc, self.framewidth_loc, self.pixeltype_loc,
+                                             self.frameheight_loc, self.footer_offset_loc_loc,
+                                             self.numframes_loc, self.spe_version_loc, self.calib_polyorder_loc,
+                                             self.calib_polycoeffs_loc],
+                                 'itemsize': self.data_offset_loc_loc})
+        return header_dtype
+
+    def decode_spe_header(self, spefile):
+        """Decode the binary header of an .spe file that has already been read or mapped.
+
+        Parameters
+        -----------
+        spefile : np.memmap or bytes
+            Mapped file (from map_spe()) or at least the first data_offset_loc_loc bytes of the file.
+
+        Returns
+        -----------
+        header : np.void
+            Record with the fields given in spe_header_dtype(), accessed like header['framewidth'].
+        """
+        header = np.frombuffer(spefile, self.spe_header_dtype(), 1)[0]
+        return header
+
+    def read_spe_header(self, fname):
+        """Read only the binary header of an .spe file from disk and decode it.
+
+        Unlike open_spe() this never touches the frame data or the XML footer, so it costs a single 4100
+        byte read however large the file is.
+
+        Parameters
+        -----------
+        fname : str
+            Name of the .spe file.
+
+        Returns
+        -----------
+        header : np.void
+            Record with the fields given in spe_header_dtype().
+        """
+        header = np.fromfile(fname, self.spe_header_dtype(), 1)[0]
+        return header
+
     @staticmethod
     def read_at(file, pos, size, ntype):
         """Read a binary file at a specific position in bytes.
@@ -878,6 +2970,11 @@ class SFGProcessTools:
             Numpy datatype corresponding to the pixel datatype.
         pixelsize : int
             Size of the pixel in bytes.
+
+        Raises
+        -----------
+        ValueError
+            If the pixel type isn't recognised.
         """
 
         if pixeltype == 'MonochromeUnsigned16':
@@ -932,45 +3029,117 @@ class SFGProcessTools:
             if self.stupidly_verbose:
                 print("Pixel type is unsigned 32 bit integer")
         else:
-            err = QtWidgets.QMessageBox()
-            err.setText("Your SPE file has an unrecognised pixel type, exiting.")
-            err.setIcon(QtWidgets.QMessageBox.Warning)
-            err.setStandardButtons(QtWidgets.QMessageBox.Ok)
-            err.setDefaultButton(QtWidgets.QMessageBox.Ok)
-            err.exec_()
-            return
+            # JDP raise rather than popping up a dialog, so scripts never hang. The GUI shows the error itself.
+            raise ValueError('Your SPE file has an unrecognised pixel type: ' + str(pixeltype))
         return pixeltype_np, pixelsize
 
-    @staticmethod
-    def slice_data(datastore, data_in, data_out):
-        """Slice a data array into a consistent shape.
+    def combine_frames(self, frames, datastore, flag):
+        """Turn the frames read from an .spe file into the data array and put it in datastore.
 
-         For most cases will slice to an array of dimensions (1, framewidth), but if the binning isnt to
-         one pixel then this will become (frameheight, framewidth). Keeping that first dimension for future
-         consistency.
+        A single frame is stored as a (frameheight, framewidth) array. Multiple frames are either summed
+        into one (frameheight, framewidth) array if sum_accumulations is set, or stacked into a (frameheight,
+        framewidth, numframes) series if series_accumulations is set, with the time of each frame stored in
+        datastore.timestamps. Both are done as single vectorised operations over all the frames.
+
+        How frames are summed is set by accumulation_mode, see accumulate_frames().
 
         Parameters
-        ----------
+        -----------
+        frames : np array
+            (numframes, frameheight, framewidth) array of frames, normally the view from map_frames().
         datastore : SFGDataStore object
-            Where the framewidth and frameheight are stored for the indexing.
-        data_in :  np array
-            1D array of data read from the data file.
-        data_out : np array
-            (frameheight, framewidth) shaped empty (or zero) array.
+            Where the data is stored to.
+        flag : str
+            Determines where in datastore the data is saved. Possible values "sig", "bg", "ref", "refbg".
 
         Returns
         -----------
-        data_out : np array
-            (frameheight, framewidth) shaped array containing data.
+        data : np array
+            The data that was stored in datastore.
         """
+        data = None
 
-        for i in range(datastore.frameheight):
-            start = int(i) * datastore.framewidth
-            stop = start + datastore.framewidth
-            dataslice = data_in[start:stop]
-            data_out[int(i), :] = dataslice
+        if datastore.numframes == 1:
+            data = frames[0].astype(self.working_dtype)
+            self.assign_data_to_storage(flag, datastore, data)
 
-        return data_out
+        if datastore.numframes > 1 and self.sum_accumulations:
+            data = self.accumulate_frames(frames).astype(self.working_dtype, copy=False)
+            if self.stupidly_verbose:
+                print("Summed frames", data)
+            self.assign_data_to_storage(flag, datastore, data)
+
+        if datastore.numframes > 1 and self.series_accumulations:
+            # JDP frames go along the last axis of the series, with timestamps in another array
+            data = np.moveaxis(frames, 0, -1).astype(self.working_dtype)
+            datastore.timestamps = np.arange(datastore.numframes) * datastore.acqtime
+            if self.stupidly_verbose:
+                print("Series of frames", data)
+            self.assign_data_to_storage(flag, datastore, data)
+
+        return data
+
+    def accumulate_frames(self, frames):
+        """Combine the frames read from an .spe file into a single frame, according to accumulation_mode.
+
+        "sum" just adds the frames. The other modes reject cosmic rays across frames before combining them, and
+        are scaled by the number of frames so the result is on the same scale as the sum:
+
+        "median" takes the median of each pixel over all frames.
+        "sigmaclip" takes the mean of each pixel over the frames within accumulation_sigma standard deviations
+        of its median, with the standard deviation estimated from the median absolute deviation.
+        "min" takes the minimum of each pixel over all frames.
+
+        The frames are worked through in chunks of at most accumulation_chunk_size values, so files with many
+        thousands of frames never need to be read into memory all at once. "sum" and "min" go through blocks
+        of frames, "median" and "sigmaclip" through blocks of pixels across all the frames.
+
+        Parameters
+        -----------
+        frames : np array
+            (numframes, frameheight, framewidth) array of frames, normally the view from map_frames().
+
+        Returns
+        -----------
+        data : np array
+            (frameheight, framewidth) array of the combined frames.
+        """
+        numframes, frameheight, framewidth = np.shape(frames)
+        mode = self.accumulation_mode
+        if mode not in ['sum', 'median', 'sigmaclip', 'min']:
+            print('accumulation_mode of', mode, 'invalid. Possible values are "sum", "median", "sigmaclip", '
+                  '"min". Summing frames instead.')
+            mode = 'sum'
+
+        if mode in ['sum', 'min']:
+            frame_chunk = max(1, self.accumulation_chunk_size // (frameheight * framewidth))
+            data = None
+            for start in range(0, numframes, frame_chunk):
+                block = frames[start:start + frame_chunk]
+                if mode == 'sum':
+                    partial = np.sum(block, axis=0, dtype=np.float64)
+                    data = partial if data is None else data + partial
+                else:
+                    partial = np.min(block, axis=0).astype(np.float64)
+                    data = partial if data is None else np.minimum(data, partial)
+            if mode == 'min':
+                data = data * numframes
+            return data
+
+        # JDP the pixels of each frame are contiguous, so take blocks of pixels through all the frames
+        pixels = np.reshape(frames, (numframes, frameheight * framewidth))
+        pixel_chunk = max(1, self.accumulation_chunk_size // numframes)
+        data = np.zeros(frameheight * framewidth)
+        for start in range(0, frameheight * framewidth, pixel_chunk):
+            block = pixels[:, start:start + pixel_chunk].astype(np.float64)
+            median = np.median(block, axis=0)
+            if mode == 'median':
+                data[start:start + pixel_chunk] = median
+            else:
+                spread = 1.4826 * np.median(np.abs(block - median), axis=0)
+                keep = np.abs(block - median) <= self.accumulation_sigma * spread
+                data[start:start + pixel_chunk] = np.sum(block * keep, axis=0) / np.sum(keep, axis=0)
+        return np.reshape(data * numframes, (frameheight, framewidth))
 
     @staticmethod
     def assign_data_to_storage(flag, datastore, data):
@@ -1050,36 +3219,42 @@ class SFGProcessTools:
             print('Could not identify data type, so could not assign to a datastore. Check typos in the flag given.')
         return
 
-    def process_spe2x(self, binaryfile, datastore, flag):
+    def process_spe2x(self, spefile, datastore, flag):
         """Process data from an SPE 2.x file and put it in the relevant datastore.
 
         Reads the SPE file at the places defined in the binary header. The output data is in the shape (
         frameheight, framewidth), so is normally (1, n) for a standard spectrum. Extra dimensions are added
-        if the full chip is read out, or if there is more than one frame in the SPE file.
+        if the full chip is read out, or if there is more than one frame in the SPE file. The frames are read
+        from a zero-copy view of the memory-mapped file given by map_frames().
 
         ftp://ftp.piacton.com/Public/Manuals/Princeton%20Instruments/SPE%203.0%20File%20Format%20Specification%20Issue%206%20(4411-0140).pdf
         Most of the options are class attributes and set externally by the GUI and not passed directly.
 
         Parameters
         -----------
-        binaryfile : binary file object
-            The opened .spe file to be processed.
+        spefile : np.memmap
+            The .spe file to be processed, mapped with map_spe().
         datastore : SFGDataStore object
             Where the data is stored to.
         flag : str
             Determines where in datastore the data is saved. Possible values "sig", "bg", "ref", "refbg".
         """
 
+        # JDP decode the whole binary header in one go
+        header = self.decode_spe_header(spefile)
+
         # JDP make sure you cast things to 32bit integers to avoid overflows
-        datastore.framewidth = self.read_at(binaryfile, self.framewidth_loc, 1, np.uint16)[0].astype(int)
-        datastore.frameheight = self.read_at(binaryfile, self.frameheight_loc, 1, np.uint16)[0].astype(int)
-        datastore.numframes = self.read_at(binaryfile, self.numframes_loc, 1, np.int32)[0].astype(int)
-        pixeltype = self.read_at(binaryfile, self.pixeltype_loc, 1, np.int16)[0]
+        datastore.framewidth = header['framewidth'].astype(int)
+        datastore.frameheight = header['frameheight'].astype(int)
+        datastore.numframes = header['numframes'].astype(int)
+        pixeltype = header['pixeltype']
         pixeltype_np, pixelsize = self.get_pixel_type(pixeltype)
         npixels = datastore.framewidth * datastore.frameheight
         framestride = npixels * pixelsize
-        acqtime = self.read_at(binaryfile, self.acqtime_loc, 1, np.float32)[0]
+        acqtime = header['acqtime']
         self.assign_acqtime_to_storage(flag, datastore, acqtime)
+        frames = self.map_frames(spefile, self.data_offset_loc_loc, datastore.numframes, datastore.frameheight,
+                                 datastore.framewidth, framestride, pixeltype_np)
 
         if self.stupidly_verbose:
             print("Width of frame is", datastore.framewidth, "pixels.")
@@ -1095,140 +3270,199 @@ class SFGProcessTools:
                 print("Your data is not in n x 1 format.")
 
         # JDP read the data from location 4100 onwards - size is width x height as usual.
-        if datastore.numframes == 1:
-            # JDP read data into a temporary array
-            data_temp = self.read_at(binaryfile, self.data_offset_loc_loc, npixels, pixeltype_np)
-            # JDP create empty array for final data
-            data = np.zeros((datastore.frameheight, datastore.framewidth))
-            # JDP slice up data_temp into the array
-            data = self.slice_data(datastore, data_temp, data)
-            # JDP write to the datastore class
-            self.assign_data_to_storage(flag, datastore, data)
-
-        if datastore.numframes > 1 and self.sum_accumulations:
-            # JDP create empty array for final summed data
-            data = np.zeros((datastore.framewidth, datastore.frameheight))
-            for i in range(datastore.numframes):
-                # JDP read data into a temporary array
-                data_temp = self.read_at(binaryfile, self.data_offset_loc_loc + (int(i) * framestride),
-                                         npixels, pixeltype_np)
-
-                # JDP make a temporary array to hold the data being summed in each iteration
-                data_sum = np.zeros((datastore.frameheight, datastore.framewidth))
-                # JDP slice up data into the sum array
-                data_sum = self.slice_data(datastore, data_temp, data_sum)
-                # JDP add data from each frame into the array
-                data = data + data_sum
-
-                if self.stupidly_verbose:
-                    print("Current frame", data_sum)
-                    print("Running summation", data)
-
-            self.assign_data_to_storage(flag, datastore, data)
-
-        if datastore.numframes > 1 and self.series_accumulations:
-            data_series = np.zeros((datastore.framewidth, datastore.frameheight, datastore.numframes))
-            datastore.timestamps = np.zeros(datastore.numframes)
-            for i in range(datastore.numframes):
-                # JDP read data into a temporary array
-                data_temp = self.read_at(binaryfile, self.data_offset_loc_loc + (int(i) * framestride),
-                                         npixels, pixeltype_np)
-                # JDP slice up data if needed
-                data_sliced = np.zeros((datastore.frameheight, datastore.framewidth))
-                data_sliced = self.slice_data(datastore, data_temp, data_sliced)
-
-                # JDP add the sliced data to the series array with timestamps in another array
-                data_series[:, :, int(i)] = data_sliced
-                datastore.timestamps[int(i)] = int(i) * datastore.acqtime
-                if self.stupidly_verbose:
-                    print("Current frame", data_sliced)
-                    print("Running series", data_series)
-
-            self.assign_data_to_storage(flag, datastore, data_series)
+        data = self.combine_frames(frames, datastore, flag)
 
         if self.stupidly_verbose:
             print("Shape of data array: ", np.shape(data))
             print("Data array:", data)
 
+        datastore.xaxis = self.spe2x_xaxis(header)
+
+        # JDP this error is more of a warning.
+        if np.size(datastore.xaxis) != np.shape(data)[1]:
+            print("Error, the wavelength axis length is", np.size(datastore.xaxis), "elements",
+                  "but the data is", np.size(data), "elements.")
+
+        return
+
+    def spe2x_xaxis(self, header):
+        """Work out the energy axis of an SPE 2.x file from the calibration stored in its binary header.
+
+        Parameters
+        -----------
+        header : np.void
+            The decoded binary header, from decode_spe_header().
+
+        Returns
+        -----------
+        xaxis : np array
+            Energy axis in wavenumbers, one value per pixel across the frame.
+        """
         # JDP in SPE 2.x they don't store the wavelengths as an array, but give you polynomial coefficients
         # JDP for a function that will produce them on a given x axis.
-        calib_polyorder = int(self.read_at(binaryfile, 3101, -1, np.int8)[0])
+        calib_polyorder = int(header['calib_polyorder'])
 
         # JDP get the coefficients and flip them into the right order for np.polyval, which needs them like
         # JDP a,b,c where it's ax^2+bx+c or whatever, +1 on the end because by default numpy doesn't read
         # JDP the stopping point
-        calib_polycoeffs = np.flipud(self.read_at(binaryfile, 3263, -1, np.float64)[0:calib_polyorder + 1])
+        calib_polycoeffs = np.flipud(header['calib_polycoeffs'][0:calib_polyorder + 1])
 
         if self.stupidly_verbose:
             print("Calibration coefficients from spectrograph (from highest degree down) are:", calib_polycoeffs)
 
         # JDP creating an x axis with the width of the frame to evaluate the polynomial over
         # JDP starts at 1 and not 0  (checked with real data)
-        wavelength_x = np.arange(1, datastore.framewidth + 1)
+        wavelength_x = np.arange(1, int(header['framewidth']) + 1)
 
         # JDP evaluate the polynomial with coefficients above on this axis to get the wavelength axis
         # JDP i think theres a new polynomial API in numpy now but whatever.
         wavelength_axis = np.polyval(calib_polycoeffs, wavelength_x)
 
-        datastore.xaxis = self.nm_to_cm(wavelength_axis)
-
         if self.stupidly_verbose:
             print("Wavelength axis :", wavelength_axis)
 
-        # JDP this error is more of a warning.
-        if np.size(wavelength_axis) != np.size(data[0]):
-            print("Error, the wavelength axis length is", np.size(wavelength_axis), "elements",
+        xaxis = self.nm_to_cm(wavelength_axis)
+        return xaxis
+
+    @staticmethod
+    def get_window(data, n_base=10, n_dev=2):
+        """UNUSED. Get the indices of the reference array where spectral intensity is non-zero.
+
+        It's a bit of a clunkfest and not very reliable.
+
+        NOT IMPLEMENTED IN V1.0"""
+        cat = np.concatenate((data[0:n_base], data[-n_base:-1]))
+        base = np.mean(cat)
+        dev = np.std(cat)
+        threshold = base + (n_dev * dev)
+        edgestart = int(np.argwhere(data > (base + threshold))[0])
+        edgestop = int(np.argwhere(data > (base + threshold))[-1])
+        return edgestart, edgestop
+
+    def process_spe3x(self, spefile, datastore, flag):
+        """Process data from an SPE 3.0 file and put it in the relevant datastore.
+
+        Reads the SPE file at the places defined in the XML footer. The output data is in the shape (
+        frameheight, framewidth), so is normally (1, n) for a standard spectrum. Extra dimensions are added
+        if the full chip is read out, or if there is more than one frame in the SPE file. The frames are read
+        from a zero-copy view of the memory-mapped file given by map_frames().
+
+        Most of the options are class attributes and set externally by the GUI and not passed directly.
+
+        ftp://ftp.piacton.com/Public/Manuals/Princeton%20Instruments/SPE%203.0%20File%20Format%20Specification%20Issue%206%20(4411-0140).pdf
+
+        Parameters
+        -----------
+        spefile : np.memmap
+            The .spe file to be processed, mapped with map_spe().
+        datastore : SFGDataStore object
+            Where the data is stored to.
+        flag : str
+            Determines where in datastore the data is saved. Possible values "sig", "bg", "ref", "refbg".
+        """
+        # JDP function for processing SPE 3.0 or later
+        # JDP moves to the position of the footer in the binary file, this is described in the manual
+        footer_offset_loc = self.decode_spe_header(spefile)['footer_offset']
+        # JDP reading the position of the XML footer in bytes (varies depending on data size)
+        xmlfooter = spefile[int(footer_offset_loc):].tobytes()
+
+        # JDP unpack the xmlfooter into an elementtree object
+        xmltree = etree.fromstring(xmlfooter)
+
+        framewidth, frameheight, numframes, framestride, pixeltype, acqtime = self.decode_spe3x_footer(xmltree)
+        datastore.framewidth = framewidth
+        datastore.frameheight = frameheight
+        datastore.numframes = numframes
+        pixeltype_np, pixelsize = self.get_pixel_type(pixeltype)
+        self.assign_acqtime_to_storage(flag, datastore, acqtime)
+        frames = self.map_frames(spefile, self.data_offset_loc_loc, datastore.numframes, datastore.frameheight,
+                                 datastore.framewidth, framestride, pixeltype_np)
+        if self.stupidly_verbose:
+            print("Width of frame is", datastore.framewidth, "pixels.")
+            print("Height of frame is", datastore.frameheight, "pixels.")
+            print("Number of frames is", datastore.numframes)
+            print("Pixel size is", pixelsize, "bytes.")
+            print("Frame size is", framestride, "bytes")
+            print("Acquisition time per frame is:", datastore.acqtime, "s.")
+            print("Total acquisition time is:", datastore.acqtime * datastore.numframes, "s.")
+
+        if datastore.frameheight > 1:
+            print("Your data is not in n x 1 format, it will process correctly but the plotting/writing "
+                  "may not work as intended if you're in the GUI.")
+
+        data = self.combine_frames(frames, datastore, flag)
+
+        datastore.xaxis = self.spe3x_xaxis(xmltree)
+        if self.stupidly_verbose:
+            print("Shape of data array: ", np.shape(data))
+            print("Data array:", data)
+
+        if np.size(datastore.xaxis) != np.shape(data)[1]:
+            print("ERROR, the wavelength axis length is", np.size(datastore.xaxis), "elements",
                   "but the data is", np.size(data), "elements.")
 
         return
 
-    @staticmethod
-    def get_window(data, n_base=10, n_dev=2):
-        """UNUSED. Get the indices of the reference array where spectral intensity is non-zero.
+    def spe3x_xaxis(self, xmltree):
+        """Work out the energy axis of an SPE 3.0 file from the calibration stored in its XML footer.
 
-        It's a bit of a clunkfest and not very reliable.
+        Parameters
+        -----------
+        xmltree : lxml.etree.Element
+            The root element of the XML footer.
 
-        NOT IMPLEMENTED IN V1.0"""
-        cat = np.concatenate((data[0:n_base], data[-n_base:-1]))
-        base = np.mean(cat)
-        dev = np.std(cat)
-        threshold = base + (n_dev * dev)
-        edgestart = int(np.argwhere(data > (base + threshold))[0])
-        edgestop = int(np.argwhere(data > (base + threshold))[-1])
-        return edgestart, edgestop
+        Returns
+        -----------
+        xaxis : np array
+            Energy axis in wavenumbers, one value per pixel across the region of interest.
+        """
+        xmlns = '{http://www.princetoninstruments.com/spe/2009}'
 
-    def process_spe3x(self, binaryfile, datastore, flag):
-        """Process data from an SPE 3.0 file and put it in the relevant datastore.
+        # JDP look through the tree to find the calibration
+        calib = xmltree.find(xmlns+'Calibrations')
 
-        Reads the SPE file at the places defined in the XML footer. The output data is in the shape (
-        frameheight, framewidth), so is normally (1, n) for a standard spectrum. Extra dimensions are added
-        if the full chip is read out, or if there is more than one frame in the SPE file.
+        # JDP find the part that is the wavelength axis
+        wavelength = np.fromstring(calib[0].findall(xmlns+'Wavelength')[0].text, sep=',')
 
-        Most of the options are class attributes and set externally by the GUI and not passed directly.
+        # JDP this axis covers the whole sensor which isn't necessarily the bit you want for the ROI
+        wavelength_leftedge = int(calib[2].attrib['x'])
+        wavelength_rightedge = wavelength_leftedge + int(calib[2].attrib['width'])
 
-        ftp://ftp.piacton.com/Public/Manuals/Princeton%20Instruments/SPE%203.0%20File%20Format%20Specification%20Issue%206%20(4411-0140).pdf
+        # JDP select the portion of the calibration that covers the region you're actually using
+        wavelength_axis = wavelength[wavelength_leftedge:wavelength_rightedge]
+        if self.stupidly_verbose:
+            print("Size of wavelength axis:", np.shape(wavelength_axis))
+            print("Wavelength axis :", wavelength_axis)
+
+        xaxis = self.nm_to_cm(wavelength_axis)
+        return xaxis
+
+    def decode_spe3x_footer(self, xmltree):
+        """Decode the frame geometry, pixel type and exposure time from the XML footer of an SPE 3.0 file.
 
         Parameters
         -----------
-        binaryfile : binary file object
-            The opened .spe file to be processed.
-        datastore : SFGDataStore object
-            Where the data is stored to.
-        flag : str
-            Determines where in datastore the data is saved. Possible values "sig", "bg", "ref", "refbg".
-        """
-        # JDP function for processing SPE 3.0 or later
-        # JDP moves to the position of the footer in the binary file, this is described in the manual
-        footer_offset_loc = self.read_at(binaryfile, self.footer_offset_loc_loc, -1, np.uint64)[0]
-        # JDP reading the position of the XML footer in bytes (varies depending on data size)
-        binaryfile.seek(footer_offset_loc)
-        xmlfooter = binaryfile.read()
+        xmltree : lxml.etree element
+            The parsed XML footer.
 
+        Returns
+        -----------
+        framewidth : int
+            Width of the (first) ROI in pixels.
+        frameheight : int
+            Height of the (first) ROI in pixels.
+        numframes : int
+            Number of frames stored in the file.
+        framestride : int
+            Distance (in bytes) from the start of one frame to the start of the next.
+        pixeltype : str
+            Pixel format string, to be decoded by get_pixel_type().
+        acqtime : float
+            Exposure time of each frame in seconds.
+        """
         # JDP creating the two namespaces needed for the useful stuff
         xmlns = '{http://www.princetoninstruments.com/spe/2009}'
         xmlexpns = '{http://www.princetoninstruments.com/experiment/2009}'
-        # JDP unpack the xmlfooter into an elementtree object
-        xmltree = etree.fromstring(xmlfooter)
 
         # JDP find the dataformat child within the xmltree (all data is a child of this)
         dataformat = xmltree.find(xmlns+'DataFormat')
@@ -1261,93 +3495,35 @@ class SFGProcessTools:
             print("Attributes of the ROI")
             print(roi.attrib)
 
-        datastore.framewidth = int(roi.attrib['width'])
-        datastore.frameheight = int(roi.attrib['height'])
+        framewidth = int(roi.attrib['width'])
+        frameheight = int(roi.attrib['height'])
         framestride = int(frame.attrib['stride'])
-        datastore.numframes = int(frame.attrib['count'])
+        numframes = int(frame.attrib['count'])
         pixeltype = frame.attrib['pixelFormat']
-        pixeltype_np, pixelsize = self.get_pixel_type(pixeltype)
-        npixels = datastore.framewidth * datastore.frameheight
         acqtime = np.float32(xmltree.findall('.//' + xmlexpns + 'ExposureTime')[0].text) / 1000
-        self.assign_acqtime_to_storage(flag, datastore, acqtime)
-        if self.stupidly_verbose:
-            print("Width of frame is", datastore.framewidth, "pixels.")
-            print("Height of frame is", datastore.frameheight, "pixels.")
-            print("Number of frames is", datastore.numframes)
-            print("Pixel size is", pixelsize, "bytes.")
-            print("Frame size is", framestride, "bytes")
-            print("Acquisition time per frame is:", datastore.acqtime, "s.")
-            print("Total acquisition time is:", datastore.acqtime * datastore.numframes, "s.")
-
-        if datastore.frameheight > 1:
-            print("Your data is not in n x 1 format, it will process correctly but the plotting/writing "
-                  "may not work as intended if you're in the GUI.")
-
-        if datastore.numframes > 1 and self.sum_accumulations:
-            data = np.zeros((datastore.frameheight, datastore.framewidth))
-
-            for i in range(datastore.numframes):
-                data_temp = self.read_at(binaryfile, self.data_offset_loc_loc+(int(i)*framestride),
-                                         npixels, pixeltype_np)
-
-                data_sum = np.zeros((datastore.frameheight, datastore.framewidth))
-                data_sum = self.slice_data(datastore, data_temp, data_sum)
-                data = data + data_sum
-
-                if self.stupidly_verbose:
-                    print("Current frame", data_temp)
-                    print("Running summation", data_sum)
-
-            self.assign_data_to_storage(flag, datastore, data)
-
-        if datastore.numframes > 1 and self.series_accumulations:
-            data_series = np.zeros((datastore.frameheight, datastore.framewidth, datastore.numframes))
-            datastore.timestamps = np.zeros(datastore.numframes)
-            for i in range(datastore.numframes):
-                data_temp = self.read_at(binaryfile, self.data_offset_loc_loc+(int(i)*framestride),
-                                         npixels, pixeltype_np)
-                data_sliced = np.zeros((datastore.frameheight, datastore.framewidth))
-                self.slice_data(datastore, data_temp, data_sliced)
-
-                data_series[:, :, int(i)] = data_temp
-                datastore.timestamps[int(i)] = int(i) * datastore.acqtime
-                if self.stupidly_verbose:
-                    print("Current frame", data_temp)
-                    print("Running series", data_series)
-
-            data = data_series
-            self.assign_data_to_storage(flag, datastore, data)
-
-        if datastore.numframes == 1:
-            data_temp = self.read_at(binaryfile, self.data_offset_loc_loc, npixels, pixeltype_np)
-            data = np.zeros((datastore.frameheight, datastore.framewidth))
-            data = self.slice_data(datastore, data_temp, data)
-            self.assign_data_to_storage(flag, datastore, data)
-
-        # JDP look through the tree to find the calibration
-        calib = xmltree.find(xmlns+'Calibrations')
-
-        # JDP find the part that is the wavelength axis
-        wavelength = np.fromstring(calib[0].findall(xmlns+'Wavelength')[0].text, sep=',')
 
-        # JDP this axis covers the whole sensor which isn't necessarily the bit you want for the ROI
-        wavelength_leftedge = int(calib[2].attrib['x'])
-        wavelength_rightedge = wavelength_leftedge + int(calib[2].attrib['width'])
+        return framewidth, frameheight, numframes, framestride, pixeltype, acqtime
 
-        # JDP select the portion of the calibration that covers the region you're actually using
-        wavelength_axis = wavelength[wavelength_leftedge:wavelength_rightedge]
-        datastore.xaxis = self.nm_to_cm(wavelength_axis)
-        if self.stupidly_verbose:
-            print("Size of wavelength axis:", np.shape(wavelength_axis))
-            print("Wavelength axis :", wavelength_axis)
-            print("Shape of data array: ", np.shape(data))
-            print("Data array:", data)
+    def read_spe3x_footer(self, fname, footer_offset):
+        """Read only the XML footer of an SPE 3.0 file from disk and parse it.
 
-        if np.size(wavelength_axis) != np.size(data[0]):
-            print("ERROR, the wavelength axis length is", np.size(wavelength_axis), "elements",
-                  "but the data is", np.size(data), "elements.")
+        Parameters
+        -----------
+        fname : str
+            Name of the .spe file.
+        footer_offset : int
+            Location (in bytes) of the footer, as given by the footer_offset field of the binary header.
 
-        return
+        Returns
+        -----------
+        xmltree : lxml.etree element
+            The parsed XML footer.
+        """
+        with open(fname, 'rb') as spefile:
+            spefile.seek(int(footer_offset))
+            xmlfooter = spefile.read()
+        xmltree = etree.fromstring(xmlfooter)
+        return xmltree
 
     @staticmethod
     def nm_to_cm(data):
@@ -1421,6 +3597,10 @@ class SFGProcessTools:
         then these are defined as the background. If not, then the nearest background file to the signal
         file (in terms of creation time) is chosen.
 
+        Every signal file is checked for a background by name. Older versions only did this for the last
+        signal file in the list and matched the rest by time, so files processed with them may have been
+        paired with a different background.
+
         Could be updated to include some way of strictly matching polarisations, rather than implicitly as
         here.
 
@@ -1434,24 +3614,20 @@ class SFGProcessTools:
             The directory containing the background and signal filenames.
 
         """
-        length = len(filenames)
-        bg_list_matched = [None] * length
+        # JDP look up backgrounds by the name they would have without the bg string
+        bg_by_name = {}
+        for bgfile in bg_filenames:
+            bg_by_name[pathlib.Path(bgfile).name.replace(self.bg_string, '')] = bgfile
 
-        for sigindex, sigfile in enumerate(filenames):
-            signame = pathlib.Path(sigfile).name
-        for bgindex, bgfile in enumerate(bg_filenames):
-            bgname = pathlib.Path(bgfile).name
-            bgname_nobg = bgname.replace(self.bg_string, '')
-            if bgname_nobg == signame:
-                bg_list_matched[sigindex] = bgfile
+        bg_list_matched = [bg_by_name.get(pathlib.Path(sigfile).name) for sigfile in filenames]
 
-        if None in bg_list_matched:
-            for index, bgfile in enumerate(bg_list_matched):
-                if bgfile is None:
-                    signame = directory + filenames[index]
-                    bgs = [directory + bg for bg in bg_filenames]
-                    bg_match = self.get_closest_file(bgs, signame)
-                    bg_list_matched[index] = str(pathlib.Path(bg_match).name)
+        unmatched = [index for index, bgfile in enumerate(bg_list_matched) if bgfile is None]
+        if unmatched:
+            sig_times = self.get_file_mtimes(directory, [filenames[index] for index in unmatched])
+            bg_times = self.get_file_mtimes(directory, bg_filenames)
+            closest = self.find_closest_times(sig_times, bg_times)
+            for index, bgindex in zip(unmatched, closest):
+                bg_list_matched[index] = str(pathlib.Path(bg_filenames[bgindex]).name)
 
         return bg_list_matched
 
@@ -1480,13 +3656,10 @@ class SFGProcessTools:
         sig_ref_id : list
             Contains the refID of the reference file that each signal file needs to be normalised to.
         """
-        sig_ref_id = [None] * len(sig_filenames)
-        for index, sigfile in enumerate(sig_filenames):
-            signame = directory + sigfile
-            refs = [directory + ref for ref in ref_filenames]
-            ref_match = self.get_closest_file(refs, signame)
-            ref_id_index = ref_filenames.index(str(pathlib.Path(ref_match).name))
-            sig_ref_id[index] = ref_id[ref_id_index]
+        sig_times = self.get_file_mtimes(directory, sig_filenames)
+        ref_times = self.get_file_mtimes(directory, ref_filenames)
+        closest = self.find_closest_times(sig_times, ref_times)
+        sig_ref_id = [ref_id[i] for i in closest]
 
         return sig_ref_id
 
@@ -1518,9 +3691,14 @@ class SFGProcessTools:
             The number of each reference file used (for display in GUI).
         """
 
-        ref_matched = [ref_filenames[ref_id.index(i)] for i in sig_ref_id]
-        refbg_matched = [ref_bg_filenames[ref_id.index(i)] for i in sig_ref_id]
-        ref_num = [ref_id.index(i)+1 for i in sig_ref_id]
+        # JDP position of the first reference with each refID, equivalent to ref_id.index() but built once
+        ref_position = {}
+        for position, i in enumerate(ref_id):
+            ref_position.setdefault(i, position)
+
+        ref_matched = [ref_filenames[ref_position[i]] for i in sig_ref_id]
+        refbg_matched = [ref_bg_filenames[ref_position[i]] for i in sig_ref_id]
+        ref_num = [ref_position[i]+1 for i in sig_ref_id]
 
         return ref_matched, refbg_matched, ref_num
 
@@ -1749,7 +3927,8 @@ class SFGDataStore():
                      'signal_normalised', 'exp_divided_sig', 'exp_divided_bg',
                      'exp_divided_ref',
                      'exp_divided_refbg',  'cosmic_sig', 'cosmic_bg', 'cosmic_ref',
-                     'cosmic_refbg', 'filename_sig', 'filename_bg', 'filename_ref', 'filename_refbg', 'verbose', 'stupidly_verbose']
+                     'cosmic_refbg', 'filename_sig', 'filename_bg', 'filename_ref', 'filename_refbg', 'verbose', 'stupidly_verbose',
+                     'dtype', 'lean', 'keep_intermediates']
 
         def __init__(self):
             self.sample = None
@@ -1790,14 +3969,59 @@ class SFGDataStore():
             self.cosmic_sig = False
             self.cosmic_bg = False
             self.cosmic_ref = False
-            self.cosmic_bg = False
+            self.cosmic_refbg = False
             self.filename_sig = 'NoSignal'
             self.filename_bg = 'NoBackground'
             self.filename_ref = 'NoReference'
             self.filename_refbg = 'NoReferenceBackground'
             self.verbose = False
             self.stupidly_verbose = False
+            # JDP floating point type the arithmetic is done in, set from SFGProcessTools.working_dtype
+            self.dtype = np.float64
+            # JDP set from SFGProcessTools.lean_memory and keep_intermediates, see lean_buffer()
+            self.lean = False
+            self.keep_intermediates = []
+
+
+        def lean_buffer(self, data, name=None):
+            """Return the array that the next processing step can write its result into, in lean mode.
+
+            In lean mode each step of the processing chain overwrites the array it started from, rather than
+            allocating a new one, and the earlier stage is dropped with drop_intermediate(). Only arrays this
+            datastore owns outright are overwritten, arrays shared with the read cache or an SFGBatchStore
+            (or of a different type to dtype) are left alone and NumPy allocates a new one as usual.
+
+            Parameters
+            -----------
+            data : np.ndarray
+                The array the step starts from.
+            name : str, optional
+                Attribute that data is stored in. If it is listed in keep_intermediates then data is never
+                overwritten.
+
+            Returns
+            -----------
+            out : np.ndarray or None
+                data if it can be overwritten, otherwise None.
+            """
+            if not self.lean or name in self.keep_intermediates:
+                return None
+            if isinstance(data, np.ndarray) and data.base is None and data.flags.writeable \
+                    and data.dtype == self.dtype:
+                return data
+            return None
 
+        def drop_intermediate(self, name):
+            """In lean mode, free the named stage of the processing chain unless it is in keep_intermediates.
+
+            Parameters
+            -----------
+            name : str
+                Attribute to drop, e.g. "signal_raw".
+            """
+            if self.lean and name not in self.keep_intermediates:
+                setattr(self, name, None)
+            return
 
         def print_attributes(self):
             """Print the attributes of datastore attractively."""
@@ -1875,7 +4099,10 @@ class SFGDataStore():
                         'really want to subtract twice.')
                     return
 
-                self.signal_subtracted = self.signal_raw - self.background
+                self.signal_subtracted = np.subtract(self.signal_raw, self.background,
+                                                     out=self.lean_buffer(self.signal_raw, 'signal_raw'),
+                                                     dtype=self.dtype)
+                self.drop_intermediate('signal_raw')
                 self.background_subtracted = True
                 if self.verbose:
                    print('Background subtracted from the signal data.')
@@ -1884,12 +4111,17 @@ class SFGDataStore():
                 if self.signal_subtracted is not None:
                     if self.stupidly_verbose:
                         print("Note, you are subtracting the background twice.")
-                    self.signal_subtracted = self.signal_subtracted - self.background
+                    self.signal_subtracted = np.subtract(self.signal_subtracted, self.background,
+                                                         out=self.lean_buffer(self.signal_subtracted, 'signal_subtracted'),
+                                                         dtype=self.dtype)
                     self.background_subtracted = True
                     if self.verbose:
                         print('Background subtracted from the signal data.')
                 else:
-                    self.signal_subtracted = self.signal_raw - self.background
+                    self.signal_subtracted = np.subtract(self.signal_raw, self.background,
+                                                         out=self.lean_buffer(self.signal_raw, 'signal_raw'),
+                                                         dtype=self.dtype)
+                    self.drop_intermediate('signal_raw')
                     self.background_subtracted = True
                     if self.verbose:
                         print('Background subtracted from the signal data.')
@@ -1920,7 +4152,10 @@ class SFGDataStore():
                         'really want to subtract twice.')
                     return
 
-                self.ref_subtracted = self.ref_raw - self.ref_bg
+                self.ref_subtracted = np.subtract(self.ref_raw, self.ref_bg,
+                                                  out=self.lean_buffer(self.ref_raw, 'ref_raw'),
+                                                  dtype=self.dtype)
+                self.drop_intermediate('ref_raw')
                 self.refbackground_subtracted = True
                 if self.verbose:
                     print('Background subtracted from the reference data.')
@@ -1929,12 +4164,17 @@ class SFGDataStore():
                 if self.ref_subtracted is not None:
                     if self.stupidly_verbose:
                         print('Note, you are subtracting the reference background twice.')
-                    self.ref_subtracted = self.ref_subtracted - self.ref_bg
+                    self.ref_subtracted = np.subtract(self.ref_subtracted, self.ref_bg,
+                                                      out=self.lean_buffer(self.ref_subtracted, 'ref_subtracted'),
+                                                      dtype=self.dtype)
                     self.refbackground_subtracted = True
                     if self.verbose:
                         print('Background subtracted from the reference data.')
                 else:
-                    self.ref_subtracted = self.ref_raw - self.ref_bg
+                    self.ref_subtracted = np.subtract(self.ref_raw, self.ref_bg,
+                                                      out=self.lean_buffer(self.ref_raw, 'ref_raw'),
+                                                      dtype=self.dtype)
+                    self.drop_intermediate('ref_raw')
                     self.refbackground_subtracted = True
                     if self.verbose:
                         print('Background subtracted from the reference data.')
@@ -1968,12 +4208,18 @@ class SFGDataStore():
                     return
 
                 if self.background_subtracted:
-                    self.signal_normalised = self.signal_subtracted / reference
+                    self.signal_normalised = np.divide(self.signal_subtracted, reference,
+                                                       out=self.lean_buffer(self.signal_subtracted, 'signal_subtracted'),
+                                                       dtype=self.dtype)
+                    self.drop_intermediate('signal_subtracted')
                     self.normalised = True
                     if self.verbose:
                         print('Signal data successfully normalised.')
                 else:
-                    self.signal_normalised = self.signal_raw / reference
+                    self.signal_normalised = np.divide(self.signal_raw, reference,
+                                                       out=self.lean_buffer(self.signal_raw, 'signal_raw'),
+                                                       dtype=self.dtype)
+                    self.drop_intermediate('signal_raw')
                     self.normalised = True
                     if self.verbose:
                         print('Signal data successfully normalised.')
@@ -1982,18 +4228,26 @@ class SFGDataStore():
                 if self.normalised:
                     if self.stupidly_verbose:
                         print('Note, you are normalising twice.')
-                    self.signal_normalised = self.signal_normalised / reference
+                    self.signal_normalised = np.divide(self.signal_normalised, reference,
+                                                       out=self.lean_buffer(self.signal_normalised, 'signal_normalised'),
+                                                       dtype=self.dtype)
                     self.normalised = True
                     if self.verbose:
                         print('Signal data successfully normalised (more than once, r u srs).')
                 else:
                     if self.background_subtracted:
-                        self.signal_normalised = self.signal_subtracted / reference
+                        self.signal_normalised = np.divide(self.signal_subtracted, reference,
+                                                           out=self.lean_buffer(self.signal_subtracted, 'signal_subtracted'),
+                                                           dtype=self.dtype)
+                        self.drop_intermediate('signal_subtracted')
                         self.normalised = True
                         if self.verbose:
                             print('Signal data successfully normalised.')
                     else:
-                        self.signal_normalised = self.signal_raw / reference
+                        self.signal_normalised = np.divide(self.signal_raw, reference,
+                                                           out=self.lean_buffer(self.signal_raw, 'signal_raw'),
+                                                           dtype=self.dtype)
+                        self.drop_intermediate('signal_raw')
                         self.normalised = True
                         if self.verbose:
                             print('Signal data successfully normalised.')
@@ -2035,7 +4289,7 @@ class SFGDataStore():
                                                            ' if you really want to divide it twice')
                             return data, flag
                         else:
-                            data = data / time
+                            data = np.divide(data, time, out=self.lean_buffer(data), dtype=self.dtype)
                             flag = True
                             if self.verbose:
                                 print(string + ' data divided by exposure time of ' + str(time) + ' s.')
@@ -2051,7 +4305,7 @@ class SFGDataStore():
                         print('No exposure time for ' + string + ' found. Check SPE file.')
                         return data, flag
                     else:
-                        data = data / time
+                        data = np.divide(data, time, out=self.lean_buffer(data), dtype=self.dtype)
                         flag = True
                         if self.verbose:
                             print(string + ' data divided by exposure time of ' + str(time) + ' s.')
@@ -2120,6 +4374,7 @@ class SFGDataStore():
                 else:
                     x_base = np.arange(0, np.size(self.xaxis_raw), 1)
                     self.xaxis = np.polynomial.polynomial.polyval(x_base, calibration_offset)
+                    self.calibrated = True
                     if self.verbose:
                         print('Calibration of degree '+str(degree)+' applied, coefficients used: '+np.array2string(calibration_offset, separator=',')[1:-1])
 
@@ -2155,49 +4410,96 @@ class SFGDataStore():
                             print('Calibration of degree '+str(degree)+' applied, coefficients used: '+np.array2string(calibration_offset, separator=',')[1:-1])
 
                 self.calibrated = True
+            self.applied_calibration = calibration_offset
             return
 
         @staticmethod
-        def cosmic_ray_killer(data, threshold, max_width):
+        def cosmic_ray_killer(data, threshold, max_width, axis=1):
             """Remove cosmic ray contributions from data.
 
-            Algorithm from Steven J Roeters. Not thoroughly tested but implemented for future use.
+            Based on the algorithm from Steven J Roeters, vectorised so that every row (and frame) of the data
+            is done at once. The running median of each spectrum is taken over 4*max_width + 1 pixels, so that
+            neither a spike nor the edge of a real peak can drag it up. The noise of each spectrum is estimated
+            robustly as 1.4826 times the median absolute deviation of the spectrum from its running median
+            (the standard deviation, for Gaussian noise), and a pixel is part of a spike if it is more than
+            threshold times the noise above the running median. The threshold is therefore independent of the
+            counts in the data. Runs of spike pixels wider than max_width are kept as real signal, the rest are
+            replaced by linear interpolation between the good pixels either side of them.
 
-            Questionably robust method for doing it that might just require endless tweaking.
+            Note that threshold used to be an absolute height in counts, with a default of 0.001. Thresholds
+            from then, of much less than 1, would now mark most of the spectrum as spikes.
 
             Parameters
             -----------
                 data : np array
-                    Array containing the data to have cosmic ray contributions removed. Shape (1, width).
+                    Array containing the data to have cosmic ray contributions removed, e.g. shape
+                    (frameheight, framewidth) or (frameheight, framewidth, numframes).
                 threshold : float
-                    Min height above the background signal that a spike has to have to be considered a
-                    cosmic ray.
+                    Min height above the running median that a spike has to have to be considered a cosmic
+                    ray, in multiples of the noise of the spectrum. Around 5 is sensible.
                 max_width : int
                     Anything wider that max_width is considered real signal and not a cosmic ray.
+                axis : int, optional
+                    Axis of data that runs along the spectrum (default 1).
 
             Returns
             ------------
                 data : np array
-                    Data with cosmic ray contributions removed.
+                    Data with cosmic ray contributions removed. Always a new array that owns its memory, the
+                    input is not modified.
                 rays_removed : bool
                     Flag used to keep track of whether or not the data has had cosmic ray contributions
                     removed.
             """
-            print("Killing cosmic rays. Threshold: ", threshold, ". Max width: ", max_width, ".")
-            raycount = 0
-            for i in range(len(data[0]) - int(max_width)):
-                n = 0
-                while data[0][i + n] >= data[0][i] + float(threshold):
-                    n = n + 1
-                    if data[0][i + n] < data[0][i] + float(threshold):
-                        for k in range(n):
-                            raycount = raycount + 1
-                            data[0][i + k] = np.interp(i + k, [i, i + n + 1], [data[0][i], data[0][i + n +
-                                                                                                   1]])
-                    if n == int(max_width):
-                        break
+            # JDP work on a copy with the spectrum along the last axis, the data may be shared with other
+            # JDP datastores through the read cache
+            data = np.array(np.moveaxis(data, axis, -1), dtype=np.result_type(data, np.float32))
+            shape = np.shape(data)
+            spectra = data.reshape(-1, shape[-1])
+            numrows, width = np.shape(spectra)
+            max_width = int(max_width)
+
+            half = min(2 * max_width, width - 1)
+            padded = np.pad(spectra, ((0, 0), (half, half)), mode='reflect')
+            baseline = np.median(np.lib.stride_tricks.sliding_window_view(padded, 2 * half + 1, axis=1), axis=2)
+            residual = spectra - baseline
+            deviation = np.abs(residual - np.median(residual, axis=1, keepdims=True))
+            noise = 1.4826 * np.median(deviation, axis=1, keepdims=True)
+            # JDP more than half the pixels on the median gives no MAD, so fall back to the standard deviation
+            noise = np.where(noise > 0, noise, np.std(residual, axis=1, keepdims=True))
+            spikes = residual > float(threshold) * noise
+
+            # JDP label each run of spike pixels and keep the ones wider than max_width
+            starts = spikes.copy()
+            starts[:, 1:] &= ~spikes[:, :-1]
+            run_id = np.cumsum(starts.ravel()).reshape(numrows, width) * spikes
+            run_length = np.bincount(run_id.ravel())
+            run_length[0] = 0
+            spikes &= run_length[run_id] <= max_width
+
+            if np.any(spikes):
+                # JDP nearest good pixel to the left and right of every pixel, within the same row
+                columns = np.broadcast_to(np.arange(width), (numrows, width))
+                left = np.maximum.accumulate(np.where(spikes, -1, columns), axis=1)
+                right = np.minimum.accumulate(np.where(spikes, width, columns)[:, ::-1], axis=1)[:, ::-1]
+                rows = np.broadcast_to(np.arange(numrows)[:, None], (numrows, width))
+                no_left = left < 0
+                no_right = right >= width
+                left = np.where(no_left, right, left)
+                right = np.where(no_right, left, right)
+                # JDP a row that is all spikes has nothing to interpolate from, so leave it alone
+                spikes &= ~(no_left & no_right)
+                left_value = spectra[rows, np.clip(left, 0, width - 1)]
+                right_value = spectra[rows, np.clip(right, 0, width - 1)]
+                span = np.maximum(right - left, 1)
+                interpolated = left_value + (right_value - left_value) * (columns - left) / span
+                spectra[spikes] = interpolated[spikes]
+
+            # JDP hand back an array that owns its memory rather than a view of one, so that lean_buffer() can
+            # JDP reuse it for the later steps. Only copy if the spectrum isn't along the last axis already.
+            if axis % np.ndim(data) != np.ndim(data) - 1:
+                data = np.moveaxis(data, -1, axis).copy()
             rays_removed = True
-            print("Rays removed:", raycount)
             return data, rays_removed
 
         def remove_cosmic_rays(self, threshold, max_width, flag):
@@ -2208,8 +4510,8 @@ class SFGDataStore():
             Parameters
             -----------
                 threshold : float
-                    Min height above the background signal that a spike has to have to be considered a
-                    cosmic ray.
+                    Min height above the running median that a spike has to have to be considered a cosmic
+                    ray, in multiples of the noise of the spectrum. See cosmic_ray_killer().
                 max_width : int
                     Anything wider that max_width is considered real signal and not a cosmic ray.
                 flag : str
@@ -2239,3 +4541,566 @@ class SFGDataStore():
                 print('Flag of', flag, 'invalid. Possible values are  "sig", "bg, "ref", "refbg", '
                                        '"all". Exiting.')
             return
+
+
+class SFGBatchStore():
+    """This class stores many SFG spectra stacked into single arrays so they can be processed together.
+
+    Where SFGDataStore holds one signal file, SFGBatchStore holds N of them as (N, frameheight, framewidth)
+    arrays, so each processing step is one NumPy operation over the whole batch rather than N small ones.
+    Backgrounds and references are usually shared between many signal files, so each unique background or
+    reference is stored once and the signal files point at theirs through bg_index and ref_index. Use
+    SFGProcessTools.create_batch_store() to fill one from files, and to_datastores() to split the result
+    back into SFGDataStore instances for writing and plotting.
+
+    Every file in a batch must have the same frame size. Series data is not supported directly, but
+    SFGProcessTools.process_series() processes a series a block of frames at a time, with one row per frame.
+    """
+
+    __slots__ = ['directory', 'signal_names', 'bg_names', 'ref_names', 'ref_bg_names', 'xaxis', 'xaxis_raw',
+                 'signal_raw', 'background', 'ref_raw', 'ref_bg', 'ref_subtracted', 'signal_subtracted',
+                 'signal_normalised', 'bg_index', 'ref_index', 'acqtime', 'acqtime_bg', 'acqtime_ref',
+                 'acqtime_refbg', 'framewidth', 'frameheight', 'numframes', 'upconverter_used',
+                 'applied_calibration', 'calibrated', 'downconverted', 'background_subtracted',
+                 'refbackground_subtracted', 'normalised', 'exp_divided', 'cosmic_removed', 'verbose',
+                 'stupidly_verbose', 'dtype']
+
+    def __init__(self):
+        self.directory = None
+        self.signal_names = []
+        self.bg_names = []
+        self.ref_names = []
+        self.ref_bg_names = []
+        self.xaxis = None
+        self.xaxis_raw = None
+        self.signal_raw = None
+        self.background = None
+        self.ref_raw = None
+        self.ref_bg = None
+        self.ref_subtracted = None
+        self.signal_subtracted = None
+        self.signal_normalised = None
+        self.bg_index = None
+        self.ref_index = None
+        self.acqtime = None
+        self.acqtime_bg = None
+        self.acqtime_ref = None
+        self.acqtime_refbg = None
+        self.framewidth = None
+        self.frameheight = None
+        self.numframes = None
+        self.upconverter_used = None
+        self.applied_calibration = None
+        self.calibrated = False
+        self.downconverted = False
+        self.background_subtracted = False
+        self.refbackground_subtracted = False
+        self.normalised = False
+        self.exp_divided = False
+        self.cosmic_removed = False
+        self.verbose = False
+        self.dtype = np.float64
+        self.stupidly_verbose = False
+
+    def __len__(self):
+        """Return the number of signal files in the batch."""
+        return len(self.signal_names)
+
+    def remove_cosmic_rays(self, threshold, max_width):
+        """Remove cosmic rays from every raw spectrum in the batch using SFGDataStore.cosmic_ray_killer().
+
+        Parameters
+        -----------
+        threshold : float
+            Min height above the running median that a spike has to have to be considered a cosmic ray, in
+            multiples of the noise of the spectrum. See SFGDataStore.cosmic_ray_killer().
+        max_width : int
+            Anything wider that max_width is considered real signal and not a cosmic ray.
+        """
+        if self.signal_raw is not None:
+            self.signal_raw = SFGDataStore.cosmic_ray_killer(self.signal_raw, threshold, max_width, axis=2)[0]
+        if self.background is not None:
+            self.background = SFGDataStore.cosmic_ray_killer(self.background, threshold, max_width, axis=2)[0]
+        if self.ref_raw is not None:
+            self.ref_raw = SFGDataStore.cosmic_ray_killer(self.ref_raw, threshold, max_width, axis=2)[0]
+        if self.ref_bg is not None:
+            self.ref_bg = SFGDataStore.cosmic_ray_killer(self.ref_bg, threshold, max_width, axis=2)[0]
+        self.cosmic_removed = True
+        return
+
+    def downconvert_spectrum(self, upconverter, force=False):
+        """Downconvert the energy axis of every spectrum by upconverter in wavenumbers.
+
+        Parameters
+        -----------
+        upconverter : float
+            The energy of the upconversion line to subtract in wavenumbers.
+        force : bool, optional
+            Allows downconversion more than once if true. Default False.
+        """
+        if self.downconverted and not force:
+            if self.verbose:
+                print('Spectra already downconverted, exiting. Pass flag "force=True" if you '
+                      'really want to downconvert twice.')
+            return
+
+        self.xaxis_raw = self.xaxis
+        self.xaxis = self.xaxis - upconverter
+        self.upconverter_used = upconverter
+        self.downconverted = True
+        if self.verbose:
+            print('Energy axes downconverted by ' + f'{upconverter:f}' + 'cm-1.')
+        return
+
+    def calibrate_spectrum(self, calibration_offset, force=False):
+        """Apply a calibration of arbitrary degree to the energy axis of every spectrum.
+
+        Parameters
+        -----------
+        calibration_offset : np array
+            Contains the calibration coefficients.
+        force : bool, optional
+            Allows calibration more than once if true. Default False.
+        """
+        calibration_offset = np.atleast_1d(calibration_offset)
+        degree = len(calibration_offset) - 1
+        if self.calibrated and not force:
+            print('Calibration already applied, exiting. Pass flag "force=True" if you'
+                  ' want to calibrate again more than once.')
+            return
+        if degree < 0:
+            print('No calibration coefficients or offset loaded, exiting.')
+            return
+
+        if degree == 0:
+            self.xaxis = self.xaxis + calibration_offset
+        else:
+            x_base = np.arange(0, np.shape(self.xaxis)[1], 1)
+            self.xaxis = np.broadcast_to(np.polynomial.polynomial.polyval(x_base, calibration_offset),
+                                         np.shape(self.xaxis)).copy()
+        self.applied_calibration = calibration_offset
+        self.calibrated = True
+        if self.verbose:
+            print('Calibration of degree ' + str(degree) + ' applied, coefficients used: ' +
+                  np.array2string(calibration_offset, separator=',')[1:-1])
+        return
+
+    def divide_exposure(self, force=False):
+        """Divide every stored spectrum by its own exposure time.
+
+        Parameters
+        -----------
+        force : bool, optional
+            Allows exposure division more than once if true. Default False.
+        """
+        if self.exp_divided and not force:
+            if self.verbose:
+                print('Exposure already divided, exiting. Pass flag "force=True" if you really want to divide '
+                      'it twice')
+            return
+
+        self.signal_raw = np.divide(self.signal_raw, self.acqtime[:, np.newaxis, np.newaxis], dtype=self.dtype)
+        if self.background is not None:
+            self.background = np.divide(self.background, self.acqtime_bg[:, np.newaxis, np.newaxis], dtype=self.dtype)
+        if self.ref_raw is not None:
+            self.ref_raw = np.divide(self.ref_raw, self.acqtime_ref[:, np.newaxis, np.newaxis], dtype=self.dtype)
+        if self.ref_bg is not None:
+            self.ref_bg = np.divide(self.ref_bg, self.acqtime_refbg[:, np.newaxis, np.newaxis], dtype=self.dtype)
+        self.exp_divided = True
+        if self.verbose:
+            print('All ' + str(len(self)) + ' spectra divided by their exposure times.')
+        return
+
+    def background_subtract(self, force=False):
+        """Subtract the matched background from every signal spectrum.
+
+        Parameters
+        -----------
+        force : bool, optional
+            Allows subtraction more than once if true. Default False.
+        """
+        if self.background is None:
+            print("Error - no background files found.")
+            return
+        if self.background_subtracted and not force:
+            if self.verbose:
+                print('Spectra already background subtracted, exiting. Pass flag "force=True" if you '
+                      'really want to subtract twice.')
+            return
+
+        if self.background_subtracted:
+            self.signal_subtracted = np.subtract(self.signal_subtracted, self.background[self.bg_index], dtype=self.dtype)
+        else:
+            self.signal_subtracted = np.subtract(self.signal_raw, self.background[self.bg_index], dtype=self.dtype)
+        self.background_subtracted = True
+        if self.verbose:
+            print('Backgrounds subtracted from the signal data.')
+        return
+
+    def ref_background_subtract(self, force=False):
+        """Subtract its background from every unique reference spectrum.
+
+        Parameters
+        -----------
+        force : bool, optional
+            Allows subtraction more than once if true. Default False.
+        """
+        if self.ref_bg is None or self.ref_raw is None:
+            print("Error - no reference or reference background files found, exiting.")
+            return
+        if self.refbackground_subtracted and not force:
+            if self.verbose:
+                print('References already backround subtracted, exiting. Pass flag "force=True" if you '
+                      'really want to subtract twice.')
+            return
+
+        if self.refbackground_subtracted:
+            self.ref_subtracted = np.subtract(self.ref_subtracted, self.ref_bg, dtype=self.dtype)
+        else:
+            self.ref_subtracted = np.subtract(self.ref_raw, self.ref_bg, dtype=self.dtype)
+        self.refbackground_subtracted = True
+        if self.verbose:
+            print('Backgrounds subtracted from the reference data.')
+        return
+
+    def normalise_data(self, force=False):
+        """Divide every signal spectrum by its matched reference spectrum.
+
+        Parameters
+        -----------
+        force : bool, optional
+            Allows normalisation more than once if true. Default False.
+        """
+        if self.ref_subtracted is None and self.ref_raw is None:
+            print("Error - no reference files found, exiting.")
+            return
+        if self.normalised and not force:
+            if self.verbose:
+                print('Spectra already normalised, exiting. Pass flag "force=True" if'
+                      ' you really want to normalise twice.')
+            return
+
+        if self.ref_subtracted is not None:
+            reference = self.ref_subtracted[self.ref_index]
+        else:
+            reference = self.ref_raw[self.ref_index]
+
+        if self.normalised:
+            self.signal_normalised = np.divide(self.signal_normalised, reference, dtype=self.dtype)
+        elif self.background_subtracted:
+            self.signal_normalised = np.divide(self.signal_subtracted, reference, dtype=self.dtype)
+        else:
+            self.signal_normalised = np.divide(self.signal_raw, reference, dtype=self.dtype)
+        self.normalised = True
+        if self.verbose:
+            print('Signal data successfully normalised.')
+        return
+
+    def to_datastores(self):
+        """Split the batch into one SFGDataStore per signal file.
+
+        The arrays in the datastores are views of the batch arrays, so no data is copied. Datastores that
+        share a background or reference share the same array.
+
+        Returns
+        ----------
+        datastores : list
+            Contains one SFGDataStore per signal file, in the order of signal_names.
+        """
+        datastores = []
+        for i in range(len(self)):
+            datastore = SFGDataStore()
+            datastore.verbose = self.verbose
+            datastore.stupidly_verbose = self.stupidly_verbose
+            datastore.dtype = self.dtype
+            datastore.filename_sig = self.directory + self.signal_names[i]
+            datastore.signal_raw = self.signal_raw[i]
+            datastore.acqtime = self.acqtime[i]
+            datastore.exp_divided_sig = self.exp_divided
+            datastore.cosmic_sig = self.cosmic_removed
+            if self.background is not None:
+                datastore.filename_bg = self.directory + self.bg_names[self.bg_index[i]]
+                datastore.background = self.background[self.bg_index[i]]
+                datastore.acqtime_bg = self.acqtime_bg[self.bg_index[i]]
+                datastore.exp_divided_bg = self.exp_divided
+                datastore.cosmic_bg = self.cosmic_removed
+            if self.ref_raw is not None:
+                datastore.filename_ref = self.directory + self.ref_names[self.ref_index[i]]
+                datastore.ref_raw = self.ref_raw[self.ref_index[i]]
+                datastore.acqtime_ref = self.acqtime_ref[self.ref_index[i]]
+                datastore.exp_divided_ref = self.exp_divided
+                datastore.cosmic_ref = self.cosmic_removed
+            if self.ref_bg is not None:
+                datastore.filename_refbg = self.directory + self.ref_bg_names[self.ref_index[i]]
+                datastore.ref_bg = self.ref_bg[self.ref_index[i]]
+                datastore.acqtime_refbg = self.acqtime_refbg[self.ref_index[i]]
+                datastore.exp_divided_refbg = self.exp_divided
+                datastore.cosmic_refbg = self.cosmic_removed
+            if self.ref_subtracted is not None:
+                datastore.ref_subtracted = self.ref_subtracted[self.ref_index[i]]
+            if self.signal_subtracted is not None:
+                datastore.signal_subtracted = self.signal_subtracted[i]
+            if self.signal_normalised is not None:
+                datastore.signal_normalised = self.signal_normalised[i]
+            datastore.xaxis = self.xaxis[i]
+            if self.xaxis_raw is not None:
+                datastore.xaxis_raw = self.xaxis_raw[i]
+            datastore.framewidth = self.framewidth
+            datastore.frameheight = self.frameheight
+            datastore.numframes = self.numframes[i]
+            datastore.upconverter_used = self.upconverter_used
+            datastore.applied_calibration = self.applied_calibration
+            datastore.calibrated = self.calibrated
+            datastore.downconverted = self.downconverted
+            datastore.background_subtracted = self.background_subtracted
+            datastore.refbackground_subtracted = self.refbackground_subtracted
+            datastore.normalised = self.normalised
+            datastores.append(datastore)
+        return datastores
+
+
+class SFGFileWriter():
+    """This class writes processed datastores to file, optionally on a background thread.
+
+    With a queue_size of more than 0 the datastores given to put() wait in a queue of at most queue_size
+    and are written by a background thread, so that processing of the next file overlaps with writing of the
+    last one. When the queue is full put() waits for the writer to catch up, so memory use stays bounded if
+    processing is faster than the disk. With a queue_size of 0 each datastore is written straight away.
+
+    An error while writing one file doesn't stop the others from being written. The errors are kept, and
+    close() prints them all and raises the first one, so they are never lost. Use it as a context manager,
+    so that it is closed (and its thread stopped) even if processing fails part way, e.g.
+
+    with SFGFileWriter(tools, directory) as writer:
+        for datastore in datastores:
+            writer.put(datastore)
+
+    Parameters
+    -----------
+    tools : SFGProcessTools object
+        Its write_data_to_file() method, and so its write settings, are used to write each datastore.
+    directory : str
+        Where the files are to be saved.
+    queue_size : int, optional
+        Maximum number of datastores waiting to be written. Default 8, 0 writes on the calling thread.
+    """
+
+    def __init__(self, tools, directory, queue_size=8):
+        self.tools = tools
+        self.directory = directory
+        self.errors = []
+        self.queue = None
+        self.thread = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.run, name='SFGFileWriter', daemon=True)
+            self.thread.start()
+
+    def write(self, datastore):
+        """Write one datastore, keeping any error rather than raising it."""
+        try:
+            self.tools.write_data_to_file(datastore, self.directory)
+        except Exception as error:
+            self.errors.append((datastore.filename_sig, error))
+        return
+
+    def run(self):
+        """Write datastores from the queue until close() puts None in it. Runs on the background thread."""
+        while True:
+            datastore = self.queue.get()
+            if datastore is None:
+                return
+            self.write(datastore)
+
+    def put(self, datastore):
+        """Write datastore, or queue it to be written, waiting if the queue is full."""
+        if self.thread is None:
+            self.write(datastore)
+        else:
+            self.queue.put(datastore)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the writer at the end of a with block, even if the block raised.
+
+        Everything already queued is still written. If the block raised, that error is the one that
+        propagates, and any errors from writing are only printed.
+        """
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
+
+    def close(self):
+        """Wait for every queued datastore to be written, then raise the first error, if there was one."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.errors:
+            for fname, error in self.errors:
+                print('Error writing', fname, ':', repr(error))
+            raise self.errors[0][1]
+        return
+
+
+def benchmark_import(repeats=5):
+    """Time "import sfgtools" in fresh Python processes, and check which slow optional modules it imports.
+
+    Each import is timed inside its own new interpreter, so nothing is cached between repeats except by the
+    operating system. Run it with "python -m sfgtools benchmark-import".
+
+    Parameters
+    -----------
+    repeats : int, optional
+        Number of times to import the module. Default 5.
+
+    Returns
+    ----------
+    times : list
+        Time taken by each import, in seconds.
+    modules : list
+        The slow optional modules (matplotlib, lxml, h5py, PyQt5) that were imported along with it.
+    """
+    code = ('import time, sys, json\n'
+            'start = time.perf_counter()\n'
+            'import sfgtools\n'
+            'elapsed = time.perf_counter() - start\n'
+            'print(json.dumps([elapsed, sorted(set(name.split(".")[0] for name in sys.modules) & '
+            '{"matplotlib", "lxml", "h5py", "PyQt5"})]))')
+    times = []
+    modules = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        elapsed, modules = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(elapsed)
+    return times, modules
+
+
+def main(argv=None):
+    """Command line tools for sfgtools, run as python -m sfgtools (or python sfgtools.py). Nothing here uses Qt.
+
+    "process" finds, matches, processes, and writes all the data in a directory with process_directory(), and
+    prints a JSON summary of the run, e.g.
+    python -m sfgtools process ./data --sample sample --ref ref --subtract --normalise --workers 4
+
+    Settings can also be read from a JSON file of SFGProcessTools attribute names and values with --config,
+    e.g. {"samplestring": "sample", "refstring": "ref", "subtract_check": true}. Options given on the command
+    line override the ones in the file.
+
+    "prune-cache" trims the on-disk result cache, e.g.
+    python -m sfgtools prune-cache --max-size 100
+
+    "benchmark-import" times how long importing sfgtools takes, see benchmark_import().
+
+    Parameters
+    -----------
+    argv : list, optional
+        Command line arguments. Default sys.argv[1:].
+
+    Returns
+    ----------
+    status : int
+        Exit status, 0 on success and 1 if processing failed.
+    """
+    parser = argparse.ArgumentParser(prog='sfgtools', description='Tools for processing SFG data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    process = subparsers.add_parser('process', help='Process and write all the data in a directory.')
+    process.add_argument('directory', help='Directory containing the .spe files.')
+    process.add_argument('--config', default=None, help='JSON file of settings (SFGProcessTools attributes).')
+    process.add_argument('--sample', dest='samplestring', help='Start of the names of the signal files.')
+    process.add_argument('--ref', dest='refstring', help='Start of the names of the reference files.')
+    process.add_argument('--bg', dest='bg_string', help='Part of the names of background files (default _bg).')
+    process.add_argument('--write-dir', dest='write_directory', help='Output directory (default the data one).')
+    for option, attribute, description in [('--downconvert', 'downconvert_check', 'Downconvert the energy axis.'),
+                                           ('--subtract', 'subtract_check', 'Subtract the backgrounds.'),
+                                           ('--normalise', 'normalise_check', 'Normalise by the references.'),
+                                           ('--exposure', 'exposure_check', 'Divide by the exposure times.'),
+                                           ('--calibrate', 'calibrate_check', 'Apply the calibration offset.'),
+                                           ('--cosmic', 'cosmic_kill_check', 'Remove cosmic rays.'),
+                                           ('--stacked', 'stacked_check', 'Process all files as one batch.'),
+                                           ('--cache', 'result_cache_check', 'Use the on-disk result cache.'),
+                                           ('--async-write', 'async_write_check', 'Write on a background thread.'),
+                                           ('--verbose', 'verbose', 'Print progress.')]:
+        process.add_argument(option, dest=attribute, action='store_true', default=None, help=description)
+    process.add_argument('--upconverter', dest='upconversion_line', type=float,
+                         help='Upconverter wavelength in nm, needed for --downconvert.')
+    process.add_argument('--calibration-offset', dest='calibration_offset', type=float, nargs='+',
+                         help='Calibration polynomial coefficients for --calibrate.')
+    process.add_argument('--cosmic-threshold', dest='cosmic_threshold', type=float, help='See cosmic_ray_killer().')
+    process.add_argument('--cosmic-width', dest='cosmic_max_width', type=int, help='See cosmic_ray_killer().')
+    process.add_argument('--formats', dest='write_formats', nargs='+',
+                         choices=['txt', 'npz', 'hdf5', 'hdf5_batch', 'png'], help='Output formats (default txt).')
+    process.add_argument('--workers', dest='num_workers', type=int, help='Number of worker processes.')
+    process.add_argument('--summary', default=None, help='Write the JSON summary to this file, not the screen.')
+    prune = subparsers.add_parser('prune-cache', help='Delete the least recently used processed results.')
+    prune.add_argument('--max-size', type=float, default=None,
+                       help='Maximum size of the cache in MB (default 1024, 0 empties the cache).')
+    prune.add_argument('--cache-dir', default=None, help='Result cache directory (default per-user cache).')
+    benchmark = subparsers.add_parser('benchmark-import', help='Time how long "import sfgtools" takes.')
+    benchmark.add_argument('--repeats', type=int, default=5, help='Number of imports to time (default 5).')
+    args = parser.parse_args(argv)
+
+    if args.command == 'benchmark-import':
+        times, modules = benchmark_import(args.repeats)
+        print('import sfgtools: best', round(1000 * min(times), 1), 'ms, median',
+              round(1000 * float(np.median(times)), 1), 'ms over', len(times), 'imports.')
+        print('Slow optional modules imported:', ', '.join(modules) if modules else 'none')
+        return 0
+
+    tools = SFGProcessTools()
+    if args.command == 'prune-cache':
+        tools.result_cache_directory = args.cache_dir
+        max_size = None if args.max_size is None else int(args.max_size * 2**20)
+        removed, freed = tools.prune_result_cache(max_size)
+        print('Removed', removed, 'results,', round(freed / 2**20, 2), 'MB freed from',
+              tools.get_result_cache_directory())
+        return 0
+
+    settings = {}
+    if args.config is not None:
+        with open(args.config) as configfile:
+            settings = json.load(configfile)
+    options = dict(vars(args))
+    for attribute in ['directory', 'config', 'summary', 'command']:
+        del options[attribute]
+    settings.update({attribute: value for attribute, value in options.items() if value is not None})
+
+    tools.write_file_check = True
+    for attribute, value in settings.items():
+        if attribute not in tools.__dict__:
+            parser.error('unknown setting ' + attribute)
+        if attribute == 'calibration_offset':
+            value = np.asarray(value, dtype=float)
+        setattr(tools, attribute, value)
+    if tools.samplestring is None or tools.refstring is None:
+        parser.error('the sample and reference filename strings are needed, use --sample and --ref')
+    if tools.downconvert_check and tools.upconversion_line is None:
+        parser.error('--downconvert needs the upconverter wavelength, use --upconverter')
+
+    try:
+        summary = tools.process_directory(args.directory)
+        summary['status'] = 'ok'
+    except Exception as error:
+        summary = {'directory': args.directory, 'status': 'error', 'error': repr(error)}
+
+    text = json.dumps(summary, indent=2)
+    if args.summary is None:
+        print(text)
+    else:
+        with open(args.summary, 'w') as summaryfile:
+            summaryfile.write(text + '\n')
+    return 0 if summary['status'] == 'ok' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
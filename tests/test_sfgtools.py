@@ -0,0 +1,394 @@
+"""Tests for sfgtools, run with "python -m pytest" from the top directory.
+
+These process the files in examples/ and compare the written results of the different processing paths.
+"""
+import filecmp
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import sfgtools
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+NUM_FILES = 3
+
+
+@pytest.fixture
+def data_directory(tmp_path):
+    """A directory with a few copies of the example signal and the example background and reference files."""
+    directory = tmp_path / 'data'
+    directory.mkdir()
+    for name in ('background_example.spe', 'reference_example.spe', 'reference_background_example.spe'):
+        shutil.copy(os.path.join(EXAMPLES, name), directory / name)
+    for i in range(NUM_FILES):
+        shutil.copy(os.path.join(EXAMPLES, 'signal_example.spe'), directory / ('sig_' + str(i) + '.spe'))
+    return str(directory) + os.sep
+
+
+def make_tools(data_directory, write_directory, calibration_offset):
+    tools = sfgtools.SFGProcessTools()
+    tools.verbose = False
+    tools.data_directory = data_directory
+    tools.write_directory = write_directory
+    tools.signal_names = ['sig_' + str(i) + '.spe' for i in range(NUM_FILES)]
+    tools.bg_names = ['background_example.spe'] * NUM_FILES
+    tools.ref_names = ['reference_example.spe'] * NUM_FILES
+    tools.ref_bg_names = ['reference_background_example.spe'] * NUM_FILES
+    tools.subtract_check = True
+    tools.normalise_check = True
+    tools.exposure_check = True
+    tools.downconvert_check = True
+    tools.upconversion_line = 808.
+    tools.calibrate_check = True
+    tools.calibration_offset = np.array(calibration_offset)
+    tools.cosmic_kill_check = True
+    tools.write_file_check = True
+    tools.plot_data_check = False
+    return tools
+
+
+@pytest.mark.parametrize('calibration_offset', [[3.0], [-2.0, 1.01, 1e-6]])
+def test_stacked_matches_per_file(data_directory, tmp_path, calibration_offset):
+    """Stacked processing writes exactly the same files as processing one file at a time."""
+    written = {}
+    for stacked in (False, True):
+        write_directory = str(tmp_path / ('stacked' if stacked else 'per_file')) + os.sep
+        os.makedirs(write_directory)
+        tools = make_tools(data_directory, write_directory, calibration_offset)
+        tools.stacked_check = stacked
+        datastores = tools.pull_trigger(plot=False)
+        assert len(datastores) == NUM_FILES
+        assert all(datastore.calibrated for datastore in datastores)
+        written[stacked] = write_directory
+
+    names = sorted(os.listdir(written[False]))
+    assert names and names == sorted(os.listdir(written[True]))
+    match, mismatch, errors = filecmp.cmpfiles(written[False], written[True], names, shallow=False)
+    assert mismatch == [] and errors == []
+
+
+def test_series_in_chunks_matches_single_frames(data_directory):
+    """A series processed a few frames at a time by process_series() matches each frame processed on its own."""
+    numframes = 5
+    tools = make_tools(data_directory, None, [-2.0, 1.01, 1e-6])
+    with open(os.path.join(EXAMPLES, 'signal_example.spe'), 'rb') as file:
+        header = bytearray(file.read(tools.data_offset_loc_loc))
+        frame = np.frombuffer(file.read(), dtype=np.float32)
+    frames = [frame * (1 + 0.25 * i) for i in range(numframes)]
+
+    # JDP one file holding the whole series, and one file per frame with the original single frame header
+    for i in range(numframes):
+        with open(data_directory + 'frame_' + str(i) + '.spe', 'wb') as file:
+            file.write(bytes(header) + frames[i].tobytes())
+    header[tools.numframes_loc:tools.numframes_loc + 4] = np.int32(numframes).tobytes()
+    with open(data_directory + 'series.spe', 'wb') as file:
+        file.write(bytes(header) + b''.join(i.tobytes() for i in frames))
+
+    blocks = list(tools.process_series(data_directory, 'series.spe', 'background_example.spe',
+                                       'reference_example.spe', 'reference_background_example.spe', chunk=2))
+    assert [len(batchstore) for batchstore, timestamps in blocks] == [2, 2, 1]
+    timestamps = np.concatenate([timestamps for batchstore, timestamps in blocks])
+    np.testing.assert_allclose(timestamps, np.arange(numframes) * blocks[0][0].acqtime[0])
+    series = [datastore for batchstore, timestamps in blocks for datastore in batchstore.to_datastores()]
+
+    tools.signal_names = ['frame_' + str(i) + '.spe' for i in range(numframes)]
+    tools.bg_names = ['background_example.spe'] * numframes
+    tools.ref_names = ['reference_example.spe'] * numframes
+    tools.ref_bg_names = ['reference_background_example.spe'] * numframes
+    tools.write_file_check = False
+    single = tools.pull_trigger(plot=False)
+
+    for from_series, from_file in zip(series, single):
+        np.testing.assert_allclose(from_series.signal_normalised, from_file.signal_normalised, rtol=1e-12)
+        np.testing.assert_allclose(from_series.xaxis, from_file.xaxis, rtol=1e-12)
+
+
+def test_batch_hdf5_rows(data_directory, tmp_path, monkeypatch):
+    """The batch HDF5 file keeps long filenames whole, has one row per file, and gives skipped files no row."""
+    h5py = pytest.importorskip('h5py')
+    longname = os.path.join('y' * 100, 'sig_' + 'x' * 200 + '.spe')
+    os.mkdir(data_directory + 'y' * 100)
+    shutil.copy(data_directory + 'sig_0.spe', data_directory + longname)
+    fname = str(tmp_path / 'batch.h5')
+    tools = make_tools(data_directory, str(tmp_path), [3.0])
+    tools.signal_names = ['sig_0.spe', longname]
+    tools.bg_names = ['background_example.spe'] * 2
+    tools.ref_names = ['reference_example.spe'] * 2
+    tools.ref_bg_names = ['reference_background_example.spe'] * 2
+    tools.write_file_check = False
+    datastores = tools.pull_trigger(plot=False)
+    tools.write_batch_to_hdf5(datastores, fname)
+
+    # JDP the same file again through a relative path, and one whose arrays don't fit the batch
+    monkeypatch.chdir(data_directory)
+    datastores[0].filename_sig = os.path.basename(datastores[0].filename_sig)
+    datastores[1].filename_sig = data_directory + 'sig_1.spe'
+    datastores[1].signal_raw = datastores[1].signal_raw[:, :10]
+    tools.write_batch_to_hdf5(datastores, fname)
+
+    with h5py.File(fname, 'r') as h5file:
+        filenames = [name.decode() for name in h5file['metadata']['filename']]
+        assert filenames == [os.path.abspath(data_directory + 'sig_0.spe'), os.path.abspath(data_directory + longname)]
+        assert h5file['signal_normalised'].shape[0] == 2
+        assert not np.isnan(h5file['signal_normalised'][()]).any()
+
+
+def test_lean_memory_reuses_buffer_after_cosmic_rays(data_directory):
+    """In lean mode the signal array left by cosmic ray removal is written over by every later step."""
+    tools = make_tools(data_directory, None, [3.0])
+    tools.lean_memory = True
+    datastore = tools.create_data_stores(1)[0]
+    tools.populate_data_stores([datastore], data_directory, tools.signal_names[:1], tools.bg_names[:1],
+                               tools.ref_names[:1], tools.ref_bg_names[:1])
+    checks = (tools.downconvert_check, tools.subtract_check, tools.normalise_check, tools.exposure_check,
+              tools.calibrate_check, tools.cosmic_kill_check)
+    tools.process_stage(datastore, 'cosmic', *checks)
+    buffer = datastore.signal_raw
+    assert buffer.base is None
+    for stage in ['downconvert', 'calibrate', 'exposure', 'subtract', 'normalise']:
+        tools.process_stage(datastore, stage, *checks)
+    assert datastore.signal_normalised is buffer
+
+
+def cached_run(data_directory, cachedir, **options):
+    """Process the example files through the result cache with fresh tools, counting the files read."""
+    tools = make_tools(data_directory, None, [3.0])
+    tools.write_file_check = False
+    tools.result_cache_check = True
+    tools.result_cache_directory = cachedir
+    for name, value in options.items():
+        setattr(tools, name, value)
+    reads = []
+    read_files = tools.read_files
+
+    def counted(fname, datastore, flag):
+        reads.append(fname)
+        return read_files(fname, datastore, flag)
+
+    tools.read_files = counted
+    datastores = tools.process_files_cached(data_directory, tools.signal_names, tools.bg_names, tools.ref_names,
+                                            tools.ref_bg_names)
+    return tools, datastores, reads
+
+
+def test_result_cache_hit_and_miss(data_directory, tmp_path):
+    """A hit returns the same results without reading anything, a changed option or input file misses."""
+    cachedir = str(tmp_path / 'cache')
+    tools, first, reads = cached_run(data_directory, cachedir)
+    assert reads
+    tools, second, reads = cached_run(data_directory, cachedir)
+    assert reads == []
+    for old, new in zip(first, second):
+        np.testing.assert_array_equal(old.signal_normalised, new.signal_normalised)
+        np.testing.assert_array_equal(old.xaxis, new.xaxis)
+        assert tools.make_header(old) == tools.make_header(new)
+
+    tools, datastores, reads = cached_run(data_directory, cachedir, cosmic_threshold=6.0)
+    assert len(reads) > 0
+
+    stat = os.stat(data_directory + 'background_example.spe')
+    os.utime(data_directory + 'background_example.spe', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    tools, datastores, reads = cached_run(data_directory, cachedir)
+    assert len(reads) > 0
+
+
+def test_result_cache_prune(tmp_path):
+    """prune_result_cache() deletes the least recently used results until the cache fits result_cache_max_size."""
+    tools = sfgtools.SFGProcessTools()
+    tools.verbose = False
+    tools.result_cache_directory = str(tmp_path)
+    for i in range(5):
+        fname = str(tmp_path / ('result_' + str(i) + '.npz'))
+        with open(fname, 'wb') as cachefile:
+            cachefile.write(b'0' * 1000)
+        os.utime(fname, (1000 + i, 1000 + i))
+    tools.result_cache_max_size = 2500
+    assert tools.prune_result_cache() == (3, 3000)
+    assert sorted(os.listdir(tmp_path)) == ['result_3.npz', 'result_4.npz']
+    assert tools.prune_result_cache(0) == (2, 2000)
+
+
+@pytest.mark.parametrize('queue_size', [0, 2])
+def test_file_writer_raises_write_errors(data_directory, tmp_path, queue_size):
+    """An error writing one file doesn't stop the others, and close() raises it, even from the writer thread."""
+    tools = make_tools(data_directory, str(tmp_path), [3.0])
+    tools.write_file_check = False
+    datastores = tools.pull_trigger(plot=False)
+    write_data_to_file = tools.write_data_to_file
+
+    def failing(datastore, directory):
+        if datastore is datastores[1]:
+            raise RuntimeError('disk full')
+        return write_data_to_file(datastore, directory)
+
+    tools.write_data_to_file = failing
+    write_directory = tmp_path / 'out'
+    write_directory.mkdir()
+    writer = sfgtools.SFGFileWriter(tools, str(write_directory) + os.sep, queue_size)
+    for datastore in datastores:
+        writer.put(datastore)
+    with pytest.raises(RuntimeError, match='disk full'):
+        writer.close()
+    assert writer.thread is None
+    assert sorted(os.listdir(write_directory)) == ['sig_0_processed.txt', 'sig_2_processed.txt']
+
+
+def test_async_writes_match_sync_writes(data_directory, tmp_path):
+    """Files written on the background thread are byte for byte the same as those written straight away."""
+    written = []
+    for async_write in (False, True):
+        write_directory = str(tmp_path / ('async' if async_write else 'sync')) + os.sep
+        os.makedirs(write_directory)
+        tools = make_tools(data_directory, write_directory, [3.0])
+        tools.write_formats = ['txt', 'npz']
+        tools.async_write_check = async_write
+        tools.write_queue_size = 1
+        tools.pull_trigger(plot=False)
+        written.append(write_directory)
+
+    names = sorted(os.listdir(written[0]))
+    assert len(names) == 2 * NUM_FILES and names == sorted(os.listdir(written[1]))
+    match, mismatch, errors = filecmp.cmpfiles(written[0], written[1], names, shallow=False)
+    assert mismatch == [] and errors == []
+
+
+def test_text_files_match_savetxt(data_directory, tmp_path):
+    """write_text_file() writes exactly what np.savetxt(fmt='%-10.5f') writes, for real and awkward data."""
+    tools = make_tools(data_directory, str(tmp_path), [3.0])
+    tools.write_file_check = False
+    datastore = tools.pull_trigger(plot=False)[0]
+    headstring = tools.make_header(datastore) + tools.text_columns
+    processed = np.array([datastore.xaxis, datastore.signal_normalised[0], datastore.ref_subtracted[0],
+                          datastore.signal_subtracted[0], datastore.signal_raw[0], datastore.background[0],
+                          datastore.ref_raw[0], datastore.ref_subtracted[0], datastore.xaxis_raw]).T
+    awkward = np.array([[np.nan, np.inf, -np.inf], [-0.0, 1e12, -123456.789012], [5e-6, -5e-6, 0.000005]])
+
+    for i, data in enumerate([processed, awkward, processed.astype(np.float32)]):
+        fname = str(tmp_path / ('new_' + str(i) + '.txt'))
+        oldname = str(tmp_path / ('old_' + str(i) + '.txt'))
+        tools.write_text_file(fname, data, headstring)
+        np.savetxt(oldname, data, header=headstring, fmt='%-10.5f')
+        assert filecmp.cmp(fname, oldname, shallow=False)
+
+
+def noisy_frames(numframes=9, frameheight=2, framewidth=50):
+    """Frames of a smooth spectrum with a little noise, and one big spike in a single frame."""
+    rng = np.random.default_rng(0)
+    spectrum = 1000 + 500 * np.sin(np.linspace(0, 3, framewidth))
+    frames = spectrum + rng.normal(0, 5, (numframes, frameheight, framewidth))
+    spiked = frames.copy()
+    spiked[4, 1, 20] += 1e5
+    return frames, spiked
+
+
+@pytest.mark.parametrize('mode', ['median', 'sigmaclip', 'min'])
+def test_accumulation_rejects_single_frame_spike(mode):
+    """The cosmic ray rejecting modes ignore a spike in one frame, where "sum" keeps it."""
+    frames, spiked = noisy_frames()
+    tools = sfgtools.SFGProcessTools()
+    tools.accumulation_mode = mode
+    clean = tools.accumulate_frames(frames)
+    result = tools.accumulate_frames(spiked)
+    assert np.shape(result) == np.shape(frames)[1:]
+    # JDP the result is on the scale of the sum, and the spike moves it by much less than the noise
+    assert abs(result[1, 20] - clean[1, 20]) < 10 * len(frames) * 5
+    np.testing.assert_allclose(result.mean(), frames.sum(axis=0).mean(), rtol=0.05)
+
+    tools.accumulation_mode = 'sum'
+    assert tools.accumulate_frames(spiked)[1, 20] - tools.accumulate_frames(frames)[1, 20] == pytest.approx(1e5)
+
+
+@pytest.mark.parametrize('mode', ['sum', 'median', 'sigmaclip', 'min'])
+@pytest.mark.parametrize('chunk_size', [1, 7, 64])
+def test_accumulation_chunks_match_whole(mode, chunk_size):
+    """Working through the frames in small chunks gives the same result as doing them all at once."""
+    spiked = noisy_frames()[1]
+    tools = sfgtools.SFGProcessTools()
+    tools.accumulation_mode = mode
+    whole = tools.accumulate_frames(spiked)
+    tools.accumulation_chunk_size = chunk_size
+    np.testing.assert_allclose(tools.accumulate_frames(spiked), whole, rtol=1e-12)
+
+
+def test_accumulation_invalid_mode_sums(capsys):
+    """An invalid accumulation_mode says so and sums the frames instead."""
+    spiked = noisy_frames()[1]
+    tools = sfgtools.SFGProcessTools()
+    tools.accumulation_mode = 'mean'
+    result = tools.accumulate_frames(spiked)
+    assert 'accumulation_mode of mean invalid' in capsys.readouterr().out
+    np.testing.assert_allclose(result, spiked.sum(axis=0), rtol=1e-12)
+
+
+@pytest.fixture
+def cli_directory(tmp_path):
+    """A directory named the way get_filenames_smart() expects, with an empty output directory."""
+    directory = tmp_path / 'cli'
+    directory.mkdir()
+    (directory / 'out').mkdir()
+    for i in range(2):
+        shutil.copy(os.path.join(EXAMPLES, 'signal_example.spe'), directory / ('sample_' + str(i) + '.spe'))
+        shutil.copy(os.path.join(EXAMPLES, 'background_example.spe'), directory / ('sample_' + str(i) + '_bg.spe'))
+    shutil.copy(os.path.join(EXAMPLES, 'reference_example.spe'), directory / 'ref.spe')
+    shutil.copy(os.path.join(EXAMPLES, 'reference_background_example.spe'), directory / 'ref_bg.spe')
+    return directory
+
+
+def test_cli_process_writes_files_and_summary(cli_directory):
+    """"process" writes each requested format for every signal file and a JSON summary of what it did."""
+    summary_file = cli_directory / 'summary.json'
+    status = sfgtools.main(['process', str(cli_directory), '--sample', 'sample', '--ref', 'ref', '--subtract',
+                            '--normalise', '--write-dir', str(cli_directory / 'out'), '--formats', 'txt', 'npz',
+                            '--summary', str(summary_file)])
+    assert status == 0
+    with open(summary_file) as file:
+        summary = json.load(file)
+    assert summary['status'] == 'ok'
+    assert summary['num_files'] == summary['num_processed'] == 2
+    assert summary['signal_files'] == ['sample_0.spe', 'sample_1.spe']
+    assert summary['background_files'] == ['sample_0_bg.spe', 'sample_1_bg.spe']
+    assert summary['reference_files'] == ['ref.spe'] * 2
+    assert summary['reference_background_files'] == ['ref_bg.spe'] * 2
+    assert summary['write_formats'] == ['txt', 'npz']
+    assert sorted(os.listdir(cli_directory / 'out')) == ['sample_0_processed.npz', 'sample_0_processed.txt',
+                                                         'sample_1_processed.npz', 'sample_1_processed.txt']
+
+
+def test_cli_config_merges_with_options(cli_directory, tmp_path, capsys):
+    """Settings come from the --config file, except where the command line gives them too."""
+    config = tmp_path / 'config.json'
+    with open(config, 'w') as file:
+        json.dump({'samplestring': 'nothing', 'refstring': 'ref', 'subtract_check': True,
+                   'normalise_check': True, 'write_formats': ['npz']}, file)
+    status = sfgtools.main(['process', str(cli_directory), '--config', str(config), '--sample', 'sample',
+                            '--formats', 'txt', '--write-dir', str(cli_directory / 'out')])
+    assert status == 0
+    summary = json.loads(capsys.readouterr().out)
+    assert summary['signal_files'] == ['sample_0.spe', 'sample_1.spe']
+    assert summary['write_formats'] == ['txt']
+
+    # JDP the subtraction and normalisation from the file are applied, the same as setting them directly
+    write_directory = tmp_path / 'direct'
+    write_directory.mkdir()
+    tools = sfgtools.SFGProcessTools()
+    tools.verbose = False
+    tools.samplestring, tools.refstring = 'sample', 'ref'
+    tools.subtract_check = tools.normalise_check = tools.write_file_check = True
+    tools.write_directory = str(write_directory)
+    tools.process_directory(str(cli_directory))
+    names = ['sample_0_processed.txt', 'sample_1_processed.txt']
+    match, mismatch, errors = filecmp.cmpfiles(cli_directory / 'out', write_directory, names, shallow=False)
+    assert match == names
+
+
+@pytest.mark.parametrize('options', [['--sample', 'sample'], ['--ref', 'ref'], []])
+def test_cli_needs_sample_and_ref(cli_directory, options, capsys):
+    """Without both the sample and reference strings "process" stops with a usage error and writes nothing."""
+    with pytest.raises(SystemExit) as error:
+        sfgtools.main(['process', str(cli_directory), '--write-dir', str(cli_directory / 'out')] + options)
+    assert error.value.code == 2
+    assert 'use --sample and --ref' in capsys.readouterr().err
+    assert os.listdir(cli_directory / 'out') == []